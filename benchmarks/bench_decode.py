@@ -0,0 +1,101 @@
+"""事件解码基准：旧路径（json.loads 全部帧） vs EventCodec（预过滤 + orjson + MessageEvent）
+
+用法: python benchmarks/bench_decode.py [语料.jsonl]
+语料每行是一条原始WebSocket帧；不提供时生成模拟语料：机器人所在群远多于启用的群，
+另有心跳等元事件。
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+from main import ENABLED_GROUPS, EventCodec, MessageEvent  # noqa: E402
+
+FRAMES = 50_000
+
+
+def synthetic_corpus(count, rng):
+    """约70%来自未启用的群，10%心跳，5%通知，其余为启用群的消息"""
+    enabled = sorted(ENABLED_GROUPS)
+    frames = []
+    for index in range(count):
+        roll = rng.random()
+        if roll < 0.10:
+            event = {"time": 1700000000 + index, "self_id": 10000, "post_type": "meta_event",
+                     "meta_event_type": "heartbeat", "status": {"online": True, "good": True}, "interval": 30000}
+        elif roll < 0.15:
+            event = {"time": 1700000000 + index, "self_id": 10000, "post_type": "notice",
+                     "notice_type": "group_increase", "sub_type": "approve",
+                     "group_id": rng.choice(enabled + [rng.randint(10 ** 8, 10 ** 9)]),
+                     "user_id": rng.randint(10 ** 8, 10 ** 9), "operator_id": 0}
+        else:
+            group_id = rng.choice(enabled) if roll > 0.85 else rng.randint(10 ** 8, 10 ** 9)
+            text = "".join(rng.choice("今天天气不错我们去打游戏吧哈哈哈好的") for _ in range(rng.randint(2, 40)))
+            if rng.random() < 0.3:
+                text += "[CQ:face,id=178]"
+            user_id = rng.randint(10 ** 8, 10 ** 9)
+            event = {"self_id": 10000, "user_id": user_id, "time": 1700000000 + index,
+                     "message_id": rng.randint(1, 2 ** 31), "message_seq": index, "real_id": index,
+                     "message_type": "group", "sender": {"user_id": user_id, "nickname": "测试用户", "card": "",
+                                                           "role": "member"},
+                     "raw_message": text, "font": 14, "sub_type": "normal",
+                     "message": [{"type": "text", "data": {"text": text}}],
+                     "message_format": "array", "post_type": "message", "group_id": group_id}
+        frames.append(json.dumps(event, ensure_ascii=False))
+    return frames
+
+
+def legacy_path(frames):
+    kept = 0
+    for frame in frames:
+        event = json.loads(frame)
+        if event.get("post_type") == "message" and event.get("group_id") in ENABLED_GROUPS:
+            kept += 1
+    return kept
+
+
+def codec_path(frames):
+    codec = EventCodec(ENABLED_GROUPS)
+    kept = 0
+    for frame in frames:
+        event = codec.decode(frame)
+        if event is not None and event.get("post_type") == "message":
+            MessageEvent.from_dict(event)
+            if event.get("group_id") in ENABLED_GROUPS:
+                kept += 1
+    return kept, codec
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main_bench(path=None):
+    if path:
+        with open(path, encoding="utf-8") as f:
+            frames = [line.rstrip("\n") for line in f if line.strip()]
+        print(f"语料: {path}（{len(frames)} 帧）")
+    else:
+        frames = synthetic_corpus(FRAMES, random.Random(7))
+        print(f"语料: 模拟生成 {len(frames)} 帧")
+
+    legacy_time, legacy_kept = timed(legacy_path, frames)
+    codec_time, (codec_kept, codec) = timed(codec_path, frames)
+    if legacy_kept != codec_kept:
+        print(f"⚠️ 结果不一致: 旧路径保留{legacy_kept}条，新路径保留{codec_kept}条")
+
+    print(f"JSON库: {'orjson' if main.orjson is not None else 'json（未安装orjson）'}")
+    print(f"旧路径:     {legacy_time * 1e6 / len(frames):6.2f} us/帧")
+    print(f"EventCodec: {codec_time * 1e6 / len(frames):6.2f} us/帧 "
+          f"（预过滤丢弃 {codec.filtered}，完整解析 {codec.decoded}）")
+    print(f"加速比: {legacy_time / codec_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main_bench(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,279 @@
+"""压测：机器人连上模拟Napcat，按固定速率推送群消息，统计吞吐、决策到动作的延迟和内存增长
+
+用法: python benchmarks/bench_load.py [--rate 500] [--duration 20] [--latency 0.02] [--fail 0.01]
+                                      [--corpus 录制.jsonl] [--tracemalloc] [--max-p99 毫秒] [--workers N]
+                                      [--accounts N] [--restart-at 秒 --downtime 秒]
+
+不提供语料时生成模拟流量：大部分是正常聊天，少量命中各级违禁词、广告，偶尔有人连续刷屏。
+语料每行是一条原始WebSocket帧（可以是 CAPTURE_DIR 录制的 .jsonl.gz 分段），其中的消息事件会改写message_id（和群内序号）以便把撤回动作对应回消息。
+“决策到动作的延迟”指模拟Napcat推送消息到收到对应 delete_msg 请求之间的时间。
+--accounts 大于1时启动多个模拟Napcat作为多个账号，每条事件推送给所有账号，测试去重和动作分摊。
+--restart-at 在推送开始后该时刻停掉第一个模拟Napcat，--downtime 秒后在原端口重新启动，模拟Napcat重启，
+输出从断开到重新连上的恢复时间，以及断线期间暂存、恢复后重发的处罚动作数。
+设置 --max-p99 后，p99 超过该值（毫秒）时以非零状态退出，可用于部署前的回归检查。
+"""
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402
+from fake_napcat import FakeNapcat  # noqa: E402
+
+# 命中默认规则的示例文本（修改了 main.py 的词库时相应调整）
+VIOLATIONS = (
+    (0.010, "level_3", "来玩kukemc吧"),
+    (0.015, "level_2", "你看那个女大"),
+    (0.020, "ad", "加群领福利 vx123456"),
+    (0.025, "level_1", "你是不是脑残"),
+)
+CHAT = "今天天气不错我们去打游戏吧哈哈哈好的服务器什么时候开"
+FLOOD_RATE = 0.005  # 触发一次连续刷屏的概率
+
+
+def rss_bytes() -> int:
+    """当前进程常驻内存（Linux读/proc，其余平台取峰值）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def synthetic_traffic(server, rng, users):
+    """无限生成模拟群消息事件"""
+    groups = sorted(main.ENABLED_GROUPS)
+    while True:
+        group_id = rng.choice(groups)
+        user_id = rng.randrange(10 ** 8, 10 ** 8 + users)
+        roll = rng.random()
+        if roll < FLOOD_RATE:
+            for _ in range(main.FLOOD_MAX_MESSAGES + 1):
+                yield server.group_message(group_id, user_id, "刷屏" * rng.randint(1, 5))
+            continue
+        text = None
+        for threshold, _, sample in VIOLATIONS:
+            if roll < threshold:
+                text = sample
+                break
+        if text is None:
+            text = "".join(rng.choice(CHAT) for _ in range(rng.randint(2, 40)))
+            if rng.random() < 0.2:
+                text += "[CQ:face,id=178]"
+        yield server.group_message(group_id, user_id, text)
+
+
+def recorded_traffic(path, message_ids):
+    """循环回放录制的原始帧，消息事件的message_id改为唯一值"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        frames = [line.strip() for line in f if line.strip()]
+    if not frames:
+        raise SystemExit(f"语料为空: {path}")
+    while True:
+        for frame in frames:
+            event = json.loads(frame)
+            if event.get("post_type") == "message":
+                event["message_id"] = event["message_seq"] = next(message_ids)
+                event.pop("real_seq", None)
+            yield event
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def wait_until(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def restart_napcat(bot, server, expected, at, downtime):
+    """在 at 秒时停掉模拟Napcat，downtime 秒后重启，返回 (断开到恢复的秒数, 重启到恢复的秒数)"""
+    await asyncio.sleep(at)
+    stopped = time.perf_counter()
+    await server.stop()
+    await asyncio.sleep(downtime)
+    await server.start()
+    restarted = time.perf_counter()
+    if not await wait_until(lambda: bot.connections.ready == expected, 120):
+        return None
+    recovered = time.perf_counter()
+    return recovered - stopped, recovered - restarted
+
+
+async def run(args):
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    servers = [
+        await FakeNapcat(token="bench", latency=args.latency, jitter=args.jitter, fail_rate=args.fail,
+                         drop_rate=args.drop, self_id=10000 + index, seed=args.seed + index).start()
+        for index in range(args.accounts)
+    ]
+    server = servers[0]
+    main.WS_ENDPOINTS = [{"name": f"账号{index}", "url": fake.url, "token": "bench"}
+                         for index, fake in enumerate(servers)]
+    main.MC_SERVERS = {}  # 压测时不查询真实的MC服务器
+    main.AUDIT_LOG_FILE = None
+    main.logger.setLevel(logging.ERROR)
+    console = logging.StreamHandler()
+    console.setLevel(logging.ERROR)  # 多进程模式下工作进程的日志也经这个处理器输出
+    logging.getLogger().addHandler(console)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = rss_bytes()
+    bot = main.GroupRuleEnforcer(shards=main.ShardPool(args.workers) if args.workers > 1 else None)
+    bot_task = asyncio.create_task(bot.run())
+    if not await wait_until(lambda: bot.connections.ready == len(servers), 10):
+        raise SystemExit("机器人未能连接到模拟Napcat")
+    snapshot_before = tracemalloc.take_snapshot() if args.tracemalloc else None
+    rss_connected = rss_bytes()
+
+    restart = None
+    if args.restart_at is not None:
+        restart = asyncio.create_task(restart_napcat(bot, server, len(servers), args.restart_at, args.downtime))
+
+    rng = random.Random(args.seed)
+    traffic = (recorded_traffic(args.corpus, itertools.count(1)) if args.corpus
+               else synthetic_traffic(server, rng, args.users))
+    sent_at = {}
+    undelivered = 0
+    total = int(args.rate * args.duration)
+    started = time.perf_counter()
+    for index in range(total):
+        delay = started + index / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        event = next(traffic)
+        pushed_at = time.perf_counter()
+        delivered = 0
+        for fake in servers:
+            delivered += await fake.push(event)
+        # Napcat停机期间推送不出去的消息不计入
+        if not delivered:
+            undelivered += 1
+        elif event.get("post_type") == "message":
+            sent_at[event["message_id"]] = pushed_at
+    send_elapsed = time.perf_counter() - started
+
+    def processed():
+        return bot.shards.stats().get("processed", 0) if bot.shards is not None else bot.dispatcher.processed
+
+    def dropped():
+        if bot.shards is not None:
+            stats = bot.shards.stats()
+            return stats.get("dropped", 0) + stats["dropped_forwarding"]
+        return bot.dispatcher.dropped
+
+    recovery = await restart if restart is not None else None
+    drained = await wait_until(
+        lambda: processed() + dropped() >= len(sent_at) and bot.outbound.depth == 0 and bot.actions.in_flight == 0
+        and not bot.connections.outbox,
+        args.drain_timeout,
+    )
+    elapsed = time.perf_counter() - started
+    rss_after = rss_bytes()
+    traced_growth = None
+    if args.tracemalloc:
+        main_file = os.path.abspath(main.__file__)
+        diff = tracemalloc.take_snapshot().compare_to(snapshot_before, "filename")
+        traced_growth = sum(stat.size_diff for stat in diff
+                            if os.path.abspath(stat.traceback[0].filename) == main_file)
+        tracemalloc.stop()
+
+    latencies = [
+        (received - sent_at[request["params"]["message_id"]]) * 1000
+        for fake in servers
+        for received, request in fake.actions_named("delete_msg")
+        if request.get("params", {}).get("message_id") in sent_at
+    ]
+    action_counts = {}
+    for fake in servers:
+        for _, request in fake.actions:
+            action_counts[request.get("action")] = action_counts.get(request.get("action"), 0) + 1
+    account_counts = [len(fake.actions) for fake in servers]
+
+    processed_count, dropped_count = processed(), dropped()
+    await bot.shutdown()
+    await asyncio.gather(bot_task, return_exceptions=True)
+    for fake in servers:
+        await fake.stop()
+
+    mib = 1024 * 1024
+    p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+    print(f"推送 {len(sent_at)} 条消息，目标速率 {args.rate}/s，实际推送速率 {total / send_elapsed:,.0f}/s"
+          + (f"（{undelivered} 条在Napcat停机期间未送达）" if undelivered else ""))
+    print(f"处理完成 {processed_count} 条，丢弃 {dropped_count} 条，"
+          f"吞吐 {processed_count / elapsed:,.0f} 条/s" + ("" if drained else "（未在时限内处理完）"))
+    print(f"决策到动作延迟（{len(latencies)} 次撤回）: p50 {p50:.1f} ms, p99 {p99:.1f} ms, "
+          f"最大 {max(latencies, default=float('nan')):.1f} ms")
+    print("模拟Napcat收到的动作: " + ", ".join(f"{name} {count}" for name, count in sorted(action_counts.items())))
+    if restart is not None:
+        if recovery is None:
+            print("模拟Napcat重启后未能在120秒内恢复连接")
+        else:
+            print(f"Napcat重启恢复: 断开到重新连上 {recovery[0]:.2f} s（停机 {args.downtime:.2f} s，"
+                  f"重启后 {recovery[1] * 1000:.0f} ms 连上），重连 {bot.connections.reconnects} 次，"
+                  f"暂存后重发 {bot.connections.replayed} 个处罚动作，丢弃 {bot.connections.outbox_dropped} 个")
+    if len(servers) > 1:
+        print("各账号收到的动作数: " + ", ".join(str(count) for count in account_counts)
+              + f"，重复事件 {bot.connections.dedup.duplicates} 条已去重")
+    print(f"常驻内存: 启动前 {rss_before / mib:.1f} MiB, 连接后 {rss_connected / mib:.1f} MiB, "
+          f"结束时 {rss_after / mib:.1f} MiB（增长 {(rss_after - rss_connected) / mib:+.1f} MiB）")
+    if traced_growth is not None:
+        print(f"main.py 分配的内存增长: {traced_growth / mib:+.2f} MiB")
+    if bot.shards is not None:
+        print(f"（{args.workers} 个工作进程，常驻内存只统计主进程）")
+    print(f"机器人状态规模: 违规记录 {len(bot.violation_records)}, 刷屏跟踪 {len(bot.flood)}, "
+          f"成员缓存 {len(bot.member_cache)}, 到期调度 {len(bot.expiry)}")
+
+    if args.max_p99 is not None and not p99 <= args.max_p99:
+        print(f"p99 {p99:.1f} ms 超过上限 {args.max_p99} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="机器人端到端压测")
+    parser.add_argument("--rate", type=float, default=500, help="每秒推送的消息数")
+    parser.add_argument("--duration", type=float, default=20, help="推送时长（秒）")
+    parser.add_argument("--users", type=int, default=20000, help="模拟流量中的用户数")
+    parser.add_argument("--corpus", default=None, help="录制的原始帧（每行一条），代替模拟流量")
+    parser.add_argument("--latency", type=float, default=0.02, help="模拟Napcat的响应延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.01, help="额外随机延迟上限（秒）")
+    parser.add_argument("--fail", type=float, default=0.0, help="动作返回失败的比例")
+    parser.add_argument("--drop", type=float, default=0.0, help="动作不回复的比例")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="推送结束后等待处理完的时限（秒）")
+    parser.add_argument("--tracemalloc", action="store_true", help="统计main.py分配的内存（会明显变慢）")
+    parser.add_argument("--max-p99", type=float, default=None, help="p99延迟上限（毫秒），超过则返回非零")
+    parser.add_argument("--workers", type=int, default=1, help="工作进程数，大于1时测试多进程模式")
+    parser.add_argument("--accounts", type=int, default=1, help="模拟的Napcat账号数，大于1时测试多账号连接池")
+    parser.add_argument("--restart-at", type=float, default=None, help="推送开始后第几秒模拟Napcat重启")
+    parser.add_argument("--downtime", type=float, default=2.0, help="模拟重启时Napcat停机的时长（秒）")
+    parser.add_argument("--seed", type=int, default=1)
+    arguments = parser.parse_args()
+    if arguments.corpus:
+        arguments.corpus = os.path.abspath(arguments.corpus)
+    # 状态数据库写到临时目录，不影响正式的 bot_state.db
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        sys.exit(asyncio.run(run(arguments)))
@@ -0,0 +1,85 @@
+"""文字归一化微基准：每条消息增加的耗时（无缓存 / 命中缓存），以及对常见绕过写法的识别效果
+
+用法: python benchmarks/bench_normalize.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import RULE_TIERS, RuleMatcher, TextNormalizer  # noqa: E402
+
+CHAT = "今天天气不错我们去打游戏吧哈哈哈好的服务器什么时候开有人一起玩吗 okgoodgame"
+# 绕过写法 -> 应命中的级别（修改了 main.py 的词库时相应调整）
+EVASIONS = (
+    ("k u k e", "level_3"), ("ｋｕｋｅ", "level_3"), ("KUKEMC", "level_3"), ("k.u.k.e", "level_3"),
+    ("k̶u̶k̶e̶", "level_3"), ("酷 可", "level_3"), ("酷*可", "level_3"), ("кuке", "level_3"),
+    ("你是不是腦殘", "level_1"), ("脑 残", "level_1"), ("傻 逼", "level_1"), ("死媽", "level_1"),
+    ("加 群 领福利", "ad"), ("加-群", "ad"), ("Ｖ Ｘ 123456", "ad"), ("w x:abc", "ad"), ("WeiXin", "ad"),
+    # 夹在句子里的绕过写法
+    ("来玩k u k e服务器", "level_3"), ("k u k e啊", "level_3"), ("去k.u.k.e玩", "level_3"),
+    ("有福利快来 加 群", "ad"), ("私聊我v x领", "ad"), ("要的 w x 找我", "ad"),
+)
+# 不应命中的正常文字
+CLEAN = ("new xbox", "wow x", "ok ukelele", "hello world", "我们去看电影吧", "今天 天气 不错", "The VX-7 radio",
+         "I am a boy", "我a了一下 x轴")
+# 正常聊天的句子：断句标点或空格两侧的字连起来恰好是违禁词，不能拼接
+SENTENCES = (
+    "这个好酷，可以教我吗", "我是女。大家好", "我想参加，群主同意吗", "好酷！可以再来一次吗", "太酷了 可以的",
+    "这游戏真酷，可惜我没钱", "我是女生，大家好呀", "明天要参加、群里的活动吗", "我也想参加 群聊好热闹",
+    "你说的对，脑子残了才这么干", "刚下班，死活打不开游戏", "先加好友，群里人太多了",
+    "看了个vlog，那个up主更新了吗", "Wow, xbox is cool", "New x-ray mod", "He is a star, then gone.",
+)
+MESSAGES = 2000
+
+
+def per_message_us(func, messages, budget=1.0):
+    """在时间预算内尽量多跑，返回每条消息的平均耗时（微秒）"""
+    done = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < budget:
+        for text in messages:
+            func(text)
+        done += len(messages)
+    return (time.perf_counter() - start) / done * 1e6
+
+
+def main():
+    rng = random.Random(42)
+    messages = ["".join(rng.choice(CHAT) for _ in range(rng.randint(5, 60))) for _ in range(MESSAGES)]
+    matcher = RuleMatcher(RULE_TIERS)
+
+    started = time.perf_counter()
+    normalizer = TextNormalizer(cache_size=0)
+    print(f"构建翻译表: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    uncached = per_message_us(normalizer.normalize, messages)
+    cached_normalizer = TextNormalizer(cache_size=MESSAGES * 2)
+    per_message_us(cached_normalizer.normalize, messages, budget=0.1)  # 预热缓存
+    cached = per_message_us(cached_normalizer.normalize, messages)
+    match_only = per_message_us(matcher.match, messages)
+    print(f"每条消息: 归一化 {uncached:.2f} us（命中缓存 {cached:.2f} us），规则匹配本身 {match_only:.2f} us")
+
+    def tier(text, normalize):
+        hit = matcher.match(normalizer.normalize(text) if normalize else text)
+        return hit[0] if hit else None
+
+    print(f"\n{'写法':<16} {'应命中':<8} {'不归一化':<10} {'归一化':<10}")
+    caught = missed = 0
+    for text, expected in EVASIONS:
+        before, after = tier(text, False), tier(text, True)
+        caught += after == expected
+        missed += before != expected
+        print(f"{text:<16} {expected:<8} {str(before):<10} {str(after):<10}")
+    normal = CLEAN + SENTENCES
+    false_positives = [(text, tier(text, True)) for text in normal if tier(text, True) is not None]
+    print(f"\n{len(EVASIONS)} 种绕过写法: 不归一化漏掉 {missed} 种，归一化后识别 {caught} 种")
+    print(f"{len(normal)} 条正常文字误判: {len(false_positives)}" + (f" {false_positives}" if false_positives else ""))
+    if caught < len(EVASIONS) or false_positives:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
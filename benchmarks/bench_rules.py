@@ -0,0 +1,90 @@
+"""违禁词匹配微基准：逐条 re.search（旧实现） vs RuleMatcher（单次扫描）
+
+用法: python benchmarks/bench_rules.py [规则数 ...]
+默认依次测试 10 / 100 / 10000 条规则。
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import RuleMatcher  # noqa: E402
+
+CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严"
+MESSAGES = 2000
+
+
+def legacy_check(tiers, text):
+    """旧实现：每个级别逐条调用 re.search"""
+    for name, patterns in tiers:
+        if any(re.search(pattern, text) for pattern in patterns):
+            return name
+    return None
+
+
+def make_rules(count, rng):
+    """生成规则：约九成纯文字词，一成带字符类的正则"""
+    tiers = [("level_3", set()), ("level_2", set()), ("ad", set()), ("level_1", set())]
+    while sum(len(patterns) for _, patterns in tiers) < count:
+        word = "".join(rng.choice(CHARS) for _ in range(rng.randint(2, 4)))
+        if rng.random() < 0.1:
+            word = f"{word[0]}[{word[1]}{rng.choice(CHARS)}]{word[2:]}"
+        rng.choice(tiers)[1].add(word)
+    return tiers
+
+
+def make_messages(tiers, rng):
+    """生成测试消息：约5%的消息夹带一条规则词"""
+    literals = [p for _, patterns in tiers for p in patterns if "[" not in p]
+    messages = []
+    for _ in range(MESSAGES):
+        text = "".join(rng.choice(CHARS + "  abc123") for _ in range(rng.randint(5, 60)))
+        if literals and rng.random() < 0.05:
+            pos = rng.randint(0, len(text))
+            text = text[:pos] + rng.choice(literals) + text[pos:]
+        messages.append(text)
+    return messages
+
+
+def per_message_us(func, messages, budget=1.0):
+    """在时间预算内尽量多跑，返回每条消息的平均耗时（微秒）"""
+    done = 0
+    start = time.perf_counter()
+    while True:
+        for text in messages:
+            func(text)
+            done += 1
+            if done % 50 == 0 and time.perf_counter() - start > budget:
+                return (time.perf_counter() - start) / done * 1e6
+        if time.perf_counter() - start > budget:
+            return (time.perf_counter() - start) / done * 1e6
+
+
+def main(sizes):
+    rng = random.Random(42)
+    print(f"{'规则数':>8} {'构建(ms)':>10} {'旧实现(us/条)':>16} {'RuleMatcher(us/条)':>20} {'加速比':>8}")
+    for size in sizes:
+        tiers = make_rules(size, rng)
+        messages = make_messages(tiers, rng)
+
+        start = time.perf_counter()
+        matcher = RuleMatcher(tiers)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        mismatches = sum(
+            1 for text in messages[:200]
+            if legacy_check(tiers, text) != (matcher.match(text) or (None,))[0]
+        )
+        if mismatches:
+            print(f"⚠️ {size}条规则时有{mismatches}条消息结果不一致")
+
+        legacy = per_message_us(lambda text: legacy_check(tiers, text), messages)
+        fast = per_message_us(matcher.match, messages)
+        print(f"{size:>8} {build_ms:>10.1f} {legacy:>16.1f} {fast:>20.1f} {legacy / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 10000])
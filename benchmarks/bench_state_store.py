@@ -0,0 +1,77 @@
+"""状态持久化基准：10万用户记录的冷启动耗时，以及批量写盘耗时
+
+用法: python benchmarks/bench_state_store.py [用户数]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main as bot_main  # noqa: E402
+from main import GroupRuleEnforcer, ModerationStore  # noqa: E402
+
+
+async def populate(path, users):
+    """写入测试数据：每个用户一条违规记录，另有部分封禁、禁言、点赞冷却"""
+    store = ModerationStore(path)
+    now = time.time()
+    for user_id in range(users):
+        store.save(ModerationStore.VIOLATION, user_id, now - user_id, user_id % 5 + 1)
+        if user_id % 10 == 0:
+            store.save(ModerationStore.BAN, user_id)
+        if user_id % 20 == 0:
+            store.save(ModerationStore.MUTE, user_id, now + 3600)
+        if user_id % 5 == 0:
+            store.save(ModerationStore.LIKE, user_id, now - 60)
+    started = time.perf_counter()
+    await store.flush()
+    elapsed = time.perf_counter() - started
+    await store.close()
+    return elapsed
+
+
+def cold_start(path):
+    """构造完整的机器人实例：打开数据库并恢复成内存中的结构（包括到期调度）"""
+    started = time.perf_counter()
+    bot = GroupRuleEnforcer(store=ModerationStore(path))
+    elapsed = time.perf_counter() - started
+    counts = (len(bot.ban_list), len(bot.mute_list), len(bot.violation_records), len(bot.like_cooldowns))
+    bot.store._conn.close()
+    return elapsed, counts
+
+
+async def incremental_flush(path, changes):
+    """模拟运行中的一次批量写盘"""
+    store = ModerationStore(path)
+    now = time.time()
+    for user_id in range(changes):
+        store.save(ModerationStore.VIOLATION, user_id, now, 9)
+    started = time.perf_counter()
+    await store.flush()
+    elapsed = time.perf_counter() - started
+    await store.close()
+    return elapsed
+
+
+def main(users):
+    bot_main.logger.setLevel("WARNING")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "state.db")
+        write = asyncio.run(populate(path, users))
+        print(f"写入 {users} 个用户的初始数据: {write * 1000:.0f} ms（单次批量事务）")
+        print(f"数据库大小: {os.path.getsize(path) / 1024 / 1024:.1f} MiB")
+
+        for attempt in range(3):
+            elapsed, (bans, mutes, violations, likes) = cold_start(path)
+            print(f"冷启动 #{attempt + 1}: {elapsed * 1000:.0f} ms "
+                  f"（封禁{bans} 禁言{mutes} 违规{violations} 点赞冷却{likes}）")
+
+        flush = asyncio.run(incremental_flush(path, 1000))
+        print(f"1000 条修改批量写盘: {flush * 1000:.1f} ms（在写线程中执行，不阻塞事件循环）")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,74 @@
+"""跨用户重复内容检测微基准：不同消息速率下每条消息的耗时，以及对一波变体广告的识别效果
+
+按模拟时间推进，低速率时的耗时主要是时间槽轮换（实际运行中每个群约每 WAVE_WINDOW/4 秒一次）。
+
+用法: python benchmarks/bench_wave.py [--messages 20000] [--raiders 8]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import DuplicateWaveDetector, TextNormalizer  # noqa: E402
+
+CHAT = "今天天气不错我们去打游戏吧哈哈哈好的服务器什么时候开有人一起玩吗一起来挖矿建房子"
+AD = "这里有免费的会员激活码，需要的私聊我拿，名额有限先到先得"
+# 刷广告的账号常用的小改动，与原文视为同一波
+MUTATIONS = (
+    lambda text, rng: text,
+    lambda text, rng: text + "!" * rng.randint(1, 3),
+    lambda text, rng: "【" + text + "】",
+    lambda text, rng: text.replace("免费", "免 费"),
+    lambda text, rng: text + str(rng.randint(100, 999)),
+    lambda text, rng: text.replace("私聊我", "滴我"),
+)
+RATES = (1, 5, 20, 100)  # 单个群每秒消息数
+
+
+def chatter(rng: random.Random, count: int):
+    return ["".join(rng.choice(CHAT) for _ in range(rng.randint(5, 40))) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="跨用户重复内容检测微基准")
+    parser.add_argument("--messages", type=int, default=20000, help="每种速率的消息数")
+    parser.add_argument("--raiders", type=int, default=8, help="刷广告的账号数")
+    args = parser.parse_args()
+    rng = random.Random(42)
+    normalizer = TextNormalizer()
+    messages = [normalizer.normalize(text) for text in chatter(rng, args.messages)]
+
+    print(f"{'每秒消息':>8} {'每条耗时(us)':>12} {'误判':>6}")
+    for rate in RATES:
+        detector = DuplicateWaveDetector()
+        flagged = 0
+        started = time.perf_counter()
+        for index, text in enumerate(messages):
+            flagged += len(detector.observe(1, index % 500, index, text, now=index / rate))
+        elapsed = time.perf_counter() - started
+        print(f"{rate:>8} {elapsed / len(messages) * 1e6:>12.1f} {flagged:>6}")
+
+    # 正常聊天中混入一波变体广告，每个账号发一条
+    detector = DuplicateWaveDetector()
+    now, caught, first = 0.0, set(), None
+    raid = {rng.randrange(200, 400): raider for raider in range(args.raiders)}
+    for index, text in enumerate(chatter(rng, 600)):
+        now += 0.2
+        user_id, message_id = index % 300, index
+        if index in raid:
+            user_id = 100000 + raid[index]
+            text = rng.choice(MUTATIONS)(AD, rng)
+        targets = detector.observe(1, user_id, message_id, normalizer.normalize(text), now=now)
+        if targets and first is None:
+            first = index
+        caught.update(user_id for user_id, _ in targets)
+    raiders = set(100000 + raider for raider in range(args.raiders))
+    print(f"\n{len(raid)} 个账号发送变体广告: 识别 {len(caught & raiders)} 个，误判 {len(caught - raiders)} 个"
+          + (f"，在第 {sorted(raid).index(first) + 1} 条广告时发现" if first is not None else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""本地模拟的 Napcat（OneBot v11）正向WebSocket服务，用于压测和回归测试，不需要真实QQ账号
+
+支持 set_websocket_event、send_group_msg、set_group_ban、set_group_kick、delete_msg、
+send_like、get_group_member_info、get_login_info、get_status、get_msg（只能查到 group_message 构造过的消息）；可设置响应延迟、失败率和丢包率（不回复，触发超时）。
+收到的每个动作都带接收时间记录在 actions 里，push() 向所有已连接的客户端推送事件。
+
+单独运行: python benchmarks/fake_napcat.py [--port 3001] [--latency 0.02] [--fail 0.01]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import websockets
+
+
+class FakeNapcat:
+    """模拟的 Napcat WebSocket 服务端"""
+
+    ACTIONS = frozenset({
+        "set_websocket_event", "send_group_msg", "set_group_ban", "set_group_kick",
+        "delete_msg", "send_like", "get_group_member_info", "get_login_info", "get_status", "get_msg",
+    })
+    MESSAGE_HISTORY = 10000  # get_msg 能查到的最近消息数，压测时不让模拟服务端的内存持续增长
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, token: Optional[str] = None,
+                 latency: float = 0.0, jitter: float = 0.0, fail_rate: float = 0.0, drop_rate: float = 0.0,
+                 self_id: int = 10000, seed: Optional[int] = None):
+        self.host = host
+        self.port = port  # 0 表示随机端口，启动后回填
+        self.token = token  # 设置后校验 Authorization: Bearer <token>
+        self.latency = latency  # 每个响应的固定延迟（秒）
+        self.jitter = jitter  # 在固定延迟上再加 0~jitter 秒的随机延迟
+        self.fail_rate = fail_rate  # 返回 status=failed 的比例
+        self.drop_rate = drop_rate  # 不回复的比例
+        self.self_id = self_id
+        self.roles: Dict[Tuple[int, int], str] = {}  # (群号, 用户ID): 角色，默认 member
+        self.actions: List[Tuple[float, Dict]] = []  # (接收时间, 请求) 按接收顺序
+        self.messages: Dict[int, Dict] = {}  # 消息ID: group_message 构造的事件，供 get_msg 查询
+        self.clients: Set = set()
+        self.connections = 0  # 累计接受的连接数
+        self.server = None
+        self._rng = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await websockets.serve(self._serve, self.host, self.port)
+        self.port = next(iter(self.server.sockets)).getsockname()[1]
+        return self
+
+    async def stop(self):
+        await self.disconnect_all()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def disconnect_all(self, code: int = 1001):
+        """主动断开所有客户端（模拟Napcat重启）"""
+        await asyncio.gather(*(client.close(code) for client in list(self.clients)), return_exceptions=True)
+
+    async def push(self, event: Dict) -> int:
+        """向所有客户端推送一个事件，返回推送到的客户端数"""
+        return await self.push_raw(json.dumps(event, ensure_ascii=False))
+
+    async def push_raw(self, frame: str) -> int:
+        """推送一条原始帧（回放录制的流量时使用）"""
+        sent = 0
+        for client in list(self.clients):
+            try:
+                await client.send(frame)
+                sent += 1
+            except websockets.exceptions.ConnectionClosed:
+                pass
+        return sent
+
+    def group_message(self, group_id: int, user_id: int, text: str, message_id: Optional[int] = None,
+                      role: str = "member") -> Dict:
+        """构造一条群消息事件"""
+        message_id = message_id if message_id is not None else next(self._message_ids)
+        if len(self.messages) >= self.MESSAGE_HISTORY:
+            del self.messages[next(iter(self.messages))]
+        self.messages[message_id] = event = {
+            "time": int(time.time()), "self_id": self.self_id, "post_type": "message", "message_type": "group",
+            "sub_type": "normal", "message_id": message_id, "message_seq": message_id,  # 群内序号，各账号相同
+            "group_id": group_id, "user_id": user_id, "raw_message": text, "message": text, "font": 0,
+            "sender": {"user_id": user_id, "nickname": str(user_id), "card": "", "role": role},
+        }
+        return event
+
+    def actions_named(self, name: str) -> List[Tuple[float, Dict]]:
+        return [(received, request) for received, request in self.actions if request.get("action") == name]
+
+    async def _serve(self, websocket, path=None):
+        if self.token is not None:
+            request = getattr(websocket, "request", None)
+            headers = request.headers if request is not None else websocket.request_headers
+            if headers.get("Authorization") != f"Bearer {self.token}":
+                await websocket.close(1008, "unauthorized")
+                return
+        self.clients.add(websocket)
+        self.connections += 1
+        try:
+            async for frame in websocket:
+                received = time.perf_counter()
+                try:
+                    request = json.loads(frame)
+                except ValueError:
+                    continue
+                self.actions.append((received, request))
+                task = asyncio.create_task(self._respond(websocket, request))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(websocket)
+
+    async def _respond(self, websocket, request: Dict):
+        roll = self._rng.random()
+        if roll < self.drop_rate:
+            return
+        delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        action = request.get("action")
+        if action not in self.ACTIONS:
+            response = {"status": "failed", "retcode": 1404, "data": None, "message": f"不支持的动作: {action}"}
+        elif roll < self.drop_rate + self.fail_rate:
+            response = {"status": "failed", "retcode": 100, "data": None, "message": "注入的失败"}
+        else:
+            response = {"status": "ok", "retcode": 0, "data": self._result(action, request.get("params") or {}),
+                        "message": ""}
+        if "echo" in request:
+            response["echo"] = request["echo"]
+        try:
+            await websocket.send(json.dumps(response, ensure_ascii=False))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def _result(self, action: str, params: Dict):
+        if action == "send_group_msg":
+            return {"message_id": next(self._message_ids)}
+        if action == "get_group_member_info":
+            group_id, user_id = params.get("group_id"), params.get("user_id")
+            return {"group_id": group_id, "user_id": user_id, "nickname": str(user_id), "card": "",
+                    "role": self.roles.get((group_id, user_id), "member")}
+        if action == "get_login_info":
+            return {"user_id": self.self_id, "nickname": str(self.self_id)}
+        if action == "get_status":
+            return {"online": True, "good": True}
+        if action == "get_msg":
+            return self.messages.get(params.get("message_id"))
+        return None
+
+
+async def _serve_forever(args):
+    server = await FakeNapcat(host=args.host, port=args.port, token=args.token, latency=args.latency,
+                              jitter=args.jitter, fail_rate=args.fail, drop_rate=args.drop).start()
+    print(f"模拟Napcat已启动: {server.url}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(f"已收到 {len(server.actions)} 个动作，当前连接 {len(server.clients)} 个")
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟的Napcat WebSocket服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3001)
+    parser.add_argument("--token", default=None, help="要求客户端携带的访问令牌")
+    parser.add_argument("--latency", type=float, default=0.0, help="响应延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="额外随机延迟上限（秒）")
+    parser.add_argument("--fail", type=float, default=0.0, help="返回失败的比例")
+    parser.add_argument("--drop", type=float, default=0.0, help="不回复的比例")
+    try:
+        asyncio.run(_serve_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,23 +1,128 @@
 import asyncio
+import atexit
+import operator
+import bisect
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import socket
+import sqlite3
+import struct
+import time
+import unicodedata
 import websockets
 import re
-from typing import Dict, Set, Optional, List
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Set, Optional, List, Tuple
 import logging
+import logging.handlers
 from datetime import datetime, timedelta
-from functools import wraps
 import aiohttp
+from aiohttp import web
+
+try:
+    import aiodns  # 可选：用于解析 _minecraft._tcp SRV 记录
+except ImportError:
+    aiodns = None
+
+try:
+    import orjson  # 可选：更快的JSON编解码
+except ImportError:
+    orjson = None
+
+# 日志配置
+LOG_LEVEL = logging.INFO
+LOG_FILE = "bot.log"  # 日志文件，按大小轮转，旧文件压缩为 .gz
+LOG_MAX_BYTES = 10 * 1024 * 1024  # 单个日志文件上限（字节）
+LOG_BACKUP_COUNT = 5  # 保留的历史日志文件数
+AUDIT_LOG_FILE = "audit.jsonl"  # 处罚审计日志（每行一个JSON），设为None关闭
+
+
+def _gzip_rotator(source: str, dest: str):
+    """日志轮转时把旧文件压缩成 .gz"""
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class _AuditFormatter(logging.Formatter):
+    """审计记录格式化为一行JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "event": record.getMessage()}
+        entry.update(getattr(record, "audit", {}))
+        return json.dumps(entry, ensure_ascii=False)
+
+
+log_listener: Optional[logging.handlers.QueueListener] = None  # setup_logging() 之后才有；只导入模块时不写日志文件
+
+
+def setup_logging(log_queue=None) -> Optional[logging.handlers.QueueListener]:
+    """日志经队列交给后台线程写盘，事件循环线程不做磁盘IO
+
+    只在机器人进程入口调用（重复调用无效）。工作进程传入 log_queue，日志交给主进程的日志线程输出，不打开文件。
+    """
+    global log_listener
+    root = logging.getLogger()
+    if log_queue is not None:
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        return None
+    if log_listener is not None:
+        return log_listener
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    is_audit = lambda record: record.name == "audit"
+
+    console = logging.StreamHandler()
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True
+    )
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = _gzip_rotator
+    handlers = [console, file_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.addFilter(lambda record: not is_audit(record))
+
+    if AUDIT_LOG_FILE:
+        audit_handler = logging.handlers.RotatingFileHandler(
+            AUDIT_LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True
+        )
+        audit_handler.namer = lambda name: name + ".gz"
+        audit_handler.rotator = _gzip_rotator
+        audit_handler.setFormatter(_AuditFormatter())
+        audit_handler.addFilter(is_audit)
+        handlers.append(audit_handler)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    return log_listener
+
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
-)
 logger = logging.getLogger(__name__)
+audit_logger = logging.getLogger("audit")
+
+
+def audit(event: str, **fields):
+    """记录一条处罚审计（AUDIT_LOG_FILE 为 None 时不写）"""
+    if AUDIT_LOG_FILE:
+        audit_logger.info(event, extra={"audit": fields})
 
 # 配置部分
 WS_URL = "ws://这不能说喵自己改喵:这不能说喵自己改喵"
@@ -25,11 +130,30 @@ ACCESS_TOKEN = "这不能说喵自己改喵"
 ADMIN_GROUP_ID = 923820685
 SLEEP_TARGET_ID = 1724270068  # 战云用户ID
 
+# 多账号配置：填写后代替上面的 WS_URL / ACCESS_TOKEN，同时连接多个Napcat账号。
+# 禁言、踢人、撤回优先交给在该群是管理员的账号，其余动作在账号间分摊；某个连接断开时立即改用其它账号
+WS_ENDPOINTS = [
+    # {"name": "主号", "url": "ws://127.0.0.1:3001", "token": "..."},
+    # {"name": "小号", "url": "ws://127.0.0.1:3002", "token": "..."},
+]
+CONNECTION_HEALTH_INTERVAL = 30  # 连接健康检查间隔（秒）
+CONNECTION_HEALTH_TIMEOUT = 5  # 健康检查超时（秒），超时或账号离线时断开重连
+EVENT_DEDUP_TTL = 120  # 多个账号在同一群会各收到一份事件，在该时间（秒）内按内容去重
+EVENT_DEDUP_SIZE = 100000  # 去重记录与消息来源记录的最大条数
+RECONNECT_DELAY_MIN = 0.5  # 断线后第一次重连前的等待（秒），之后每次失败翻倍，并随机缩短至多一半
+RECONNECT_DELAY_MAX = 60  # 重连等待上限（秒）
+RECONNECT_STABLE_AFTER = 30  # 连接保持超过该时间（秒）后才断开的，重连等待从头计算
+OUTBOX_SIZE = 1000  # 所有连接都断开时暂存的处罚动作（撤回、禁言、踢人）上限，超出时丢弃最早的
+OUTBOX_TTL = 600  # 暂存超过该时间（秒）的动作在恢复连接后不再重发
+
+# 三级违禁词的黑名单时长（天），期间再出现在群里会被直接踢出
+LEVEL_3_BLACKLIST_DAYS = 30
+
 # 点赞相关配置
 LIKE_COOLDOWN_HOURS = 24  # 冷却时间（小时）
 LIKE_COUNT = 10  # 每次点赞数量
 
-# Minecraft服务器配置
+# Minecraft服务器配置（可选 "interval": 该服务器单独的检查间隔秒数）
 MC_SERVERS = {
     "主服": {"host": "mc.tzi998.com", "port": 25565},
     "模组服": {"host": "mod.tzi998.com", "port": 25565},
@@ -40,6 +164,64 @@ MC_SERVERS = {
 SERVER_CHECK_INTERVAL = 300  # 5分钟检查一次
 SERVER_CHECK_RETRY = 3  # 离线检测重试次数
 SERVER_CHECK_TIMEOUT = 15  # 服务器查询超时时间（秒）
+SERVER_CHECK_JITTER = 15  # 每台服务器检查时间的随机抖动（秒），避免所有服务器同时查询
+MC_STATUS_CACHE_TTL = 60  # 状态缓存有效期（秒），!mcstatus 在有效期内直接读缓存
+MC_QUERY_HEDGED = True  # 同时向所有状态API发请求，取最先返回的有效结果
+MC_QUERY_DEADLINE = 5  # 并发查询所有API的总时限（秒）
+MC_HTTP_POOL_SIZE = 20  # HTTP连接池大小
+MC_DNS_CACHE_TTL = 300  # DNS缓存时间（秒）
+MC_NATIVE_PING = True  # 优先直接用Minecraft协议查询服务器，失败时才使用第三方API
+MC_PING_TIMEOUT = 5  # 直接协议查询的超时时间（秒）
+
+# API请求配置
+ACTION_TIMEOUT = 10  # 单个API请求等待响应的超时时间（秒）
+
+# 状态持久化配置（封禁、禁言、违规记录、点赞冷却，重启后自动恢复）
+STATE_DB_PATH = "bot_state.db"  # SQLite数据库文件
+STATE_FLUSH_INTERVAL = 1.0  # 批量写盘间隔（秒）
+
+# 群成员信息缓存配置
+MEMBER_CACHE_TTL = 600  # 成员信息缓存有效期（秒），管理员变动等通知会立即刷新
+MEMBER_CACHE_SIZE = 20000  # 最多缓存的成员数，超出时淘汰最久未使用的
+
+# 发送调度配置（令牌桶限速，防止被平台限流丢弃动作）
+ACTION_RATE_GLOBAL = 20  # 全局每秒最多发出的动作数
+ACTION_BURST_GLOBAL = 40  # 全局突发上限
+ACTION_RATE_PER_GROUP = 5  # 每个群每秒最多发出的动作数
+ACTION_BURST_PER_GROUP = 10  # 每个群突发上限
+# 动作优先级（数字越小越先发）：撤回/踢人 > 禁言/查询 > 通知 > 点赞
+ACTION_PRIORITIES = {
+    "set_websocket_event": 0,
+    "delete_msg": 0,
+    "set_group_kick": 0,
+    "set_group_ban": 1,
+    "get_group_member_info": 1,
+    "get_msg": 1,
+    "send_group_msg": 2,
+    "send_like": 3,
+}
+NOTICE_COALESCE_WINDOW = 0.3  # 同一群在该时间内（秒）的多条通知合并成一条发送
+NOTICE_MAX_LENGTH = 3000  # 合并后单条消息的最大长度
+
+# 重复处罚去重配置
+ENFORCEMENT_COOLDOWN = 30  # 同一用户同一动作完成后，该时间内（秒）不再重复执行
+ENFORCEMENT_LEDGER_SIZE = 10000  # 最多记录的近期动作数
+
+# 事件分发配置
+EVENT_WORKERS = 8  # 事件处理协程数，同一群的事件总由同一个协程按序处理
+EVENT_QUEUE_SIZE = 1000  # 每个处理协程的队列上限，满了直接丢弃新事件
+
+# 多进程配置（单核跑满时使用）
+WORKER_PROCESSES = 1  # 大于1时启用多进程：主进程保持唯一的连接，各群按一致性哈希分给这些工作进程处理
+SHARD_VIRTUAL_NODES = 64  # 一致性哈希中每个工作进程的虚拟节点数
+SHARD_MAX_BUFFER = 4 * 1024 * 1024  # 发往单个工作进程、尚未送出的数据上限（字节），超过时丢弃新事件
+SHARD_STATS_INTERVAL = 1.0  # 工作进程上报处理计数的间隔（秒）
+
+# 运行指标配置
+METRICS_ENABLED = True  # 记录计数器与延迟直方图，关闭后所有埋点直接返回
+METRICS_SAMPLE_RATE = 1.0  # 延迟直方图的采样比例（0~1），生产环境可调低以减少计时开销，计数器不受影响
+METRICS_HOST = "127.0.0.1"  # 指标接口只监听本机
+METRICS_PORT = None  # Prometheus抓取端口（如 9108），None表示不开启接口
 
 # 启用的群组列表（只有在这些群中才会启用bot）
 ENABLED_GROUPS = {
@@ -47,113 +229,2644 @@ ENABLED_GROUPS = {
     1022514126   # 备用群
 }
 
-# 违禁词库（支持正则表达式）
-LEVEL_3_WORDS = {r"kukemc", r"kuke", r"酷可", r"kamu", r"咖目"}  # 直接踢出
-LEVEL_2_WORDS = {r"以色列", r"女大", r"特朗普"}                   # 禁言1天 
-LEVEL_1_WORDS = {r"傻[逼屄]", r"脑残", r"死妈"}                # 禁言10分钟
+# 违禁词库（支持正则表达式）
+LEVEL_3_WORDS = {r"kukemc", r"kuke", r"酷可", r"kamu", r"咖目"}  # 直接踢出
+LEVEL_2_WORDS = {r"以色列", r"女大", r"特朗普"}                   # 禁言1天 
+LEVEL_1_WORDS = {r"傻[逼屄]", r"脑残", r"死妈"}                # 禁言10分钟
+
+# 文字归一化：违禁词与广告规则在归一化后的文字上匹配（全角转半角、转小写、繁体与形近字转简体/拉丁字母，
+# 去掉插在单独的字符之间的空格和符号，断句标点两侧不拼接），规则应写成小写简体、不含空格和标点
+NORMALIZE_TEXT = True
+NORMALIZE_CACHE_SIZE = 4096  # 归一化结果缓存条数（复读、刷屏的消息只处理一次）
+NORMALIZE_EXTRA_MAP = {}  # 额外的单字映射，如 {"庫": "库"}
+
+# 广告检测规则（与违禁词一样只在去掉CQ码后的纯文字上匹配，不会命中表情/图片的参数）
+AD_PATTERNS = {
+    r"加群",             # 加群邀请
+    r"(vx|wx|weixin)(?!-)"  # 微信相关（"vx-7" 这样的型号除外）
+}
+
+# 刷屏检测配置
+FLOOD_MAX_MESSAGES = 3  # 时间窗口内最多允许的消息数，达到即视为刷屏
+FLOOD_WINDOW = 5  # 时间窗口（秒）
+FLOOD_GROUP_RULES = {  # 按群覆盖默认规则，群号: {"messages": 条数, "window": 秒}
+    # 923820685: {"messages": 5, "window": 10},
+}
+FLOOD_IDLE_TTL = 60  # 用户闲置多久后清除其刷屏记录（秒）
+
+# 跨用户重复内容检测：多个账号在短时间内发送相同或相近的消息（刷广告、刷屏潮），开启处罚后所有发送者一并按广告处理
+WAVE_ENABLED = True
+WAVE_ENFORCE = False  # 默认只写日志和审计（wave_log）；用回放或审计确认不会误伤群里的复读、祝贺后再设为 True 开启处罚
+WAVE_MIN_USERS = 4  # 时间窗口内发送相同或相近内容的不同用户数达到该值即视为刷屏潮
+WAVE_WINDOW = 60  # 时间窗口（秒）
+WAVE_MIN_LENGTH = 8  # 去掉空白后少于该字数的消息不参与（"哈哈哈"、"+1"之类的复读很正常）
+WAVE_SIMILARITY = 0.6  # 两条消息的MinHash指纹相同的比例达到该值视为相近内容
+WAVE_RECENT_SIZE = 512  # 每个群保留的最近消息指纹数，用于找出同一波的其他发送者
+WAVE_SKETCH_WIDTH = 4096  # 每个群计数草图每行的宽度（取2的幂），内存约为 宽度×3行×5份×4字节
+
+# 图片广告：管理员回复图片消息发送 !blockimg 把图片加入黑名单，之后任何人发同一张图片都按广告处理
+IMAGE_BLOCKLIST_ENABLED = True
+IMAGE_RECENT_SIZE = 2000  # 每个群记录的最近图片数与最近带图片的消息数（重复检测、回复命令查找图片）
+IMAGE_REPEAT_USERS = 5  # 同一张图片（动画表情除外）在时间窗口内被该数量的不同用户发送时写日志和审计（不处罚，确认是广告后用 !blockimg），0表示不检测
+IMAGE_REPEAT_WINDOW = 60  # 重复图片的时间窗口（秒）
+
+# 批量撤回：按 (群, 用户) 记录最近的消息ID，供 !purge 和处罚时撤回该用户之前的消息
+PURGE_PER_USER = 30  # 每个用户最多记录的消息数
+PURGE_USERS_PER_GROUP = 300  # 每个群最多记录的用户数（最久没发言的先淘汰），每群最多 用户数×条数 条记录
+PURGE_ON_PUNISH = True  # 三级违禁词和广告处罚时，同时撤回该用户之前的消息
+PURGE_AUTO_MINUTES = 10  # 处罚时自动撤回最近多少分钟内的消息
+
+# 规则分级（按处罚轻重从高到低排列），一条消息命中多个时只执行最重的一个
+RULE_TIERS = (
+    ("level_3", LEVEL_3_WORDS),
+    ("level_2", LEVEL_2_WORDS),
+    ("ad", AD_PATTERNS),
+    ("level_1", LEVEL_1_WORDS),
+)
+
+# 事件录制与影子模式（修改词库前评估影响，见 replay.py）
+CAPTURE_DIR = None  # 把启用群的消息事件录制为压缩JSONL分段的目录（如 "captures"），None表示不录制
+CAPTURE_SEGMENT_EVENTS = 200000  # 每个分段最多的事件数，写满换新文件
+CAPTURE_FLUSH_INTERVAL = 1.0  # 批量写盘间隔（秒）
+SHADOW_MODE = False  # 影子模式：照常判断但不执行任何处罚，只在日志和审计中记录本应执行的处罚
+SHADOW_RULE_TIERS = None  # 候选规则（格式同 RULE_TIERS），设置后每条消息同时按候选规则判断，记录与现行规则不一致的结果
+
+# websockets 14 起默认客户端把 extra_headers 改名为 additional_headers
+WS_HEADERS_ARG = "additional_headers" if int(websockets.__version__.split(".")[0]) >= 14 else "extra_headers"
+
+
+def json_loads(data):
+    """解析JSON（安装了orjson时使用orjson）"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def json_dumps(obj) -> str:
+    """序列化为JSON文本（安装了orjson时使用orjson）"""
+    # 与标准库一致：非字符串的键（如用户ID）转成字符串
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8") if orjson is not None else json.dumps(obj)
+
+
+class Histogram:
+    """一个标签组合的直方图：各桶计数（最后一格是超过最大上界的值）、总和与次数"""
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics:
+    """进程内运行指标：计数器、延迟直方图与按需读取的数值，导出为Prometheus文本格式
+
+    enabled=False 时所有记录方法立即返回；sample_rate<1 时只对部分调用计时（直方图按比例抽样），
+    计数器始终完整。计时用法：started = metrics.clock() ... metrics.observe_since(name, started, 标签=值)
+    """
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, enabled: bool = METRICS_ENABLED, sample_rate: float = METRICS_SAMPLE_RATE):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.counters: Dict[str, Dict[Tuple, float]] = {}  # 指标名: {标签元组: 值}
+        self.histograms: Dict[str, Dict[Tuple, Histogram]] = {}  # 指标名: {标签元组: 直方图}
+        self.readers: Dict[str, Tuple[str, object]] = {}  # 指标名: (类型, 读取函数)，导出时才调用
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """计数器加值"""
+        if not self.enabled:
+            return
+        series = self.counters.setdefault(name, {})
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + value
+
+    def clock(self) -> float:
+        """开始计时；关闭或本次未被抽样时返回0，observe_since 会忽略"""
+        if not self.enabled or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return 0.0
+        return time.perf_counter()
+
+    def observe_since(self, name: str, started: float, **labels):
+        """记录从 clock() 到现在的耗时（秒）"""
+        if started:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def observe(self, name: str, value: float, **labels):
+        """向直方图记录一个值"""
+        if not self.enabled:
+            return
+        series = self.histograms.setdefault(name, {})
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(len(self.BUCKETS))
+        histogram.counts[bisect.bisect_left(self.BUCKETS, value)] += 1  # 超过最大上界的落在最后一格，只计入 +Inf
+        histogram.sum += value
+        histogram.count += 1
+
+    def register(self, name: str, reader, kind: str = "gauge"):
+        """登记一个导出时才读取的数值（队列深度、组件自带的计数等），kind 为 gauge 或 counter"""
+        self.readers[name] = (kind, reader)
+
+    @staticmethod
+    def _labels(key: Tuple, extra: Tuple = ()) -> str:
+        parts = []
+        for name, value in key + extra:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{name}="{value}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        """导出为Prometheus文本格式"""
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{self._labels(key)} {value}" for key, value in series.items())
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(key, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(key, (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(key)} {histogram.count}")
+        for name, (kind, reader) in sorted(self.readers.items()):
+            try:
+                value = reader()
+            except Exception as e:
+                logger.debug("读取指标 %s 失败: %s", name, e)
+                continue
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class MetricsServer:
+    """本机HTTP接口，GET /metrics 返回Prometheus文本格式的指标"""
+
+    def __init__(self, registry: Metrics, host: str = METRICS_HOST, port: Optional[int] = METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        if self.port is None or self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"📈 指标接口已开启: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+
+class MessageEvent:
+    """消息事件中处理逻辑用到的字段"""
+
+    __slots__ = ("message_type", "group_id", "user_id", "message_id", "raw_message", "sender_role",
+                 "has_role", "message", "self_id", "time", "parsed")
+
+    def __init__(self, message_type: Optional[str], group_id: Optional[int], user_id: Optional[int],
+                 message_id: Optional[int], raw_message: str, sender_role: str = "member",
+                 has_role: bool = False, message=None, self_id: Optional[int] = None, time: int = 0):
+        self.message_type = message_type
+        self.group_id = group_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.raw_message = raw_message
+        self.sender_role = sender_role
+        self.has_role = has_role  # 事件里是否真的带了sender.role
+        self.message = message  # 原始消息段（数组或字符串）
+        self.self_id = self_id
+        self.time = time
+        self.parsed: Optional["ParsedMessage"] = None  # 审核时才切分，见 ModerationPipeline.parse
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "MessageEvent":
+        sender = data.get("sender") or {}
+        return cls(
+            message_type=data.get("message_type"),
+            group_id=data.get("group_id"),
+            user_id=data.get("user_id"),
+            message_id=data.get("message_id"),
+            raw_message=data.get("raw_message") or "",
+            sender_role=sender.get("role", "member"),
+            has_role="role" in sender,
+            message=data.get("message"),
+            self_id=data.get("self_id"),
+            time=data.get("time", 0),
+        )
+
+
+class ParsedMessage:
+    """消息的一次性切分结果：去掉CQ码后的纯文字、图片、表情、回复的消息ID
+
+    raw_message 用一个不回溯的正则 split 一遍切成 [文字, 类型, 参数, 文字, ...]，每个CQ码只扫描一次；
+    Napcat 发来消息段数组时直接按段处理。图片和表情的参数在第一次访问时才解析。
+    违禁词和广告规则只在 text 上匹配，不会命中CQ码里的参数。
+    """
+
+    __slots__ = ("text", "reply", "_images", "_faces", "_raw")
+
+    CQ_CODE = re.compile(r"\[CQ:([^,\]]*)(?:,([^\]]*))?\]")
+    STICKER_SUMMARY = "[动画表情]"
+    CQ_UNESCAPE = (("&#44;", ","), ("&#91;", "["), ("&#93;", "]"), ("&amp;", "&"))
+
+    def __init__(self, text: str, images: List, faces: List, raw: bool, reply: Optional[str] = None):
+        self.text = text  # 合并空白后的纯文字
+        self.reply = reply  # 回复的消息ID
+        self._images = images
+        self._faces = faces
+        self._raw = raw  # 图片/表情是否还是未解析的CQ码参数
+
+    @classmethod
+    def unescape(cls, value: str) -> str:
+        if "&" not in value:
+            return value
+        for escaped, char in cls.CQ_UNESCAPE:
+            value = value.replace(escaped, char)
+        return value
+
+    @classmethod
+    def params(cls, params: Optional[str]) -> Dict[str, str]:
+        """解析CQ码参数 "k1=v1,k2=v2" """
+        data = {}
+        if params:
+            for param in params.split(","):
+                key, _, value = param.partition("=")
+                data[key] = cls.unescape(value)
+        return data
+
+    @property
+    def images(self) -> List[Dict[str, str]]:
+        """图片消息段的参数（file、url、sub_type、summary 等）"""
+        if self._raw:
+            self._parse_raw()
+        return self._images
+
+    @property
+    def faces(self) -> List[str]:
+        """表情ID（face 的 id，商城表情为 emoji_id）"""
+        if self._raw:
+            self._parse_raw()
+        return self._faces
+
+    def _parse_raw(self):
+        self._images = [self.params(params) for params in self._images]
+        self._faces = [data.get("id") or data.get("emoji_id", "") for data in map(self.params, self._faces)]
+        self._raw = False
+
+    @classmethod
+    def parse(cls, raw_message: str, message=None) -> "ParsedMessage":
+        """优先使用消息段数组，没有时解析 raw_message"""
+        if isinstance(message, list):
+            return cls.from_segments(message)
+        return cls.from_raw(raw_message)
+
+    @classmethod
+    def from_raw(cls, raw_message: str) -> "ParsedMessage":
+        if "[CQ:" not in raw_message:
+            return cls(" ".join(cls.unescape(raw_message).split()), [], [], False)
+        parts = cls.CQ_CODE.split(raw_message)
+        text = " ".join(cls.unescape("".join(parts[::3])).split())
+        images, faces = [], []
+        reply = None
+        for index in range(1, len(parts), 3):
+            kind = parts[index]
+            if kind == "image":
+                images.append(parts[index + 1])
+            elif kind == "face" or kind == "mface":
+                faces.append(parts[index + 1])
+            elif kind == "reply" and reply is None:
+                reply = cls.params(parts[index + 1]).get("id")
+        return cls(text, images, faces, True, reply)
+
+    @classmethod
+    def from_segments(cls, message: List[Dict]) -> "ParsedMessage":
+        texts, images, faces = [], [], []
+        reply = None
+        for segment in message:
+            kind = segment.get("type")
+            data = segment.get("data") or {}
+            if kind == "text":
+                texts.append(data.get("text") or "")
+            elif kind == "image":
+                data = {key: str(value) for key, value in data.items()}
+                images.append(data)
+            elif kind == "face" or kind == "mface":
+                faces.append(str(data.get("id") or data.get("emoji_id", "")))
+            elif kind == "reply" and reply is None:
+                reply = str(data.get("id", "")) or None
+        text = " ".join("".join(texts).split())
+        return cls(text, images, faces, False, reply)
+
+    @classmethod
+    def is_sticker(cls, data: Dict[str, str]) -> bool:
+        """动画表情（收藏的表情包）以图片形式发送，sub_type 为1或摘要为“[动画表情]”"""
+        return (data.get("sub_type") or data.get("subType")) == "1" or data.get("summary") == cls.STICKER_SUMMARY
+
+
+class EventCodec:
+    """WebSocket帧解码：完整解析前先用廉价的文本检查丢弃不需要的帧
+
+    心跳等元事件、请求事件，以及所有group_id都不在启用列表里的消息/通知，不做JSON解析直接丢弃。
+    带echo的API响应总是完整解析。
+    """
+
+    # 用 str.find 定位键名，再在该位置锚定匹配值，比整帧正则搜索快
+    STRING_VALUE = re.compile(r'\s*:\s*"(\w+)"')
+    NUMBER_VALUE = re.compile(r'\s*:\s*(\d+)')
+    WANTED_POST_TYPES = frozenset({"message", "notice"})
+
+    def __init__(self, enabled_groups: Set[int]):
+        self.enabled_groups = enabled_groups
+        self.decoded = 0  # 完整解析的帧数
+        self.filtered = 0  # 预过滤丢弃的帧数
+
+    def decode(self, frame) -> Optional[Dict]:
+        """返回解析后的帧，预过滤丢弃时返回None"""
+        text = frame.decode("utf-8") if isinstance(frame, (bytes, bytearray)) else frame
+        if self.skip(text):
+            return None
+        self.decoded += 1
+        return json_loads(text)
+
+    def skip(self, text: str) -> bool:
+        """不需要的帧返回True（并计数），不做JSON解析"""
+        if '"echo"' in text:
+            return False
+        position = text.rfind('"post_type"')
+        match = self.STRING_VALUE.match(text, position + 11) if position >= 0 else None
+        if match is not None and (match.group(1) not in self.WANTED_POST_TYPES or not self._may_be_enabled(text)):
+            self.filtered += 1
+            return True
+        return False
+
+    def shard_key(self, text: str) -> int:
+        """多进程分片用的键：帧中第一个启用群的group_id，没有时用user_id"""
+        position = text.find('"group_id"')
+        while position >= 0:
+            match = self.NUMBER_VALUE.match(text, position + 10)
+            if match is not None and int(match.group(1)) in self.enabled_groups:
+                return int(match.group(1))
+            position = text.find('"group_id"', position + 10)
+        position = text.find('"user_id"')
+        match = self.NUMBER_VALUE.match(text, position + 9) if position >= 0 else None
+        return int(match.group(1)) if match is not None else 0
+
+    def _may_be_enabled(self, text: str) -> bool:
+        """帧中任意一个group_id属于启用的群（或根本没有group_id）时返回True"""
+        found = False
+        position = text.find('"group_id"')
+        while position >= 0:
+            match = self.NUMBER_VALUE.match(text, position + 10)
+            if match is not None:
+                if int(match.group(1)) in self.enabled_groups:
+                    return True
+                found = True
+            position = text.find('"group_id"', position + 10)
+        return not found
+
+
+class OneBotActionClient:
+    """OneBot动作客户端：为每个请求分配唯一echo，多个请求可同时在途
+
+    连接上只有一个读取者（NapcatConnection._read_loop），读到带echo的响应时
+    交给 feed() 唤醒对应的调用方，其余帧作为事件继续分发。
+    """
+
+    def __init__(self, timeout: float = ACTION_TIMEOUT, echo_prefix: str = "act"):
+        self.websocket: Optional[websockets.WebSocketClientProtocol] = None
+        self.timeout = timeout
+        self.echo_prefix = echo_prefix  # 多个连接时用来区分响应属于哪个连接
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._seq = itertools.count(1)
+
+    def attach(self, websocket):
+        """绑定新连接（重连后调用）"""
+        self.websocket = websocket
+
+    @property
+    def in_flight(self) -> int:
+        """当前等待响应的请求数"""
+        return len(self._pending)
+
+    async def call(self, payload: Dict) -> Dict:
+        """发送请求并等待echo匹配的响应"""
+        if not self.websocket:
+            raise ConnectionError("WebSocket连接未建立")
+
+        action = payload.get("action")
+        echo = f"{self.echo_prefix}-{next(self._seq)}"
+        future = asyncio.get_running_loop().create_future()
+        self._pending[echo] = future
+        started = metrics.clock()
+        try:
+            await self.websocket.send(json_dumps({**payload, "echo": echo}))
+            response = await asyncio.wait_for(future, timeout=self.timeout)
+            metrics.inc("bot_actions_total", action=action, result=response.get("status", "ok"))
+            return response
+        except asyncio.TimeoutError:
+            metrics.inc("bot_actions_total", action=action, result="timeout")
+            raise TimeoutError(f"API请求超时: {action}")
+        except Exception:
+            metrics.inc("bot_actions_total", action=action, result="error")
+            raise
+        finally:
+            metrics.observe_since("bot_action_rtt_seconds", started, action=action)
+            self._pending.pop(echo, None)
+
+    def feed(self, data: Dict) -> bool:
+        """尝试把收到的帧作为API响应交付，是响应则返回True"""
+        echo = data.get("echo")
+        if echo is None:
+            return False
+        future = self._pending.get(echo)
+        if future is not None and not future.done():
+            future.set_result(data)
+        return True
+
+    def fail_all(self, exc: Exception):
+        """连接断开时让所有在途请求立即失败，避免调用方等到超时"""
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self._pending.clear()
+
+class NapcatConnection:
+    """一个Napcat账号的WebSocket连接：自己的读取任务和动作客户端，断开后自动重连
+
+    连接后查询登录的账号以及它在各群的角色，供连接池选择有管理权限的账号。
+    """
+
+    def __init__(self, index: int, name: str, url: str, token: str):
+        self.index = index
+        self.name = name
+        self.url = url
+        self.token = token
+        self.on_frame = None  # (原始帧, 连接) -> None，由连接池启动时设置
+        self.on_ready = None  # (连接) -> None，每次连接就绪后调用
+        self.actions = OneBotActionClient(echo_prefix=f"c{index}")
+        self.websocket: Optional[websockets.WebSocketClientProtocol] = None
+        self.self_id: Optional[int] = None
+        self.roles: Dict[int, str] = {}  # 群号: 本账号在该群的角色（只含确认在群里的群）
+        self.ready = False  # 已连接并完成订阅
+        self.latency: Optional[float] = None  # 最近一次健康检查的往返时间（秒）
+        self.connects = 0  # 累计成功连接次数
+        self.failures = 0  # 连续失败的连接次数，决定下一次重连前的等待
+        self.task = None
+
+    @property
+    def in_flight(self) -> int:
+        return self.actions.in_flight
+
+    def is_admin(self, group_id: Optional[int]) -> bool:
+        return self.roles.get(group_id) in ("owner", "admin")
+
+    def reconnect_delay(self) -> float:
+        """指数退避：等待时间随连续失败次数翻倍，再随机缩短至多一半，避免多个连接同时重连"""
+        delay = min(RECONNECT_DELAY_MAX, RECONNECT_DELAY_MIN * 2 ** min(self.failures, 16))
+        return random.uniform(delay / 2, delay)
+
+    async def run(self):
+        """保持连接，断开或连接失败后按指数退避重连"""
+        while True:
+            reader = None
+            connected_at = None
+            try:
+                self.websocket = await websockets.connect(
+                    self.url,
+                    **{WS_HEADERS_ARG: {"Authorization": f"Bearer {self.token}"}},
+                    ping_interval=30,
+                    ping_timeout=30,
+                    close_timeout=10
+                )
+                self.actions.attach(self.websocket)
+                # 先启动读取任务，之后的API请求才能收到响应
+                reader = asyncio.create_task(self._read_loop())
+                await self.actions.call({
+                    "action": "set_websocket_event",
+                    "params": {"message": True, "notice": True, "request": True}
+                })
+                await self._identify()
+                self.ready = True
+                self.connects += 1
+                connected_at = time.monotonic()
+                logger.info(f"✅ WebSocket连接成功: {self.name}（账号 {self.self_id}）")
+                if self.on_ready is not None:
+                    self.on_ready(self)
+                await reader
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ 连接 {self.name} 失败: {str(e)}")
+            finally:
+                self.ready = False
+                self.actions.attach(None)
+                if reader is not None:
+                    reader.cancel()
+                if self.websocket is not None:
+                    await self.websocket.close()
+                    self.websocket = None
+            if connected_at is not None and time.monotonic() - connected_at >= RECONNECT_STABLE_AFTER:
+                self.failures = 0
+            delay = self.reconnect_delay()
+            self.failures += 1
+            if connected_at is not None:
+                logger.warning(f"⚠️ 连接 {self.name} 断开，{delay:.1f}秒后尝试重连...")
+            else:
+                logger.info(f"连接 {self.name} 第{self.failures}次重连失败，{delay:.1f}秒后再试")
+            await asyncio.sleep(delay)
+
+    async def _read_loop(self):
+        """连接唯一的读取者，每一帧交给 on_frame"""
+        try:
+            async for message in self.websocket:
+                try:
+                    self.on_frame(message, self)
+                except json.JSONDecodeError:
+                    logger.error(f"无法解析的消息: {message}")
+                except Exception as e:
+                    logger.error(f"处理消息时出错: {str(e)}")
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self.ready = False
+            self.actions.fail_all(ConnectionError(f"WebSocket连接已断开: {self.name}"))
+
+    async def _identify(self):
+        """查询登录账号及其在启用群和管理群里的角色，查询失败不影响连接"""
+        try:
+            response = await self.actions.call({"action": "get_login_info"})
+            self.self_id = (response.get("data") or {}).get("user_id")
+        except (TimeoutError, ConnectionError) as e:
+            logger.warning(f"连接 {self.name} 查询登录账号失败: {str(e)}")
+            return
+        self.roles = {}
+        if self.self_id is None:
+            return
+        groups = sorted(ENABLED_GROUPS | {ADMIN_GROUP_ID})
+        responses = await asyncio.gather(*(
+            self.actions.call({
+                "action": "get_group_member_info",
+                "params": {"group_id": group_id, "user_id": self.self_id, "no_cache": True}
+            }) for group_id in groups
+        ), return_exceptions=True)
+        for group_id, response in zip(groups, responses):
+            if isinstance(response, dict) and response.get("status") == "ok":
+                self.roles[group_id] = (response.get("data") or {}).get("role", "member")
+
+    async def check_health(self) -> bool:
+        """用 get_status 检查连接和账号状态，失败时断开连接让 run() 重连"""
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self.actions.call({"action": "get_status"}),
+                                              timeout=CONNECTION_HEALTH_TIMEOUT)
+        except Exception as e:
+            reason = str(e) or "超时"
+        else:
+            if (response.get("data") or {}).get("online", True) is not False:
+                self.latency = time.perf_counter() - started
+                return True
+            reason = "账号不在线"
+        logger.warning(f"连接 {self.name} 健康检查失败（{reason}），重新连接")
+        self.ready = False
+        if self.websocket is not None:
+            await self.websocket.close()
+        return False
+
+
+class EventDeduplicator:
+    """多个账号在同一个群里会各收到一份相同的事件，在一段时间内只放行第一份
+
+    各账号收到的同一事件 message_id 和 self_id 不同。群消息优先按群内消息序号（real_seq /
+    message_seq，所有成员看到的相同）判断；没有序号时按发送者、时间和内容判断，这时同一个人
+    在同一秒里发出完全相同的两条消息会被当成一条。
+    """
+
+    def __init__(self, ttl: float = EVENT_DEDUP_TTL, max_size: int = EVENT_DEDUP_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen: "OrderedDict[int, float]" = OrderedDict()  # 内容键的哈希: 首次出现时间
+        self.duplicates = 0
+
+    @staticmethod
+    def key(event: Dict) -> Optional[int]:
+        """群事件的内容键；私聊等只会由一个账号收到的事件返回None"""
+        group_id = event.get("group_id")
+        if group_id is None:
+            return None
+        post_type = event.get("post_type")
+        if post_type == "message":
+            seq = event.get("real_seq") or event.get("message_seq")
+            if seq:
+                return hash((post_type, group_id, str(seq)))
+            return hash((post_type, group_id, event.get("user_id"), event.get("time"), event.get("raw_message")))
+        return hash((post_type, event.get("notice_type") or event.get("request_type"), event.get("sub_type"),
+                     group_id, event.get("user_id"), event.get("operator_id"), event.get("flag"), event.get("time")))
+
+    def first(self, event: Dict, now: Optional[float] = None) -> bool:
+        """第一次见到返回True，重复返回False"""
+        key = self.key(event)
+        if key is None:
+            return True
+        now = time.monotonic() if now is None else now
+        seen = self._seen
+        while seen and (len(seen) >= self.max_size or next(iter(seen.values())) < now - self.ttl):
+            seen.popitem(last=False)
+        if key in seen:
+            self.duplicates += 1
+            return False
+        seen[key] = now
+        return True
+
+
+class ConnectionPool:
+    """多账号连接池，对外与 OneBotActionClient 接口相同
+
+    撤回交给收到该消息的账号；带群号的动作优先交给在该群的账号，禁言、踢人、撤回再优先
+    群主/管理员，条件相同的按在途请求数轮流分摊。连接断开时在途请求立即失败并改由下一个
+    账号重发，不必等到超时；超时的请求不重发（可能已经执行）。
+
+    所有账号都不可用时，撤回、禁言、踢人暂存在待发队列里（同一目标的同一动作只保留最新的
+    一个），调用方立即得到 status 为 queued 的响应；任一连接恢复后经 resubmit 重新排队发送。
+    """
+
+    ADMIN_ACTIONS = frozenset({"set_group_ban", "set_group_kick", "delete_msg"})
+    OUTBOX_ACTIONS = ADMIN_ACTIONS
+
+    def __init__(self, endpoints: Optional[List[Dict]] = None):
+        endpoints = endpoints or WS_ENDPOINTS or [{"name": "默认", "url": WS_URL, "token": ACCESS_TOKEN}]
+        self.connections = [
+            NapcatConnection(index, endpoint.get("name") or endpoint["url"], endpoint["url"], endpoint.get("token", ""))
+            for index, endpoint in enumerate(endpoints)
+        ]
+        self._by_prefix = {connection.actions.echo_prefix: connection for connection in self.connections}
+        self.dedup = EventDeduplicator()
+        self._message_owner: "OrderedDict[int, NapcatConnection]" = OrderedDict()  # 消息ID: 收到它的连接
+        self._rotation = itertools.count()
+        self.failovers = 0  # 改由其它账号重发的次数
+        self.outbox: "OrderedDict[Tuple, Tuple[float, Dict]]" = OrderedDict()  # 去重键: (暂存时间, 请求)
+        self.outbox_dropped = 0  # 超出上限或过期而丢弃的暂存动作数
+        self.replayed = 0  # 恢复连接后重发成功的动作数
+        self.resubmit = self.call  # 重发暂存动作的入口，通常是发送调度器
+        self.health_task = None
+
+    def __len__(self):
+        return len(self.connections)
+
+    @property
+    def deduplicating(self) -> bool:
+        """多于一个账号时事件需要去重"""
+        return len(self.connections) > 1
+
+    @property
+    def ready(self) -> int:
+        """已就绪的连接数"""
+        return sum(connection.ready for connection in self.connections)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(connection.in_flight for connection in self.connections)
+
+    @property
+    def reconnects(self) -> int:
+        """累计重连次数（不含每个连接的第一次连接）"""
+        return sum(max(0, connection.connects - 1) for connection in self.connections)
+
+    def start(self, on_frame, resubmit=None):
+        """启动所有连接，on_frame(原始帧, 连接) 处理读到的每一帧，resubmit(请求) 重发暂存的动作"""
+        if resubmit is not None:
+            self.resubmit = resubmit
+        for connection in self.connections:
+            if connection.task is None:
+                connection.on_frame = on_frame
+                connection.on_ready = self._on_ready
+                connection.task = asyncio.create_task(connection.run())
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        tasks = [connection.task for connection in self.connections if connection.task is not None]
+        if self.health_task is not None:
+            tasks.append(self.health_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for connection in self.connections:
+            connection.task = None
+        self.health_task = None
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(CONNECTION_HEALTH_INTERVAL)
+            await asyncio.gather(*(connection.check_health() for connection in self.connections if connection.ready))
+
+    def _candidates(self, payload: Dict) -> List[NapcatConnection]:
+        """按优先顺序排列可用的连接"""
+        live = [connection for connection in self.connections if connection.ready]
+        if len(live) <= 1:
+            return live
+        action = payload.get("action")
+        params = payload.get("params") or {}
+        owner = self._message_owner.get(params.get("message_id")) if action == "delete_msg" else None
+        group_id = params.get("group_id")
+        admin_group = group_id if action in self.ADMIN_ACTIONS else None
+        offset = next(self._rotation)
+        count = len(self.connections)
+        live.sort(key=lambda connection: (
+            connection is not owner,
+            group_id is not None and group_id not in connection.roles,
+            admin_group is not None and not connection.is_admin(admin_group),
+            connection.in_flight,
+            (connection.index - offset) % count,
+        ))
+        return live
+
+    async def call(self, payload: Dict) -> Dict:
+        """选择账号发送请求，连接断开时改由下一个账号发送，都不可用时暂存处罚动作"""
+        candidates = self._candidates(payload)
+        try:
+            if not candidates:
+                raise ConnectionError("WebSocket连接未建立")
+            for attempt, connection in enumerate(candidates):
+                try:
+                    return await connection.actions.call(payload)
+                except (ConnectionError, websockets.exceptions.ConnectionClosed) as e:
+                    if attempt + 1 == len(candidates):
+                        raise
+                    self.failovers += 1
+                    logger.warning(f"连接 {connection.name} 不可用（{str(e)}），"
+                                   f"{payload.get('action')} 改由 {candidates[attempt + 1].name} 发送")
+        except (ConnectionError, websockets.exceptions.ConnectionClosed) as e:
+            if payload.get("action") not in self.OUTBOX_ACTIONS:
+                raise
+            self._park(payload)
+            logger.warning(f"{payload.get('action')} 暂存到待发队列，连接恢复后重发（{str(e)}）")
+            return {"status": "queued", "retcode": 0, "data": None, "message": "连接恢复后重发"}
+
+    @staticmethod
+    def _outbox_key(payload: Dict) -> Tuple:
+        """同一条消息的撤回、同一群同一用户的同一动作只需发一次（禁言以最新的时长为准）"""
+        params = payload.get("params") or {}
+        if payload.get("action") == "delete_msg":
+            return ("delete_msg", params.get("message_id"))
+        return (payload.get("action"), params.get("group_id"), params.get("user_id"))
+
+    def _park(self, payload: Dict):
+        key = self._outbox_key(payload)
+        self.outbox.pop(key, None)
+        self.outbox[key] = (time.monotonic(), payload)
+        while len(self.outbox) > OUTBOX_SIZE:
+            self.outbox.popitem(last=False)
+            self.outbox_dropped += 1
+
+    def _on_ready(self, connection: NapcatConnection):
+        """任一连接就绪后重发暂存的动作"""
+        if not self.outbox:
+            return
+        now = time.monotonic()
+        payloads = [payload for queued, payload in self.outbox.values() if now - queued <= OUTBOX_TTL]
+        expired = len(self.outbox) - len(payloads)
+        self.outbox.clear()
+        self.outbox_dropped += expired
+        logger.info(f"连接 {connection.name} 已恢复，重发暂存的 {len(payloads)} 个动作"
+                    + (f"（{expired} 个已过期，不再发送）" if expired else ""))
+        for payload in payloads:
+            asyncio.ensure_future(self.resubmit(payload)).add_done_callback(self._replay_done)
+
+    def _replay_done(self, future: asyncio.Future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.error(f"重发暂存动作失败: {str(future.exception())}")
+        elif (future.result() or {}).get("status") == "ok":
+            self.replayed += 1
+
+    def feed(self, data: Dict) -> bool:
+        """把响应交给发出该请求的连接，是响应则返回True"""
+        echo = data.get("echo")
+        if echo is None:
+            return False
+        connection = self._by_prefix.get(str(echo).partition("-")[0])
+        if connection is not None:
+            connection.actions.feed(data)
+        return True
+
+    def fail_all(self, exc: Exception):
+        for connection in self.connections:
+            connection.actions.fail_all(exc)
+
+    def accept(self, connection: NapcatConnection, event: Dict) -> bool:
+        """登记事件来源并去重，重复的事件返回False"""
+        if event.get("post_type") == "notice":
+            self._track_role(event)
+        if not self.deduplicating:
+            return True
+        if not self.dedup.first(event):
+            return False
+        message_id = event.get("message_id")
+        if message_id is not None and event.get("post_type") == "message":
+            self._message_owner[message_id] = connection
+            if len(self._message_owner) > EVENT_DEDUP_SIZE:
+                self._message_owner.popitem(last=False)
+        return True
+
+    def _track_role(self, event: Dict):
+        """本账号被设为/取消管理员、入群或被移出群时更新角色"""
+        notice_type = event.get("notice_type")
+        if notice_type not in ("group_admin", "group_increase", "group_decrease"):
+            return
+        group_id = event.get("group_id")
+        for connection in self.connections:
+            if connection.self_id is None or event.get("user_id") != connection.self_id:
+                continue
+            if notice_type == "group_admin":
+                connection.roles[group_id] = "admin" if event.get("sub_type") == "set" else "member"
+            elif notice_type == "group_increase":
+                connection.roles[group_id] = "member"
+            else:
+                connection.roles.pop(group_id, None)
+
+
+class TextNormalizer:
+    """违禁词匹配前的文字归一化，对付全角、大小写、插空格/标点、繁体和形近字绕过
+
+    一次 NFKC（全角转半角、兼容字符拆解）+ casefold + 预先算好的 str.maketrans 表（分隔符统一为空格，断句标点统一为换行，
+    繁体与形近字映射成简体/拉丁字母），再处理分隔符：空格和符号两侧都是单独的字符（"k u k e"、"加 群"，句子里的
+    "来玩k u k e服务器"）时去掉，其余保留一个空格，避免 "new xbox" 拼出 "wx"、"好酷 可以" 拼出 "酷可"；
+    断句标点两侧从不拼接（"这个好酷，可以教我吗"）。结果按原文缓存在有界LRU里。
+    """
+
+    # 繁体 -> 简体（违禁词、广告常用字为主，可用 NORMALIZE_EXTRA_MAP 补充）
+    TRADITIONAL = (
+        "腦脑殘残媽妈賣卖買买號号碼码費费領领幫帮組组紅红錢钱網网頁页鏈链連连載载點点擊击進进來来這这個个們们"
+        "說说話话會会時时國国對对開开關关電电視视動动務务為为與与學学長长門门問问間间題题發发現现從从經经過过"
+        "還还讓让給给請请謝谢愛爱歡欢樂乐遊游戲戏機机體体應应該该當当後后單单實实無无麼么樣样認认識识處处報报"
+        "紙纸價价優优獎奖禮礼贈赠贏赢輸输賺赚兌兑換换訊讯資资圖图觀观邊边達达運运轉转線线絡络聯联繫系夥伙團团"
+        "隊队員员種种婦妇亂乱黃黄賭赌劇剧場场殺杀滅灭槍枪醫医藥药錯错鬥斗罵骂豬猪雞鸡麥麦帶带幣币衛卫廣广區区"
+        "貨货購购車车馬马騙骗詐诈違违規规際际灣湾臺台華华維维齊齐衝冲陸陆奧奥習习總总統统鬧闹議议選选舉举權权"
+        "義义軍军戰战爭争彈弹藝艺術术勝胜臉脸腳脚髮发頭头貓猫魚鱼鳥鸟龍龙韓韩歐欧聖圣羅罗蘭兰亞亚邏逻輯辑瘋疯"
+        "癡痴兒儿孫孙親亲屬属滾滚鍋锅熱热門门員员紀纪錄录視视頻频聽听讀读寫写筆笔記记號号銷销羣群衆众萬万億亿"
+        "務务證证驗验碼码雙双隻只勁劲爾尔麗丽飛飞體体號号"
+    )
+    # 形近字母（casefold 之后）：西里尔、希腊字母 -> 拉丁字母
+    HOMOGLYPHS = ("аa", "вb", "еe", "ёe", "іi", "їi", "јj", "кk", "мm", "нh", "оo", "рp", "сc", "тt", "уy", "хx",
+                  "ѕs", "ԁd", "ԛq", "ԝw", "ɡg", "ıi", "αa", "βb", "εe", "ιi", "κk", "νv", "οo", "ρp", "τt", "υu",
+                  "χx", "ωw")
+    # 当作分隔符的 Unicode 类别：空白、标点、符号、控制/格式（零宽字符）、组合附加符（删除线等）
+    SEPARATOR_CATEGORIES = frozenset({"Zs", "Zl", "Zp", "Pc", "Pd", "Ps", "Pe", "Pi", "Pf", "Po",
+                                      "Sm", "Sc", "Sk", "So", "Cc", "Cf", "Mn", "Me"})
+    # 断句标点与换行（NFKC 之后，全角逗号、问号等已变成半角）：两侧的片段从不拼接
+    CLAUSE_BREAKS = ",!?;:。、\n\r\u2028\u2029"
+    TOKEN = re.compile(r"[^\s-]+")  # 翻译后按空白和连字符切出的片段
+
+    _table: Optional[Dict[int, str]] = None
+
+    def __init__(self, cache_size: int = NORMALIZE_CACHE_SIZE, extra_map: Optional[Dict[str, str]] = None):
+        self.cache_size = cache_size
+        self.table = self.build_table(extra_map or {})
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def build_table(cls, extra_map: Dict[str, str]) -> Dict[int, str]:
+        """构建翻译表（基本多文种平面和emoji区的分隔符只需扫描一次，所有实例共用）"""
+        if cls._table is None:
+            table = {code: " " for code in itertools.chain(range(0x10000), range(0x1F000, 0x1FB00))
+                     if unicodedata.category(chr(code)) in cls.SEPARATOR_CATEGORIES}
+            pairs = cls.TRADITIONAL
+            table.update((ord(pairs[i]), pairs[i + 1]) for i in range(0, len(pairs), 2) if pairs[i] != pairs[i + 1])
+            table.update((ord(source), target) for source, target in cls.HOMOGLYPHS)
+            table.update((ord(char), "\n") for char in cls.CLAUSE_BREAKS)
+            del table[ord("-")]  # 连字符由 _pieces 处理
+            cls._table = table
+        if not extra_map:
+            return cls._table
+        table = dict(cls._table)
+        table.update((ord(source), target) for source, target in extra_map.items())
+        return table
+
+    @staticmethod
+    def _single(token: str, index: int, neighbour: int) -> bool:
+        """token[index] 是否单独一个字符：片段只有它，或紧挨着的是另一类字符（汉字/非汉字），如 "来玩k" 末尾的 k"""
+        return len(token) == 1 or (token[neighbour] >= "⺀") != (token[index] >= "⺀")
+
+    @classmethod
+    def _glue(cls, previous: str, token: str) -> bool:
+        """空格、符号隔开的两个片段是否拼起来：只看分隔符两侧的字符，两侧都是单独的字符时才去掉分隔符
+
+        "k u k e"、"加 群"、句子里的 "来玩k u k e服务器" 会拼起来；"好酷 可以"、"new xbox" 两侧至少有一边
+        是连续的多个字，保持分开。
+        """
+        return cls._single(previous, -1, -2) and cls._single(token, 0, 1)
+
+    def _pieces(self, folded: str) -> List[Tuple[int, int, str]]:
+        """把翻译后的文字切成片段 [(起, 止, 前面的连接)]，连接为 ""（去掉分隔符）、" " 或 "-"
+
+        断句标点（逗号、句号、问号等）两侧从不拼接；只隔着 "-" 的两个非汉字片段（"vx-7" 这样的型号）保留连字符。
+        """
+        pieces: List[Tuple[int, int, str]] = []
+        previous, previous_end = "", -1
+        for match in self.TOKEN.finditer(folded):
+            token = match.group()
+            start, end = match.span()
+            if previous_end < 0:
+                joint = ""
+            else:
+                gap = folded[previous_end:start]
+                if "\n" in gap:
+                    joint = " "
+                elif self._glue(previous, token):
+                    joint = ""
+                elif not gap.strip("-") and previous[-1] < "⺀" and token[0] < "⺀":
+                    joint = "-"
+                else:
+                    joint = " "
+            pieces.append((start, end, joint))
+            previous, previous_end = token, end
+        return pieces
+
+    def normalize(self, text: str) -> str:
+        cache = self._cache
+        normalized = cache.get(text)
+        if normalized is not None:
+            cache.move_to_end(text)
+            self.hits += 1
+            return normalized
+        self.misses += 1
+        folded = unicodedata.normalize("NFKC", text).casefold().translate(self.table)
+        normalized = "".join(joint + folded[start:end] for start, end, joint in self._pieces(folded))
+        cache[text] = normalized
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return normalized
+
+    def normalize_with_offsets(self, text: str) -> Tuple[str, List[int]]:
+        """逐字符归一化，同时给出每个结果字符对应的原文下标（只在命中后记录日志时使用）"""
+        chars: List[str] = []
+        offsets: List[int] = []
+        for index, char in enumerate(text):
+            for folded in unicodedata.normalize("NFKC", char).casefold().translate(self.table):
+                chars.append(folded)
+                offsets.append(index)
+        folded = "".join(chars)
+        parts: List[str] = []
+        mapping: List[int] = []
+        for start, end, joint in self._pieces(folded):
+            if joint:
+                parts.append(joint)
+                mapping.append(mapping[-1])
+            parts.append(folded[start:end])
+            mapping.extend(offsets[start:end])
+        return "".join(parts), mapping
+
+    def locate(self, text: str, pattern: str) -> Optional[Tuple[int, int]]:
+        """命中规则在原文中的位置 (起, 止)，找不到时返回None"""
+        normalized, mapping = self.normalize_with_offsets(text)
+        match = re.search(pattern, normalized)
+        if match is None or match.end() == match.start():
+            return None
+        return mapping[match.start()], mapping[match.end() - 1] + 1
+
+
+class RuleMatcher:
+    """多模式规则匹配器：启动时把所有分级规则编译成一个匹配器，每条消息只扫描一遍
+
+    纯文字规则直接放进 Aho-Corasick 自动机；正则规则取出其中必然出现的字面量作为
+    触发词也放进自动机，只有触发词出现时才运行对应的正则。取不出触发词的正则合并成
+    一个按严重程度排序的前瞻交替正则；其中用到反向引用或命名分组的放进合并正则会改变分组编号或重名，
+    单独编译、每条消息都运行。无法编译的规则记录错误后跳过。整体耗时与规则数量基本无关。
+    """
+
+    REGEX_META = frozenset(".^$*+?{}[]\\|()")
+    GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?P[=<]|\(\?<[^=!]|\(\?\(")  # 反向引用、命名分组、条件分组
+
+    def __init__(self, tiers):
+        """tiers: [(规则类别, 规则集合)]，按严重程度从高到低排列"""
+        self.tier_names = [name for name, _ in tiers]
+        # 自动机：goto[状态] = {字符: 下一状态}；best[状态] = (严重程度下标, 规则)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._best: List[Optional[Tuple[int, str]]] = [None]
+        self._triggers: List[Tuple[int, ...]] = [()]  # 状态对应的待验证正则编号
+        self._anchored: List[Tuple[int, str, re.Pattern]] = []  # (严重程度, 规则, 编译结果)
+        self._standalone: List[Tuple[int, str, re.Pattern]] = []  # 不能合并的无触发词正则，按严重程度排列
+        self._regex_rules: Dict[str, Tuple[int, str]] = {}
+        regex_parts = []
+
+        for severity, (_, patterns) in enumerate(tiers):
+            for pattern in sorted(patterns):
+                if self.REGEX_META.isdisjoint(pattern):
+                    state = self._add_literal(pattern)
+                    current = self._best[state]
+                    if current is None or severity < current[0]:
+                        self._best[state] = (severity, pattern)
+                    continue
+
+                try:
+                    compiled = re.compile(pattern)
+                except re.error as e:
+                    logger.error("规则 %r 不是有效的正则，已跳过: %s", pattern, e)
+                    continue
+                anchor = self._required_literal(pattern)
+                if anchor:
+                    state = self._add_literal(anchor)
+                    self._triggers[state] += (len(self._anchored),)
+                    self._anchored.append((severity, pattern, compiled))
+                elif self.GROUP_REFERENCE.search(pattern):
+                    self._standalone.append((severity, pattern, compiled))
+                else:
+                    group = f"r{len(self._regex_rules)}"
+                    self._regex_rules[group] = (severity, pattern)
+                    regex_parts.append(f"(?P<{group}>{pattern})")
+
+        self._build_fail_links()
+        # 每个位置上按顺序尝试，严重的规则排在前面，所以每个位置报告的都是该处最重的命中
+        try:
+            self._regex = re.compile("(?=" + "|".join(regex_parts) + ")") if regex_parts else None
+        except re.error as e:
+            # 单独能编译、合并后不行（如写在中间的全局标志 (?i)）：全部改为单独运行
+            logger.warning("无触发词的正则无法合并，改为逐条匹配: %s", e)
+            self._standalone = sorted(self._standalone + [(severity, pattern, re.compile(pattern))
+                                                          for severity, pattern in self._regex_rules.values()],
+                                      key=lambda rule: rule[0])
+            self._regex_rules.clear()
+            self._regex = None
+        self._regex_top = min((sev for sev, _ in self._regex_rules.values()), default=len(tiers))
+
+    @classmethod
+    def _required_literal(cls, pattern: str) -> str:
+        """找出正则中任何匹配都必然包含的最长连续字面量，找不到返回空串"""
+        if "(?i" in pattern or "(?x" in pattern:
+            return ""
+        best, run = "", ""
+        depth, i = 0, 0
+        while i < len(pattern):
+            ch = pattern[i]
+            if ch == "\\":
+                best, run = max(best, run, key=len), ""
+                i += 2
+                continue
+            if ch == "[" and depth == 0:
+                best, run = max(best, run, key=len), ""
+                i += 1
+                if i < len(pattern) and pattern[i] == "^":
+                    i += 1
+                if i < len(pattern) and pattern[i] == "]":
+                    i += 1
+                while i < len(pattern) and pattern[i] != "]":
+                    i += 2 if pattern[i] == "\\" else 1
+            elif ch == "(":
+                depth += 1
+                best, run = max(best, run, key=len), ""
+            elif ch == ")":
+                depth -= 1
+            elif ch == "|" and depth == 0:
+                return ""  # 顶层分支：没有哪个字面量是必然出现的
+            elif depth == 0:
+                if ch in "?*{":
+                    # 前一个字符变成可选的
+                    best, run = max(best, run[:-1], key=len), ""
+                    if ch == "{":
+                        while i < len(pattern) and pattern[i] != "}":
+                            i += 1
+                elif ch == "+":
+                    best, run = max(best, run, key=len), ""
+                elif ch in cls.REGEX_META:
+                    best, run = max(best, run, key=len), ""
+                else:
+                    run += ch
+            i += 1
+        return max(best, run, key=len)
+
+    def _add_literal(self, word: str) -> int:
+        """把字面量插入字典树，返回终止状态"""
+        state = 0
+        for ch in word:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._best.append(None)
+                self._triggers.append(())
+            state = nxt
+        return state
+
+    def _build_fail_links(self):
+        """BFS计算失配指针，并把后缀状态的命中与触发合并进来"""
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                inherited = self._best[self._fail[nxt]]
+                if inherited is not None and (self._best[nxt] is None or inherited[0] < self._best[nxt][0]):
+                    self._best[nxt] = inherited
+                self._triggers[nxt] += self._triggers[self._fail[nxt]]
+                queue.append(nxt)
+
+    def match(self, text: str) -> Optional[Tuple[str, str]]:
+        """返回最严重的命中 (规则类别, 规则)，没有命中返回None"""
+        best = None
+        triggered = set()
+        goto, fail, outputs, triggers = self._goto, self._fail, self._best, self._triggers
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            hit = outputs[state]
+            if hit is not None and (best is None or hit[0] < best[0]):
+                best = hit
+                if best[0] == 0:
+                    return self.tier_names[0], best[1]
+            if triggers[state]:
+                triggered.update(triggers[state])
+
+        # 触发词出现过的正则才需要验证，按严重程度从高到低
+        for index in sorted(triggered):
+            severity, pattern, compiled = self._anchored[index]
+            if (best is None or severity < best[0]) and compiled.search(text):
+                best = (severity, pattern)
+        for severity, pattern, compiled in self._standalone:
+            if best is not None and severity >= best[0]:
+                break
+            if compiled.search(text):
+                best = (severity, pattern)
+
+        # 已经命中了不低于任何无触发词正则的级别时，无需再跑合并正则
+        if self._regex is not None and (best is None or best[0] > self._regex_top):
+            for m in self._regex.finditer(text):
+                hit = self._regex_rules[m.lastgroup]
+                if best is None or hit[0] < best[0]:
+                    best = hit
+                    if best[0] == self._regex_top:
+                        break
+
+        if best is None:
+            return None
+        return self.tier_names[best[0]], best[1]
+
+class FloodLimiter:
+    """按 (群, 用户) 统计的滑动窗口刷屏检测
+
+    每个用户只保留固定长度的时间戳环形缓冲区；闲置超过 idle_ttl 的记录由时间轮批量清除，
+    内存只与最近活跃的用户数有关，与历史上出现过多少用户无关。
+    """
+
+    def __init__(self, max_messages: int = FLOOD_MAX_MESSAGES, window: float = FLOOD_WINDOW,
+                 group_rules: Optional[Dict[int, Dict[str, float]]] = None,
+                 idle_ttl: float = FLOOD_IDLE_TTL, slot_seconds: float = 5):
+        self.default_rule = (int(max_messages), float(window))
+        self.group_rules = {
+            group_id: (int(rule.get("messages", max_messages)), float(rule.get("window", window)))
+            for group_id, rule in (group_rules or {}).items()
+        }
+        longest_window = max([window] + [rule[1] for rule in self.group_rules.values()])
+        self.slot_seconds = slot_seconds
+        # 时间轮：每个槽存放在该时间段内最后活跃的键，最老的槽到期时整体清除
+        slot_count = int(max(idle_ttl, longest_window) // slot_seconds) + 2
+        self._wheel: deque = deque(set() for _ in range(slot_count))
+        self._entries: Dict[Tuple[int, int], list] = {}  # 键: [时间戳环形缓冲区, 所在槽号]
+        self._slot = int(time.monotonic() // slot_seconds)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def rule_for(self, group_id: int) -> Tuple[int, float]:
+        """群的 (消息条数, 时间窗口)"""
+        return self.group_rules.get(group_id, self.default_rule)
+
+    def hit(self, group_id: int, user_id: int, now: Optional[float] = None) -> bool:
+        """记录一条消息，窗口内消息数达到上限时返回True并重新计数"""
+        if now is None:
+            now = time.monotonic()
+        self._advance(now)
+
+        key = (group_id, user_id)
+        limit, window = self.rule_for(group_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = [deque(maxlen=limit), self._slot]
+            self._entries[key] = entry
+            self._wheel[-1].add(key)
+        elif entry[1] != self._slot:
+            # 移到当前槽，O(1)
+            self._wheel[entry[1] - self._slot - 1].discard(key)
+            self._wheel[-1].add(key)
+            entry[1] = self._slot
+
+        stamps = entry[0]
+        stamps.append(now)
+        if len(stamps) == limit and now - stamps[0] < window:
+            stamps.clear()  # 已处罚，重新计数，避免同一轮刷屏重复处罚
+            return True
+        return False
+
+    def _advance(self, now: float):
+        """时间轮前进到当前槽，清除落在过期槽里的键"""
+        slot = int(now // self.slot_seconds)
+        steps = min(slot - self._slot, len(self._wheel))
+        for _ in range(steps):
+            for key in self._wheel.popleft():
+                self._entries.pop(key, None)
+            self._wheel.append(set())
+        if slot > self._slot:
+            self._slot = slot
+
+class DuplicateWaveDetector:
+    """跨用户的重复内容检测：多个账号在短时间内发送相同或相近的消息
+
+    每条消息取 MinHash 指纹（字符三元组的哈希值按值分桶，每桶取最小值；相近的文字大部分桶相同），
+    每两个桶合成一个分段键计入所在群的 Count-Min 计数草图。草图按时间分槽，过期的槽从总计数中减去，
+    总计数只反映最近一个窗口。某个分段键的计数达到门槛时，才到该群最近消息的环形缓冲区里
+    逐条比较指纹，找出同一波的所有发送者。
+    每条消息的开销与每个群的内存都有固定上限，与群里的消息量和用户数无关。
+    """
+
+    DEPTH = 3  # 草图行数，每行取分段键哈希值的不同位段作为下标
+    SLOTS = 4  # 每个窗口分成的时间槽数
+    EMPTY = 1 << 63  # 空桶，大于任何哈希值
+
+    def __init__(self, min_users: int = WAVE_MIN_USERS, window: float = WAVE_WINDOW,
+                 min_length: int = WAVE_MIN_LENGTH, similarity: float = WAVE_SIMILARITY,
+                 recent_size: int = WAVE_RECENT_SIZE, width: int = WAVE_SKETCH_WIDTH, hashes: int = 8):
+        self.min_users = min_users
+        self.window = window
+        self.min_length = min_length
+        self.hashes = hashes - hashes % 2  # 桶数，两两组成分段键
+        self.gate = max(2, min_users - 1)  # 分段键计数达到该值才逐条比较（相近而非相同的内容各段计数偏低）
+        self.overlap = max(1, round(similarity * self.hashes))  # 相近内容至少相同的桶数
+        self.recent_size = recent_size
+        self.width = 1 << max(4, (int(width) - 1).bit_length())
+        self.slot_seconds = window / self.SLOTS
+        self._empty = bytes(4 * self.DEPTH * self.width)
+        # 群号: [各时间槽的草图, 总计数草图, 当前槽号, 最近消息环形缓冲区]
+        self._groups: Dict[int, list] = {}
+        self.waves = 0  # 发现的刷屏潮数
+        self.flagged = 0  # 标记为刷屏潮的消息数
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    def fingerprint(self, text: str) -> Tuple[int, List[int]]:
+        """(整条文字的哈希, 各桶的最小值)；text 应已去掉空白"""
+        buckets = self.hashes
+        mins = [self.EMPTY] * buckets
+        for value in {hash(text[i:i + 3]) for i in range(len(text) - 2)} or {hash(text)}:
+            bucket = value % buckets
+            if value < mins[bucket]:
+                mins[bucket] = value
+        return hash(text), mins
+
+    def observe(self, group_id: int, user_id: int, message_id: int, text: str,
+                now: Optional[float] = None) -> List[Tuple[int, int]]:
+        """记录一条消息（text 为归一化后的文字），形成刷屏潮时返回要处理的 [(用户ID, 消息ID)]
+
+        同一波里已经返回过的消息不会再返回，之后跟着发的消息逐条返回。
+        """
+        compact = "".join(text.split())
+        if len(compact) < self.min_length:
+            return []
+        if now is None:
+            now = time.monotonic()
+        state = self._groups.get(group_id)
+        if state is None:
+            state = [deque(array("I", self._empty) for _ in range(self.SLOTS)), array("I", self._empty),
+                     int(now // self.slot_seconds), deque(maxlen=self.recent_size)]
+            self._groups[group_id] = state
+        self._advance(state, now)
+
+        exact, mins = self.fingerprint(compact)
+        current, total, width = state[0][-1], state[1], self.width
+        mask = width - 1
+        highest = 0
+        for band in range(0, self.hashes, 2):
+            if mins[band] == mins[band + 1]:  # 两个桶都空（短消息），不同消息的这一段没有区分度
+                continue
+            key = hash((mins[band], mins[band + 1]))
+            estimate = None
+            for row in range(self.DEPTH):
+                index = row * width + ((key >> (row * 16)) & mask)
+                current[index] += 1
+                count = total[index] + 1
+                total[index] = count
+                if estimate is None or count < estimate:
+                    estimate = count
+            if estimate > highest:
+                highest = estimate
+        entry = [now, user_id, message_id, exact, frozenset(mins) - {self.EMPTY}, False]
+        state[3].append(entry)
+
+        # 计数只会偏大：没有一个分段键到门槛，窗口内就不可能有足够多的人发过相近内容
+        if highest < self.gate:
+            return []
+        return self._collect(state[3], entry, now)
+
+    def _collect(self, recent: deque, entry: list, now: float) -> List[Tuple[int, int]]:
+        """在最近消息里找出与 entry 相同或相近的，不同发送者够多时标记并返回尚未处理的"""
+        cutoff = now - self.window
+        exact, mins = entry[3], entry[4]
+        overlap = min(self.overlap, len(mins))
+        similar = [item for item in recent
+                    if item[0] >= cutoff and (item[3] == exact or len(item[4] & mins) >= overlap)]
+        if len({item[1] for item in similar}) < self.min_users:
+            return []
+        if not any(item[5] for item in similar):
+            self.waves += 1
+        targets = []
+        for item in similar:
+            if not item[5]:
+                item[5] = True
+                targets.append((item[1], item[2]))
+        self.flagged += len(targets)
+        return targets
+
+    def _advance(self, state: list, now: float):
+        """时间槽前进到当前时间，过期槽的计数从总计数中减去"""
+        slot = int(now // self.slot_seconds)
+        steps = slot - state[2]
+        if steps <= 0:
+            return
+        slots = state[0]
+        if steps >= self.SLOTS:
+            state[1] = array("I", self._empty)
+            for _ in range(self.SLOTS):
+                slots.popleft()
+                slots.append(array("I", self._empty))
+        else:
+            for _ in range(steps):
+                state[1] = array("I", map(operator.sub, state[1], slots.popleft()))
+                slots.append(array("I", self._empty))
+        state[2] = slot
+
+class ImageBlocklist:
+    """图片黑名单与每个群最近出现过的图片
+
+    图片按消息段里的 file_unique、file（文件名，通常是内容的MD5）和去掉临时参数的 url 识别，
+    每个标识取64位摘要。加入黑名单时记下一张图片的全部标识，之后任一标识相同即命中；
+    查询只在内存的集合里进行，不发网络请求。每个群另有两个有上限的LRU：最近的图片由哪些用户发送
+    （重复检测），以及最近带图片的消息包含哪些图片（管理员回复消息加黑名单时直接取）。
+    """
+
+    PASSTHROUGH_SCHEMES = ("base64://", "file://")  # 不能作为标识的 file 值
+
+    def __init__(self, recent_size: int = IMAGE_RECENT_SIZE, repeat_users: int = IMAGE_REPEAT_USERS,
+                 repeat_window: float = IMAGE_REPEAT_WINDOW):
+        self.blocked: Set[int] = set()
+        self.recent_size = recent_size
+        self.repeat_users = repeat_users
+        self.repeat_window = repeat_window
+        self._seen: Dict[int, OrderedDict] = {}  # 群号: {图片摘要: deque[[时间, 用户ID, 消息ID, 已处理]]}
+        self._messages: Dict[int, OrderedDict] = {}  # 群号: {消息ID: [每张图片的摘要元组]}
+        self.hits = 0  # 命中黑名单的消息数
+        self.repeats = 0  # 识别为重复图片的消息数
+
+    def __len__(self) -> int:
+        return len(self.blocked)
+
+    @classmethod
+    def identifiers(cls, image: Dict[str, str]) -> List[str]:
+        """一张图片的标识：file_unique、不带扩展名的 file、url（有 fileid 时只取 fileid）"""
+        found = []
+        unique = image.get("file_unique") or image.get("fileUnique")
+        if unique:
+            found.append(unique.lower())
+        name = image.get("file") or ""
+        url = image.get("url") or ""
+        if name.startswith(("http://", "https://")):
+            url, name = url or name, ""
+        if name and not name.startswith(cls.PASSTHROUGH_SCHEMES):
+            found.append(name.rsplit(".", 1)[0].lower())
+        if url:
+            base, _, query = url.partition("?")
+            fileid = next((param[7:] for param in query.split("&") if param.startswith("fileid=")), None)
+            found.append("fileid=" + fileid if fileid else base.split("://", 1)[-1])
+        return found
+
+    @staticmethod
+    def digest(identifier: str) -> int:
+        """标识的64位摘要（有符号，可直接作为SQLite的整数键）"""
+        return int.from_bytes(hashlib.blake2b(identifier.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+    def fingerprint(self, image: Dict[str, str]) -> Tuple[int, ...]:
+        return tuple(self.digest(identifier) for identifier in self.identifiers(image))
+
+    def observe(self, group_id: int, user_id: int, message_id: int, images: List[Dict[str, str]],
+                now: Optional[float] = None) -> Tuple[bool, List[Tuple[int, int]]]:
+        """记录一条消息里的图片，返回 (是否含黑名单图片, 被多人重复发送的图片所在的 [(用户ID, 消息ID)])"""
+        if now is None:
+            now = time.monotonic()
+        pairs = [(image, digests) for image, digests in zip(images, map(self.fingerprint, images)) if digests]
+        if not pairs:
+            return False, []
+        fingerprints = [digests for _, digests in pairs]
+        messages = self._messages.setdefault(group_id, OrderedDict())
+        messages[message_id] = fingerprints
+        if len(messages) > self.recent_size:
+            messages.popitem(last=False)
+
+        blocked = any(digest in self.blocked for digests in fingerprints for digest in digests)
+        if blocked:
+            self.hits += 1
+        targets = []
+        if self.repeat_users > 0:
+            for image, digests in pairs:
+                if not ParsedMessage.is_sticker(image):
+                    targets.extend(self._repeat(group_id, digests[0], user_id, message_id, now))
+        targets = list(dict.fromkeys(targets))  # 一条消息里有多张重复图片时只记一次
+        self.repeats += len(targets)
+        return blocked, targets
+
+    def _repeat(self, group_id: int, key: int, user_id: int, message_id: int, now: float) -> List[Tuple[int, int]]:
+        """记录一次发送，时间窗口内发送过的不同用户够多时标记并返回尚未记录过的"""
+        seen = self._seen.setdefault(group_id, OrderedDict())
+        senders = seen.get(key)
+        if senders is None:
+            senders = seen[key] = deque(maxlen=self.repeat_users * 2)
+            if len(seen) > self.recent_size:
+                seen.popitem(last=False)
+        else:
+            seen.move_to_end(key)
+        senders.append([now, user_id, message_id, False])
+        cutoff = now - self.repeat_window
+        recent = [sender for sender in senders if sender[0] >= cutoff]
+        if len({sender[1] for sender in recent}) < self.repeat_users:
+            return []
+        targets = []
+        for sender in recent:
+            if not sender[3]:
+                sender[3] = True
+                targets.append((sender[1], sender[2]))
+        return targets
+
+    def images_of(self, group_id: int, message_id: int) -> Optional[List[Tuple[int, ...]]]:
+        """最近一条带图片的消息里各图片的摘要，不在记录里时返回None"""
+        return self._messages.get(group_id, {}).get(message_id)
+
+    def block(self, fingerprints: List[Tuple[int, ...]]) -> List[int]:
+        """把图片的全部标识加入黑名单，返回新加入的摘要"""
+        added = [digest for digests in fingerprints for digest in digests if digest not in self.blocked]
+        self.blocked.update(added)
+        return added
+
+    def unblock(self, fingerprints: List[Tuple[int, ...]]) -> List[int]:
+        """从黑名单移除图片的全部标识，返回实际移除的摘要"""
+        removed = [digest for digests in fingerprints for digest in digests if digest in self.blocked]
+        self.blocked.difference_update(removed)
+        return removed
+
+class RecentMessageIndex:
+    """每个群最近的消息ID，按用户分开记录，供批量撤回（!purge、处罚时撤回之前的消息）
+
+    每个用户一个定长环形缓冲区，每个群最多记录 max_users 个最近发言的用户（最久没发言的先淘汰），
+    内存按群封顶。取出的消息ID同时从记录中移除，不会重复撤回。
+    """
+
+    def __init__(self, per_user: int = PURGE_PER_USER, max_users: int = PURGE_USERS_PER_GROUP):
+        self.per_user = per_user
+        self.max_users = max_users
+        self._groups: Dict[int, OrderedDict] = {}  # 群号: {用户ID: deque[(发送时间, 消息ID)]}
+
+    def __len__(self) -> int:
+        return sum(len(users) for users in self._groups.values())
+
+    def record(self, group_id: int, user_id: int, message_id: int, now: Optional[float] = None):
+        users = self._groups.get(group_id)
+        if users is None:
+            users = self._groups[group_id] = OrderedDict()
+        messages = users.get(user_id)
+        if messages is None:
+            messages = users[user_id] = deque(maxlen=self.per_user)
+            if len(users) > self.max_users:
+                users.popitem(last=False)
+        else:
+            users.move_to_end(user_id)
+        messages.append((time.time() if now is None else now, message_id))
+
+    def take(self, group_id: int, user_id: int, count: Optional[int] = None,
+             since: Optional[float] = None) -> List[int]:
+        """取出用户最近的消息ID（从新到旧）：count 限制条数，since 只取该时间戳之后发送的"""
+        users = self._groups.get(group_id)
+        messages = users.get(user_id) if users is not None else None
+        if not messages:
+            return []
+        taken = []
+        while messages and (count is None or len(taken) < count):
+            if since is not None and messages[-1][0] < since:
+                break
+            taken.append(messages.pop()[1])
+        if not messages:
+            del users[user_id]
+        return taken
+
+
+class ModerationPipeline:
+    """审核决策（不执行动作）：消息预处理、违禁词/广告匹配、图片黑名单、刷屏与跨用户重复内容检测
+
+    在线处理、影子模式和离线回放（replay.py）共用这一套判断。
+    """
+
+    EXEMPT_ROLES = frozenset({"owner", "admin"})
+    NON_TEXT_TIERS = frozenset({"flood", "wave", "image"})  # 不是由文字规则判断的级别
+    TEXT_COMMANDS = frozenset({"赞我", "启动战云睡觉模式"})
+
+    def __init__(self, tiers=RULE_TIERS, enabled_groups: Set[int] = ENABLED_GROUPS,
+                 flood_rules: Optional[Dict[int, Dict[str, float]]] = FLOOD_GROUP_RULES):
+        self.rules = RuleMatcher(tiers)  # 所有违禁词与广告规则预编译成一个匹配器
+        self.normalizer = TextNormalizer(extra_map=NORMALIZE_EXTRA_MAP) if NORMALIZE_TEXT else None
+        self.flood = FloodLimiter(group_rules=flood_rules)  # 按群和用户统计的刷屏检测
+        self.waves = DuplicateWaveDetector() if WAVE_ENABLED else None  # 多个账号发送相同或相近内容
+        self.wave_enforce = WAVE_ENFORCE  # 关闭时刷屏潮只记录不处罚
+        self.images = ImageBlocklist() if IMAGE_BLOCKLIST_ENABLED else None  # 黑名单由持有状态的一方加载
+        self.enabled_groups = enabled_groups
+
+    @staticmethod
+    def clean(message: str) -> str:
+        """预处理消息：移除CQ码，合并空白，得到用于检测的纯文字"""
+        return ParsedMessage.from_raw(message).text
+
+    @staticmethod
+    def parse(event: MessageEvent) -> ParsedMessage:
+        """切分消息（同一事件只切分一次）"""
+        if event.parsed is None:
+            event.parsed = ParsedMessage.parse(event.raw_message, event.message)
+        return event.parsed
+
+    def normalize(self, text: str) -> str:
+        """规则匹配用的归一化文字"""
+        return self.normalizer.normalize(text) if self.normalizer is not None else text
+
+    def match(self, text: str) -> Optional[Tuple[str, str]]:
+        """在归一化后的文字上匹配违禁词与广告规则"""
+        return self.rules.match(self.normalize(text)) if text else None
+
+    def locate(self, text: str, pattern: str) -> Optional[Tuple[int, int]]:
+        """命中的规则在原文字中的位置，用于日志"""
+        if self.normalizer is not None:
+            return self.normalizer.locate(text, pattern)
+        match = re.search(pattern, text)
+        return match.span() if match is not None else None
+
+    def applies(self, event: MessageEvent) -> bool:
+        """是否需要审核：启用群里普通成员发的群消息，命令除外"""
+        raw_message = event.raw_message.strip()
+        return (event.message_type == "group" and event.group_id in self.enabled_groups
+                and event.sender_role not in self.EXEMPT_ROLES
+                and raw_message not in self.TEXT_COMMANDS and not raw_message.startswith("!"))
+
+    def decide(self, event: MessageEvent, now: Optional[float] = None,
+               text: Optional[str] = None) -> List[Tuple[str, str]]:
+        """返回消息会触发的处罚 [(级别, 规则)]：违禁词/广告至多一条（最严重的），图片、刷屏、刷屏潮各一条
+
+        重复图片只记录不处罚，刷屏潮只记录（WAVE_ENFORCE = False）时也一样，规则为 "log_only"。
+        """
+        if text is None:
+            text = self.parse(event).text
+        decisions = []
+        hit = self.match(text)
+        if hit is not None:
+            decisions.append(hit)
+        blocked, repeated = self.check_images(event, now)
+        if blocked or repeated:
+            decisions.append(("image", "blocked" if blocked else "log_only"))
+        if self.flood.hit(event.group_id, event.user_id, now):
+            decisions.append(("flood", "flood"))
+        if self.wave(event, text, now):
+            decisions.append(("wave", "wave" if self.wave_enforce else "log_only"))
+        return decisions
+
+    def check_images(self, event: MessageEvent, now: Optional[float] = None) -> Tuple[bool, List[Tuple[int, int]]]:
+        """记录消息里的图片，返回 (是否含黑名单图片, 被多人重复发送的图片所在的 [(用户ID, 消息ID)])"""
+        if self.images is None:
+            return False, []
+        images = self.parse(event).images
+        if not images:
+            return False, []
+        return self.images.observe(event.group_id, event.user_id, event.message_id, images, now)
+
+    def wave(self, event: MessageEvent, text: str, now: Optional[float] = None) -> List[Tuple[int, int]]:
+        """记录消息用于跨用户重复内容检测，形成刷屏潮时返回同一波要处理的 [(用户ID, 消息ID)]"""
+        if self.waves is None or not text:
+            return []
+        return self.waves.observe(event.group_id, event.user_id, event.message_id, self.normalize(text), now)
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，burst 为桶容量"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """取一个令牌；成功返回0，否则返回还需等待的秒数（不消耗令牌）"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class ActionScheduler:
+    """出站动作调度器：按优先级排队，全局与每个群分别限速，合并同一群的短时间内多条通知
+
+    被某个群或全局的限速挡住的动作会算好等待时间后重新排队，发送循环本身从不等待，不会阻塞其它群的动作。
+    群号由调用方给出（delete_msg 的参数里只有消息ID），没给时取参数里的 group_id。
+    """
+
+    def __init__(self, call, global_rate: float = ACTION_RATE_GLOBAL, global_burst: float = ACTION_BURST_GLOBAL,
+                 group_rate: float = ACTION_RATE_PER_GROUP, group_burst: float = ACTION_BURST_PER_GROUP):
+        self.call = call  # async (payload) -> response
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.group_buckets: Dict[int, TokenBucket] = {}
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._notices: Dict[int, List[Tuple[str, asyncio.Future]]] = {}  # 群号: 等待合并的通知
+        self._running: Set[asyncio.Task] = set()
+        self.task = None
+        self.sent = 0
+        self.merged_notices = 0  # 因合并而少发的消息数
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._pump())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    @property
+    def depth(self) -> int:
+        """排队等待发送的动作数"""
+        return self._queue.qsize()
+
+    def submit(self, payload: Dict, group_id: Optional[int] = None) -> asyncio.Future:
+        """排队一个动作，返回会得到响应的future；group_id 为按哪个群限速"""
+        future = asyncio.get_running_loop().create_future()
+        priority = ACTION_PRIORITIES.get(payload.get("action"), 2)
+        if group_id is None:
+            group_id = payload.get("params", {}).get("group_id")
+        self._queue.put_nowait((priority, next(self._seq), payload, future, metrics.clock(), group_id))
+        return future
+
+    async def send(self, payload: Dict, group_id: Optional[int] = None) -> Dict:
+        return await self.submit(payload, group_id)
+
+    def notice(self, group_id: int, text: str) -> asyncio.Future:
+        """排队一条群通知，窗口期内同一群的通知会合并发送"""
+        future = asyncio.get_running_loop().create_future()
+        pending = self._notices.get(group_id)
+        if pending is None:
+            pending = self._notices[group_id] = []
+            asyncio.get_running_loop().call_later(NOTICE_COALESCE_WINDOW, self._flush_notices, group_id)
+        pending.append((text, future))
+        return future
+
+    def _flush_notices(self, group_id: int):
+        """把窗口期内积累的通知拼接成尽量少的消息"""
+        pending = self._notices.pop(group_id, [])
+        batch: List[Tuple[str, asyncio.Future]] = []
+        length = 0
+        for text, future in pending:
+            if batch and length + len(text) + 2 > NOTICE_MAX_LENGTH:
+                self._submit_notice_batch(group_id, batch)
+                batch, length = [], 0
+            batch.append((text, future))
+            length += len(text) + 2
+        if batch:
+            self._submit_notice_batch(group_id, batch)
+
+    def _submit_notice_batch(self, group_id: int, batch: List[Tuple[str, asyncio.Future]]):
+        self.merged_notices += len(batch) - 1
+        merged = self.submit({
+            "action": "send_group_msg",
+            "params": {"group_id": group_id, "message": "\n\n".join(text for text, _ in batch)}
+        })
+
+        def resolve(done: asyncio.Future):
+            for _, future in batch:
+                if future.done():
+                    continue
+                if done.exception() is not None:
+                    future.set_exception(done.exception())
+                else:
+                    future.set_result(done.result())
+
+        merged.add_done_callback(resolve)
+
+    async def _pump(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            priority, seq, payload, future, queued, group_id = entry
+            if future.done():  # 调用方已放弃
+                continue
+
+            if group_id is not None:
+                bucket = self.group_buckets.get(group_id)
+                if bucket is None:
+                    bucket = self.group_buckets[group_id] = TokenBucket(self.group_rate, self.group_burst)
+                wait = bucket.take()
+                if wait > 0:
+                    # 该群超速，稍后重新排队，先处理其它群
+                    loop.call_later(wait, self._queue.put_nowait, entry)
+                    continue
+
+            wait = self.global_bucket.take()
+            if wait > 0:
+                # 全局超速：到有令牌时再重新排队（该群的令牌已经取过，不再重复计）
+                loop.call_later(wait, self._queue.put_nowait, (priority, seq, payload, future, queued, None))
+                continue
+
+            # 排队等待（含限速延后）的时间，相当于原来等待WS锁的时间
+            metrics.observe_since("bot_action_queue_wait_seconds", queued, action=payload.get("action"))
+            task = asyncio.create_task(self._execute(payload, future))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, payload: Dict, future: asyncio.Future):
+        try:
+            result = await self.call(payload)
+            self.sent += 1
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+class EventDispatcher:
+    """事件分发器：按群号分片到固定数量的处理协程
+
+    同一个群的事件总落在同一个分片里，保证群内按序处理；不同群互不阻塞。
+    每个分片的队列有上限，处理跟不上时丢弃新事件并计数，而不是无限堆积。
+    """
+
+    def __init__(self, handler, workers: int = EVENT_WORKERS, queue_size: int = EVENT_QUEUE_SIZE):
+        self.handler = handler
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.worker_tasks: List[asyncio.Task] = []
+        self.processed = 0  # 已处理事件数
+        self.dropped = 0  # 因队列已满被丢弃的事件数
+
+    def start(self):
+        """启动处理协程（重复调用不会重复启动）"""
+        if self.worker_tasks:
+            return
+        self.worker_tasks = [asyncio.create_task(self._worker(queue)) for queue in self.queues]
+
+    async def stop(self):
+        """停止所有处理协程"""
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+
+    def submit(self, key: int, event) -> bool:
+        """投递事件（key 一般为群号，相同key的事件按序处理），队列已满时丢弃并返回False"""
+        queue = self.queues[hash(key) % len(self.queues)]
+        try:
+            queue.put_nowait((metrics.clock(), event))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"事件队列已满，已累计丢弃 {self.dropped} 个事件")
+            return False
+
+    @property
+    def depth(self) -> int:
+        """所有分片中等待处理的事件总数"""
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self) -> Dict[str, int]:
+        """队列深度与处理/丢弃计数"""
+        return {
+            "depth": self.depth,
+            "max_shard_depth": max(queue.qsize() for queue in self.queues),
+            "processed": self.processed,
+            "dropped": self.dropped,
+        }
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            queued, event = await queue.get()
+            metrics.observe_since("bot_event_queue_wait_seconds", queued)
+            started = metrics.clock()
+            try:
+                await self.handler(event)
+            except Exception as e:
+                logger.error(f"处理事件时出错: {str(e)}")
+            finally:
+                metrics.observe_since("bot_event_handle_seconds", started)
+                self.processed += 1
+                queue.task_done()
+
+class MinecraftPinger:
+    """原生 Java 版 Server List Ping：握手 + 状态请求 + ping/pong 测延迟，不依赖第三方API
+
+    新协议失败时回退到 1.6 及更早版本使用的旧式 0xFE ping。安装了 aiodns 时会先解析
+    _minecraft._tcp SRV 记录。
+    """
+
+    MAX_PACKET_SIZE = 1 << 21
+    FORMAT_CODE_PATTERN = re.compile(r'§.')
+
+    def __init__(self, timeout: float = MC_PING_TIMEOUT):
+        self.timeout = timeout
+        self._resolver = None
+
+    @staticmethod
+    def pack_varint(value: int) -> bytes:
+        """编码VarInt（负数按32位补码）"""
+        value &= 0xFFFFFFFF
+        out = bytearray()
+        while True:
+            byte = value & 0x7F
+            value >>= 7
+            if value:
+                out.append(byte | 0x80)
+            else:
+                out.append(byte)
+                return bytes(out)
+
+    @staticmethod
+    def unpack_varint(data: bytes, offset: int = 0) -> Tuple[int, int]:
+        """从字节串解码VarInt，返回 (值, 新偏移)"""
+        result = 0
+        for shift in range(0, 35, 7):
+            if offset >= len(data):
+                raise ValueError("VarInt不完整")
+            byte = data[offset]
+            offset += 1
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                if result & 0x80000000:
+                    result -= 1 << 32
+                return result, offset
+        raise ValueError("VarInt过长")
+
+    @classmethod
+    def pack_string(cls, text: str) -> bytes:
+        data = text.encode("utf-8")
+        return cls.pack_varint(len(data)) + data
+
+    @classmethod
+    def pack_packet(cls, packet_id: int, payload: bytes = b"") -> bytes:
+        """加上长度前缀的数据包"""
+        body = cls.pack_varint(packet_id) + payload
+        return cls.pack_varint(len(body)) + body
+
+    @classmethod
+    async def read_packet(cls, reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+        """读取一个数据包，返回 (包ID, 包体)"""
+        length = 0
+        for shift in range(0, 35, 7):
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        else:
+            raise ValueError("数据包长度VarInt过长")
+        if not 0 < length <= cls.MAX_PACKET_SIZE:
+            raise ValueError(f"数据包长度异常: {length}")
+        data = await reader.readexactly(length)
+        packet_id, offset = cls.unpack_varint(data)
+        return packet_id, data[offset:]
+
+    @classmethod
+    def flatten_motd(cls, description) -> str:
+        """把聊天组件格式的MOTD拍平成纯文本（各组件原样拼接，最后才去掉格式代码和首尾空白）"""
+        return cls.FORMAT_CODE_PATTERN.sub("", cls._join_components(description)).strip()
+
+    @classmethod
+    def _join_components(cls, description) -> str:
+        if isinstance(description, str):
+            return description
+        if isinstance(description, dict):
+            extra = description.get("extra")
+            return str(description.get("text", "")) + (cls._join_components(extra) if isinstance(extra, list) else "")
+        if isinstance(description, list):
+            return "".join(map(cls._join_components, description))
+        return ""
+
+    async def resolve(self, host: str, port: int) -> Tuple[str, int]:
+        """默认端口时查询SRV记录，没有aiodns或没有记录则原样返回"""
+        if aiodns is None or port != 25565:
+            return host, port
+        try:
+            if self._resolver is None:
+                self._resolver = aiodns.DNSResolver()
+            records = await asyncio.wait_for(self._resolver.query(f"_minecraft._tcp.{host}", "SRV"), self.timeout)
+            if records:
+                record = min(records, key=lambda r: (r.priority, -r.weight))
+                return record.host.rstrip("."), record.port
+        except Exception as e:
+            logger.debug("SRV查询失败 %s: %s", host, e)
+        return host, port
+
+    async def status(self, host: str, port: int = 25565) -> dict:
+        """新版协议查询，失败抛出异常"""
+        target_host, target_port = await self.resolve(host, port)
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(target_host, target_port), self.timeout)
+        try:
+            return await asyncio.wait_for(self._exchange_status(reader, writer, host, port), self.timeout)
+        finally:
+            writer.close()
+
+    async def _exchange_status(self, reader, writer, host: str, port: int) -> dict:
+        handshake = self.pack_varint(-1) + self.pack_string(host) + struct.pack(">H", port) + self.pack_varint(1)
+        writer.write(self.pack_packet(0x00, handshake) + self.pack_packet(0x00))
+        await writer.drain()
+
+        packet_id, payload = await self.read_packet(reader)
+        if packet_id != 0x00:
+            raise ValueError(f"意外的状态响应包: {packet_id}")
+        length, offset = self.unpack_varint(payload)
+        status = json.loads(payload[offset:offset + length].decode("utf-8"))
+        # 格式不对的响应按查询失败处理，交给旧式ping和第三方API
+        if not isinstance(status, dict):
+            raise ValueError(f"状态响应不是JSON对象: {type(status).__name__}")
+        players = status.get("players") or {}
+        version = status.get("version") or {}
+        if not isinstance(players, dict) or not isinstance(version, dict):
+            raise ValueError("状态响应的 players/version 不是JSON对象")
+
+        # ping/pong测延迟；部分服务器返回状态后直接断开，此时不报延迟
+        latency = None
+        try:
+            token = int(time.time() * 1000)
+            started = time.perf_counter()
+            writer.write(self.pack_packet(0x01, struct.pack(">q", token)))
+            await writer.drain()
+            packet_id, payload = await self.read_packet(reader)
+            if packet_id == 0x01 and payload == struct.pack(">q", token):
+                latency = round((time.perf_counter() - started) * 1000)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+        return {
+            "online": True,
+            "players": {"online": players.get("online", 0), "max": players.get("max", 0)},
+            "version": version.get("name", "未知"),
+            "motd": self.flatten_motd(status.get("description", "")) or "未知",
+            "latency": latency,
+        }
+
+    async def legacy_status(self, host: str, port: int = 25565) -> dict:
+        """旧式0xFE ping（1.6及更早的服务器），失败抛出异常"""
+        target_host, target_port = await self.resolve(host, port)
+        started = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(target_host, target_port), self.timeout)
+        try:
+            writer.write(b"\xfe\x01")
+            await writer.drain()
+            header = await asyncio.wait_for(reader.readexactly(3), self.timeout)
+            if header[0] != 0xFF:
+                raise ValueError("不是旧式ping响应")
+            length = struct.unpack(">H", header[1:])[0]
+            text = (await asyncio.wait_for(reader.readexactly(length * 2), self.timeout)).decode("utf-16-be")
+        finally:
+            writer.close()
+        latency = round((time.perf_counter() - started) * 1000)
+
+        if text.startswith("§1\x00"):
+            # 1.4-1.6: §1\0协议号\0版本\0MOTD\0在线\0上限
+            _, _, version, motd, online, max_players = text.split("\x00")[:6]
+        else:
+            # beta1.8-1.3: MOTD§在线§上限
+            parts = text.split("§")
+            motd, online, max_players = "§".join(parts[:-2]), parts[-2], parts[-1]
+            version = "未知（旧版协议）"
+        return {
+            "online": True,
+            "players": {"online": int(online), "max": int(max_players)},
+            "version": version,
+            "motd": self.flatten_motd(motd) or "未知",
+            "latency": latency,
+        }
+
+    async def query(self, host: str, port: int = 25565) -> Optional[dict]:
+        """先试新版协议再试旧式ping，都失败返回None"""
+        for probe in (self.status, self.legacy_status):
+            try:
+                return await probe(host, port)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, UnicodeDecodeError) as e:
+                logger.debug("%s 查询 %s:%s 失败: %s", probe.__name__, host, port, e)
+        return None
+
+class MinecraftServerStatus:
+    """Minecraft服务器状态查询类：复用同一个HTTP会话（连接池、长连接、DNS缓存）"""
+
+    API_URLS = (
+        "https://api.mcsrvstat.us/3/{host}:{port}",
+        "https://api.mcsrvstat.us/2/{host}:{port}",
+        "https://api.mcsrvstat.us/simple/{host}:{port}",
+        "https://api.mcstatus.io/v2/status/java/{host}:{port}",
+    )
+
+    def __init__(self, hedged: bool = MC_QUERY_HEDGED, deadline: float = MC_QUERY_DEADLINE,
+                 native: bool = MC_NATIVE_PING):
+        self.hedged = hedged  # 是否同时请求所有API，取最先返回的有效结果
+        self.deadline = deadline  # 并发模式下所有API的总时限（秒）
+        self.pinger = MinecraftPinger() if native else None  # 直接协议查询，优先于API
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """懒加载共享会话（需要在事件循环内创建）"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=MC_HTTP_POOL_SIZE,
+                ttl_dns_cache=MC_DNS_CACHE_TTL,
+                keepalive_timeout=60,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=SERVER_CHECK_TIMEOUT),
+            )
+        return self.session
+
+    async def close(self):
+        """关闭共享会话"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    @staticmethod
+    def _parse_response(api_url: str, data: dict) -> Optional[dict]:
+        """把不同API的响应统一成内部格式，服务器不在线时返回None"""
+        if not data.get("online", False):
+            return None
+        if 'mcsrvstat.us' in api_url:
+            return {
+                "online": True,
+                "players": {
+                    "online": data.get("players", {}).get("online", 0),
+                    "max": data.get("players", {}).get("max", 0)
+                },
+                "version": data.get("version", "未知"),
+                "motd": data.get("motd", {}).get("clean", ["未知"])[0] if isinstance(data.get("motd"), dict) else "未知"
+            }
+        if 'mcstatus.io' in api_url:
+            return {
+                "online": True,
+                "players": {
+                    "online": data.get("players", {}).get("online", 0),
+                    "max": data.get("players", {}).get("max", 0)
+                },
+                "version": data.get("version", {}).get("name_raw", "未知"),
+                "motd": data.get("motd", {}).get("raw", "未知")
+            }
+        return None
+
+    async def _query_api(self, api_url: str) -> Optional[dict]:
+        """查询单个API，失败或离线返回None"""
+        provider = api_url.split("/")[2]  # 按API域名统计延迟
+        started = metrics.clock()
+        result = None
+        try:
+            logger.debug("尝试API: %s", api_url)
+            async with self._get_session().get(api_url) as response:
+                if response.status == 200:
+                    result = self._parse_response(api_url, await response.json(content_type=None))
+        except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+            logger.debug("API %s 查询失败: %s", api_url, e)
+        metrics.observe_since("bot_mc_probe_seconds", started, provider=provider)
+        metrics.inc("bot_mc_probes_total", provider=provider, result="online" if result else "failed")
+        return result
+
+    async def _query_hedged(self, api_urls: List[str]) -> Optional[dict]:
+        """同时请求所有API，返回最先得到的在线结果，超过总时限则放弃"""
+        tasks = [asyncio.ensure_future(self._query_api(url)) for url in api_urls]
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=self.deadline):
+                result = await next_done
+                if result is not None:
+                    return result
+        except asyncio.TimeoutError:
+            logger.debug("API并发查询超过总时限 %s 秒", self.deadline)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return None
+
+    async def query_server(self, host: str, port: int = 25565) -> dict:
+        """查询Minecraft服务器状态：先直接协议查询，再依次退回第三方API与端口探测"""
+        try:
+            if self.pinger is not None:
+                started = metrics.clock()
+                result = await self.pinger.query(host, port)
+                metrics.observe_since("bot_mc_probe_seconds", started, provider="native")
+                metrics.inc("bot_mc_probes_total", provider="native", result="online" if result else "failed")
+                if result is not None:
+                    return result
+
+            api_urls = [url.format(host=host, port=port) for url in self.API_URLS]
+
+            if self.hedged:
+                result = await self._query_hedged(api_urls)
+                if result is not None:
+                    return result
+            else:
+                for api_url in api_urls:
+                    result = await self._query_api(api_url)
+                    if result is not None:
+                        return result
+            
+            # 如果所有API都失败，尝试直接连接端口
+            try:
+                logger.debug("尝试直接连接: %s:%s", host, port)
+                started = metrics.clock()
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port),
+                    timeout=10
+                )
+                writer.close()
+                await writer.wait_closed()
+                metrics.observe_since("bot_mc_probe_seconds", started, provider="tcp")
+                metrics.inc("bot_mc_probes_total", provider="tcp", result="online")
+                return {
+                    "online": True,
+                    "players": {"online": 0, "max": 0},
+                    "version": "未知（端口可连接）",
+                    "motd": "端口可连接但协议查询失败"
+                }
+            except (OSError, asyncio.TimeoutError):
+                metrics.inc("bot_mc_probes_total", provider="tcp", result="failed")
+                        
+        except Exception as e:
+            logger.debug("服务器查询完全失败 %s:%s: %s", host, port, e)
+        
+        return {"online": False, "players": {"online": 0, "max": 0}, "version": "未知"}
+
+class ServerStatusCache:
+    """服务器状态缓存：监控和 !mcstatus 共用，过期才重新查询，同一服务器的并发查询合并为一次"""
+
+    def __init__(self, query, servers: Dict[str, Dict], ttl: float = MC_STATUS_CACHE_TTL):
+        self.query = query  # async (host, port) -> dict
+        self.servers = servers
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, dict]] = {}  # 服务器名称: (查询时间, 结果)
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def peek(self, server_name: str, max_age: Optional[float] = None) -> Optional[dict]:
+        """返回未过期的缓存结果，没有则返回None"""
+        entry = self._entries.get(server_name)
+        if entry is None:
+            return None
+        checked_at, result = entry
+        if time.monotonic() - checked_at > (self.ttl if max_age is None else max_age):
+            return None
+        return result
+
+    async def get(self, server_name: str, max_age: Optional[float] = None) -> dict:
+        """优先读缓存，过期时才查询"""
+        cached = self.peek(server_name, max_age)
+        if cached is not None:
+            return cached
+        return await self.refresh(server_name)
+
+    async def refresh(self, server_name: str) -> dict:
+        """强制查询并写入缓存；已有同一服务器的查询在进行时直接等它的结果"""
+        future = self._inflight.get(server_name)
+        if future is None:
+            config = self.servers[server_name]
+            future = asyncio.ensure_future(self.query(config["host"], config["port"]))
+            self._inflight[server_name] = future
+            future.add_done_callback(lambda done: self._store(server_name, done))
+        return await asyncio.shield(future)
+
+    def _store(self, server_name: str, future: asyncio.Future):
+        self._inflight.pop(server_name, None)
+        if not future.cancelled() and future.exception() is None:
+            self._entries[server_name] = (time.monotonic(), future.result())
+
+class MemberCache:
+    """群成员信息缓存：按 (群, 用户) 存储，带TTL和LRU上限
+
+    消息事件里的 sender.role 会随时写入缓存，管理员变动/进群/退群通知会更新或清除对应条目，
+    所以正常情况下判断权限不需要任何API请求。
+    """
+
+    def __init__(self, ttl: float = MEMBER_CACHE_TTL, max_size: int = MEMBER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[int, int], Tuple[float, Dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, group_id: int, user_id: int) -> Optional[Dict]:
+        """返回未过期的成员信息，没有则返回None"""
+        key = (group_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, group_id: int, user_id: int, info: Dict):
+        """写入完整的成员信息"""
+        key = (group_id, user_id)
+        self._entries[key] = (time.monotonic() + self.ttl, info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def update_role(self, group_id: int, user_id: int, role: str):
+        """只更新角色（来自消息事件或管理员变动通知），保留已缓存的其它字段"""
+        entry = self._entries.get((group_id, user_id))
+        if entry is not None and entry[1].get("role") == role:
+            return
+        info = dict(entry[1]) if entry is not None else {"group_id": group_id, "user_id": user_id}
+        info["role"] = role
+        self.put(group_id, user_id, info)
+
+    def invalidate(self, group_id: int, user_id: Optional[int] = None):
+        """清除一个成员；不指定用户时清除整个群"""
+        if user_id is not None:
+            self._entries.pop((group_id, user_id), None)
+            return
+        for key in [key for key in self._entries if key[0] == group_id]:
+            del self._entries[key]
+
+class EnforcementLedger:
+    """处罚动作台账：按 (群, 用户, 动作) 记录进行中和近期完成的动作
+
+    同一动作还在进行时，重复请求直接等待进行中的那一次；成功完成后冷却期内的重复请求直接跳过。
+    抛出异常或接口返回失败的动作不记为完成，下一次请求会重新执行。
+    已封禁的用户每发一条消息都会触发 check_user_status，台账保证只发出一次踢人。
+    """
+
+    def __init__(self, cooldown: float = ENFORCEMENT_COOLDOWN, max_size: int = ENFORCEMENT_LEDGER_SIZE):
+        self.cooldown = cooldown
+        self.max_size = max_size
+        self._inflight: Dict[Tuple[int, int, str], asyncio.Future] = {}
+        self._recent: "OrderedDict[Tuple[int, int, str], float]" = OrderedDict()  # 键: 完成时间
+        self.collapsed = 0  # 合并到进行中动作的请求数
+        self.suppressed = 0  # 冷却期内被跳过的请求数
+
+    async def run(self, group_id: int, user_id: int, action: str, factory):
+        """执行 factory() 产生的动作，除非同一动作正在进行或刚完成；被跳过时返回None"""
+        key = (group_id, user_id, action)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.collapsed += 1
+            return await asyncio.shield(future)
+
+        finished_at = self._recent.get(key)
+        if finished_at is not None and time.monotonic() - finished_at < self.cooldown:
+            self.suppressed += 1
+            return None
+
+        future = asyncio.ensure_future(factory())
+        self._inflight[key] = future
+        try:
+            result = await asyncio.shield(future)
+        finally:
+            self._inflight.pop(key, None)
+        if self.succeeded(result):
+            self._mark_done(key)
+        return result
+
+    @staticmethod
+    def succeeded(response) -> bool:
+        """OneBot 响应是否表示成功（连接断开时暂存待重发的也算）"""
+        return isinstance(response, dict) and (response.get("status") == "ok" or response.get("retcode") == 0)
+
+    def _mark_done(self, key: Tuple[int, int, str]):
+        now = time.monotonic()
+        self._recent[key] = now
+        self._recent.move_to_end(key)
+        # 按完成时间有序，从最老的开始清理过期或超量的记录
+        while self._recent:
+            oldest_key, oldest_time = next(iter(self._recent.items()))
+            if now - oldest_time < self.cooldown and len(self._recent) <= self.max_size:
+                break
+            del self._recent[oldest_key]
+
+    def forget(self, user_id: int):
+        """管理员手动解封/解禁后清除该用户的冷却，下次违规能立即处理"""
+        for key in [key for key in self._recent if key[1] == user_id]:
+            del self._recent[key]
+
+class ModerationStore:
+    """管理状态持久化：SQLite（WAL模式）
+
+    修改先记在内存里按 (类型, 用户) 合并，后台每隔 flush_interval 秒在单独的写线程里
+    一次事务批量写盘，事件循环不碰磁盘。启动时一次性读出全部记录，过期的禁言和点赞冷却
+    在读取前就被清理掉。
+    """
+
+    BAN = "ban"
+    MUTE = "mute"
+    VIOLATION = "violation"
+    LIKE = "like"
+    TEMP_BAN = "temp_ban"
+    IMAGE = "image"  # 图片黑名单，键为图片标识的64位摘要
+
+    def __init__(self, path: str = STATE_DB_PATH, flush_interval: float = STATE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " kind TEXT NOT NULL, user_id INTEGER NOT NULL,"
+            " value REAL NOT NULL DEFAULT 0, count INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (kind, user_id)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        self._pending: Dict[Tuple[str, int], Optional[Tuple[float, int]]] = {}  # None表示删除
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-writer")
+        self.flush_task = None
+
+    def load(self) -> Dict[str, Dict[int, Tuple[float, int]]]:
+        """读取全部状态，返回 {类型: {用户ID: (值, 计数)}}"""
+        now = time.time()
+        self._conn.execute("DELETE FROM state WHERE kind IN (?, ?) AND value <= ?", (self.MUTE, self.TEMP_BAN, now))
+        self._conn.execute("DELETE FROM state WHERE kind = ? AND value <= ?", (self.LIKE, now - LIKE_COOLDOWN_HOURS * 3600))
+        self._conn.commit()
+
+        state: Dict[str, Dict[int, Tuple[float, int]]] = {
+            self.BAN: {}, self.MUTE: {}, self.VIOLATION: {}, self.LIKE: {}, self.TEMP_BAN: {}, self.IMAGE: {}
+        }
+        for kind, user_id, value, count in self._conn.execute("SELECT kind, user_id, value, count FROM state"):
+            state.setdefault(kind, {})[user_id] = (value, count)
+        return state
+
+    def save(self, kind: str, user_id: int, value: float = 0, count: int = 0):
+        """记录一次写入（在下次批量写盘时生效）"""
+        self._pending[(kind, user_id)] = (value, count)
+
+    def delete(self, kind: str, user_id: int):
+        """记录一次删除（在下次批量写盘时生效）"""
+        self._pending[(kind, user_id)] = None
+
+    def start(self):
+        """启动后台批量写盘任务"""
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"状态写盘失败: {str(e)}")
+
+    async def flush(self):
+        """把积累的修改交给写线程，一次事务写完；写失败时整批放回，合并到下一次写盘"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write_batch, batch)
+        except BaseException:
+            # 写盘期间又有新的修改时以新的为准
+            batch.update(self._pending)
+            self._pending = batch
+            raise
+
+    def _write_batch(self, batch: Dict[Tuple[str, int], Optional[Tuple[float, int]]]):
+        upserts = [(kind, user_id, row[0], row[1]) for (kind, user_id), row in batch.items() if row is not None]
+        deletes = [(kind, user_id) for (kind, user_id), row in batch.items() if row is None]
+        with self._conn:
+            if upserts:
+                self._conn.executemany("INSERT OR REPLACE INTO state (kind, user_id, value, count) VALUES (?, ?, ?, ?)", upserts)
+            if deletes:
+                self._conn.executemany("DELETE FROM state WHERE kind = ? AND user_id = ?", deletes)
+
+    async def close(self):
+        """停止后台任务，写完剩余修改并关闭数据库"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+class EventCapture:
+    """把收到的消息事件原样录制为gzip压缩的JSONL分段，供 replay.py 离线回放
+
+    事件先在内存里攒批，后台每隔 flush_interval 秒交给单独的写线程追加到当前分段。
+    正在写的分段带 .part 后缀，写满或关闭时才改为正式文件名，回放只读完整的分段。
+    """
+
+    def __init__(self, directory: str, segment_events: int = CAPTURE_SEGMENT_EVENTS,
+                 flush_interval: float = CAPTURE_FLUSH_INTERVAL):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_events = segment_events
+        self.flush_interval = flush_interval
+        self._pending: List[str] = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture-writer")
+        self._file = None  # 以下三项只在写线程里访问
+        self._path: Optional[str] = None
+        self._count = 0
+        self.flush_task = None
+        self.captured = 0
+
+    def record(self, frame):
+        """记录一帧原始事件（在下次批量写盘时写入）"""
+        self._pending.append(frame.decode("utf-8") if isinstance(frame, (bytes, bytearray)) else frame)
+        self.captured += 1
+
+    def start(self):
+        """启动后台批量写盘任务"""
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"事件录制写盘失败: {str(e)}")
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write_batch, batch)
+
+    def _write_batch(self, batch: List[str]):
+        while batch:
+            if self._file is None:
+                self._path = os.path.join(self.directory, datetime.now().strftime("events-%Y%m%d-%H%M%S-%f") + f"-{os.getpid()}.jsonl.gz")
+                self._file = gzip.open(self._path + ".part", "wb")
+                self._count = 0
+            room = self.segment_events - self._count
+            chunk, batch = batch[:room], batch[room:]
+            self._file.write(("\n".join(chunk) + "\n").encode("utf-8"))
+            self._count += len(chunk)
+            if self._count >= self.segment_events:
+                self._close_segment()
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            os.replace(self._path + ".part", self._path)
+            self._file = None
+
+    async def close(self):
+        """停止后台任务，写完剩余事件并封闭当前分段"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close_segment)
+        self._executor.shutdown(wait=True)
+
+class ExpiryScheduler:
+    """到期调度器：统一管理所有有时限的处罚与冷却，到期时调用对应类型的回调
+
+    使用最小堆 + 惰性删除：重新安排或取消只改字典，堆里的旧条目在弹出时跳过；
+    旧条目过多时整体重建，摊还O(1)。截止时间用墙上时间，配合持久化可跨重启。
+    """
+
+    def __init__(self):
+        self._callbacks: Dict[str, callable] = {}
+        self._deadlines: Dict[Tuple[str, int], float] = {}  # (类型, 键): 截止时间
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self.task = None
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def register(self, kind: str, callback):
+        """注册某类条目到期时的回调 callback(键)"""
+        self._callbacks[kind] = callback
 
-# 广告检测规则 - 优化版本
-AD_PATTERNS = {
-    # 排除CQ码中的内容，避免匹配表情/图片中的参数
-    r"加群(?![^\[]*\])",             # 加群邀请（排除CQ码中的）
-    r"(vx|wx|weixin)(?![^\[]*\])"    # 微信相关（排除CQ码中的）
-}
+    def schedule(self, kind: str, key: int, deadline: float):
+        """安排（或重新安排）条目在 deadline（时间戳）到期"""
+        self._deadlines[(kind, key)] = deadline
+        if not self._heap or deadline < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (deadline, next(self._seq), kind, key))
+        self._maybe_compact()
 
-# CQ码正则表达式，用于匹配图片、表情等特殊消息
-CQ_PATTERN = re.compile(r'\[CQ:.*?\]')
-# 专门匹配动画表情的CQ码
-ANIMATION_EMOJI_PATTERN = re.compile(r'\[CQ:image,summary=&#91;动画表情&#93;.*?\]')
+    def cancel(self, kind: str, key: int):
+        """取消条目，不触发回调"""
+        self._deadlines.pop((kind, key), None)
+        self._maybe_compact()
 
-def websocket_lock(func):
-    """WebSocket操作锁装饰器，防止并发冲突"""
-    @wraps(func)
-    async def wrapper(self, *args, **kwargs):
-        async with self.ws_lock:
-            return await func(self, *args, **kwargs)
-    return wrapper
+    def deadline(self, kind: str, key: int) -> Optional[float]:
+        return self._deadlines.get((kind, key))
 
-class MinecraftServerStatus:
-    """Minecraft服务器状态查询类 - 简化版本"""
-    
-    @staticmethod
-    async def query_server(host: str, port: int = 25565) -> dict:
-        """查询Minecraft服务器状态 - 使用可靠的API"""
-        try:
-            # 使用可靠的API端点
-            api_urls = [
-                f"https://api.mcsrvstat.us/3/{host}:{port}",
-                f"https://api.mcsrvstat.us/2/{host}:{port}",
-                f"https://api.mcsrvstat.us/simple/{host}:{port}",
-                f"https://api.mcstatus.io/v2/status/java/{host}:{port}",
-            ]
-            
-            async with aiohttp.ClientSession() as session:
-                for api_url in api_urls:
-                    try:
-                        logger.debug(f"尝试API: {api_url}")
-                        async with session.get(api_url, timeout=SERVER_CHECK_TIMEOUT) as response:
-                            if response.status == 200:
-                                data = await response.json()
-                                
-                                # 处理不同的API响应格式
-                                if 'mcsrvstat.us' in api_url:
-                                    if data.get("online", False):
-                                        return {
-                                            "online": True,
-                                            "players": {
-                                                "online": data.get("players", {}).get("online", 0),
-                                                "max": data.get("players", {}).get("max", 0)
-                                            },
-                                            "version": data.get("version", "未知"),
-                                            "motd": data.get("motd", {}).get("clean", ["未知"])[0] if isinstance(data.get("motd"), dict) else "未知"
-                                        }
-                                elif 'mcstatus.io' in api_url:
-                                    if data.get("online", False):
-                                        return {
-                                            "online": True,
-                                            "players": {
-                                                "online": data.get("players", {}).get("online", 0),
-                                                "max": data.get("players", {}).get("max", 0)
-                                            },
-                                            "version": data.get("version", {}).get("name_raw", "未知"),
-                                            "motd": data.get("motd", {}).get("raw", "未知")
-                                        }
-                                
-                    except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
-                        logger.debug(f"API {api_url} 查询失败: {str(e)}")
-                        continue
-            
-            # 如果所有API都失败，尝试直接连接端口
+    def _maybe_compact(self):
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(deadline, next(self._seq), kind, key) for (kind, key), deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def fire_due(self, now: Optional[float] = None) -> int:
+        """触发所有已到期条目，返回触发数"""
+        now = time.time() if now is None else now
+        fired = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, kind, key = heapq.heappop(self._heap)
+            if self._deadlines.get((kind, key)) != deadline:
+                continue  # 已取消或已重新安排
+            del self._deadlines[(kind, key)]
+            fired += 1
             try:
-                logger.debug(f"尝试直接连接: {host}:{port}")
-                reader, writer = await asyncio.wait_for(
-                    asyncio.open_connection(host, port),
-                    timeout=10
-                )
-                writer.close()
-                await writer.wait_closed()
-                return {
-                    "online": True,
-                    "players": {"online": 0, "max": 0},
-                    "version": "未知（端口可连接）",
-                    "motd": "端口可连接但协议查询失败"
-                }
-            except:
+                self._callbacks[kind](key)
+            except Exception as e:
+                logger.error(f"处理到期条目 {kind}:{key} 出错: {str(e)}")
+        self.expired += fired
+        return fired
+
+    async def _run(self):
+        while True:
+            self.fire_due()
+            timeout = max(0.0, self._heap[0][0] - time.time()) if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
                 pass
-                        
-        except Exception as e:
-            logger.debug(f"服务器查询完全失败 {host}:{port}: {str(e)}")
-        
-        return {"online": False, "players": {"online": 0, "max": 0}, "version": "未知"}
 
 class GroupRuleEnforcer:
-    def __init__(self):
+    REPLY_COMMANDS = frozenset({"!blockimg", "!unblockimg"})  # 可以回复消息发送的命令
+
+    def __init__(self, actions=None, store=None, shards: Optional["ShardPool"] = None):
         self.ban_list: Set[int] = set()
         self.violation_records: Dict[int, Dict[str, int]] = {}  # 用户ID: {"count": 违规次数, "last_time": 最后违规时间}
         self.mute_list: Dict[int, datetime] = {}  # 用户ID: 解禁时间
-        self.websocket: Optional[websockets.WebSocketClientProtocol] = None
         self.running = True
-        self.ws_lock = asyncio.Lock()  # WebSocket操作锁，解决并发问题
+        self._stopped = asyncio.Event()
+        self.connections = ConnectionPool() if actions is None else None  # 各Napcat账号的连接（工作进程里没有）
+        self.actions = actions or self.connections  # 按echo复用连接的API客户端（工作进程里经主进程代发）
+        self.codec = EventCodec(ENABLED_GROUPS)  # 帧解码与预过滤
+        accounts = len(self.connections) if self.connections is not None else 1  # 限速按账号数放大
+        self.outbound = ActionScheduler(  # 限速、按优先级发送动作
+            self.actions.call,
+            global_rate=ACTION_RATE_GLOBAL * accounts, global_burst=ACTION_BURST_GLOBAL * accounts,
+            group_rate=ACTION_RATE_PER_GROUP * accounts, group_burst=ACTION_BURST_PER_GROUP * accounts,
+        )
+        self.dispatcher = EventDispatcher(self.handle_event)  # 按群分片的事件处理队列
+        self.member_cache = MemberCache()  # 群成员角色缓存
+        self.recent_messages = RecentMessageIndex()  # 各用户最近的消息ID，供批量撤回
+        self.ledger = EnforcementLedger()  # 防止对已封禁/禁言用户重复执行同一处罚
+        self.pipeline = ModerationPipeline()  # 审核判断，与影子模式、离线回放共用
+        self.rules = self.pipeline.rules
+        self.flood = self.pipeline.flood
+        self.waves = self.pipeline.waves
+        self.images = self.pipeline.images
+        self.shadow_rules = RuleMatcher(SHADOW_RULE_TIERS) if SHADOW_RULE_TIERS else None  # 候选规则，只记录不执行
+        self.capture = EventCapture(CAPTURE_DIR) if CAPTURE_DIR else None  # 录制消息事件供离线回放
         self.commands = {
             "!help": self.show_help,
             "!status": self.show_status,
@@ -161,7 +2874,10 @@ class GroupRuleEnforcer:
             "!unmute": self.admin_unmute,
             "!ban": self.admin_ban,
             "!unban": self.admin_unban,
-            "!mcstatus": self.check_mc_status  # 新增：MC服务器状态命令
+            "!mcstatus": self.check_mc_status,  # 新增：MC服务器状态命令
+            "!blockimg": self.admin_block_image,
+            "!unblockimg": self.admin_unblock_image,
+            "!purge": self.admin_purge,
         }
         # 新增：点赞冷却时间存储（用户ID: 上次点赞时间）
         self.like_cooldowns: Dict[int, datetime] = {}
@@ -170,50 +2886,188 @@ class GroupRuleEnforcer:
         self.server_status: Dict[str, bool] = {}  # 服务器名称: 是否在线
         self.server_retry_count: Dict[str, int] = {}  # 服务器名称: 重试次数
         self.monitor_task = None  # 服务器监控任务
+        self.mc_status = MinecraftServerStatus()  # 共享HTTP会话的服务器状态查询
+        self.status_cache = ServerStatusCache(self._reliable_server_query, MC_SERVERS)  # 监控与命令共用的状态缓存
+        
+        self.temp_bans: Dict[int, datetime] = {}  # 用户ID: 黑名单到期时间（三级违禁词）
+        
+        # 新增：所有有时限的状态（禁言、黑名单、点赞冷却）由到期调度器统一清理
+        self.expiry = ExpiryScheduler()
+        self.expiry.register(ModerationStore.MUTE, self._expire_mute)
+        self.expiry.register(ModerationStore.TEMP_BAN, self._expire_temp_ban)
+        self.expiry.register(ModerationStore.LIKE, self._expire_like_cooldown)
+        
+        # 新增：封禁、禁言、违规记录与点赞冷却持久化，重启后恢复
+        self.store = store or ModerationStore()  # 工作进程里为 SharedStateClient
+        self.shards = shards  # 多进程模式的主进程：事件转给工作进程处理
+        self._load_state()
 
-    async def connect(self):
-        """连接到WebSocket服务器"""
-        try:
-            headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
-            self.websocket = await websockets.connect(
-                WS_URL,
-                extra_headers=headers,
-                ping_interval=30,
-                ping_timeout=30,
-                close_timeout=10
-            )
-            logger.info("✅ WebSocket连接成功")
-            
-            # 订阅必要事件
-            await self._send_ws({
-                "action": "set_websocket_event",
-                "params": {
-                    "message": True,
-                    "notice": True,
-                    "request": True
-                }
-            })
-            
-            # 启动服务器状态监控
-            self.monitor_task = asyncio.create_task(self.monitor_servers())
-            
-            return True
-        except Exception as e:
-            logger.error(f"❌ 连接失败: {str(e)}")
-            return False
+        # 新增：运行指标（可选的本机Prometheus接口）
+        self.metrics_server = MetricsServer(metrics)
+        self._register_metrics()
+
+    def _load_state(self):
+        """从数据库恢复管理状态"""
+        for kind, rows in self.store.load().items():
+            for user_id, row in rows.items():
+                self._apply_state(kind, user_id, row)
+        logger.info(f"已恢复状态: 封禁{len(self.ban_list)}人, 黑名单{len(self.temp_bans)}人, 禁言{len(self.mute_list)}人, "
+                    f"违规记录{len(self.violation_records)}条, 点赞冷却{len(self.like_cooldowns)}条, "
+                    f"图片黑名单{len(self.images) if self.images is not None else 0}条")
+
+    def _apply_state(self, kind: str, user_id: int, row: Optional[Tuple[float, int]]):
+        """把一条存储格式的状态 (值, 计数) 应用到内存，row 为None表示删除（恢复状态和多进程同步共用）"""
+        if kind == ModerationStore.BAN:
+            if row is None:
+                self.ban_list.discard(user_id)
+                self.ledger.forget(user_id)
+            else:
+                self.ban_list.add(user_id)
+        elif kind == ModerationStore.VIOLATION:
+            if row is None:
+                self.violation_records.pop(user_id, None)
+            else:
+                self.violation_records[user_id] = {"count": row[1], "last_time": datetime.fromtimestamp(row[0])}
+        elif kind == ModerationStore.IMAGE:
+            if self.images is None:
+                return
+            if row is None:
+                self.images.blocked.discard(user_id)
+            else:
+                self.images.blocked.add(user_id)
+        else:
+            records = {
+                ModerationStore.MUTE: self.mute_list,
+                ModerationStore.TEMP_BAN: self.temp_bans,
+                ModerationStore.LIKE: self.like_cooldowns,
+            }.get(kind)
+            if records is None:
+                return
+            if row is None:
+                records.pop(user_id, None)
+                self.expiry.cancel(kind, user_id)
+                if kind != ModerationStore.LIKE:
+                    self.ledger.forget(user_id)
+                return
+            records[user_id] = datetime.fromtimestamp(row[0])
+            deadline = row[0] + LIKE_COOLDOWN_HOURS * 3600 if kind == ModerationStore.LIKE else row[0]
+            self.expiry.schedule(kind, user_id, deadline)
+
+    def _state_snapshot(self) -> Dict[str, Dict[int, Tuple[float, int]]]:
+        """当前内存状态，格式同 ModerationStore.load()"""
+        return {
+            ModerationStore.BAN: {user_id: (0, 0) for user_id in self.ban_list},
+            ModerationStore.MUTE: {user_id: (until.timestamp(), 0) for user_id, until in self.mute_list.items()},
+            ModerationStore.VIOLATION: {
+                user_id: (record["last_time"].timestamp(), record["count"])
+                for user_id, record in self.violation_records.items()
+            },
+            ModerationStore.LIKE: {user_id: (liked_at.timestamp(), 0) for user_id, liked_at in self.like_cooldowns.items()},
+            ModerationStore.TEMP_BAN: {user_id: (until.timestamp(), 0) for user_id, until in self.temp_bans.items()},
+            ModerationStore.IMAGE: {digest: (0, 0) for digest in (self.images.blocked if self.images is not None else ())},
+        }
+
+    def _register_metrics(self):
+        """把各组件已有的计数与队列深度登记为指标，抓取时才读取"""
+        metrics.register("bot_frames_decoded_total", lambda: self.codec.decoded, "counter")
+        metrics.register("bot_frames_filtered_total", lambda: self.codec.filtered, "counter")
+        metrics.register("bot_event_queue_depth", lambda: self.dispatcher.depth)
+        metrics.register("bot_events_processed_total", lambda: self.dispatcher.processed, "counter")
+        metrics.register("bot_events_dropped_total", lambda: self.dispatcher.dropped, "counter")
+        metrics.register("bot_action_queue_depth", lambda: self.outbound.depth)
+        metrics.register("bot_actions_in_flight", lambda: self.actions.in_flight)
+        metrics.register("bot_actions_sent_total", lambda: self.outbound.sent, "counter")
+        metrics.register("bot_notices_merged_total", lambda: self.outbound.merged_notices, "counter")
+        metrics.register("bot_member_cache_hits_total", lambda: self.member_cache.hits, "counter")
+        metrics.register("bot_member_cache_misses_total", lambda: self.member_cache.misses, "counter")
+        metrics.register("bot_enforcements_collapsed_total", lambda: self.ledger.collapsed, "counter")
+        metrics.register("bot_enforcements_suppressed_total", lambda: self.ledger.suppressed, "counter")
+        metrics.register("bot_expiry_pending", lambda: len(self.expiry))
+        if self.pipeline.normalizer is not None:
+            metrics.register("bot_normalize_cache_hits_total", lambda: self.pipeline.normalizer.hits, "counter")
+            metrics.register("bot_normalize_cache_misses_total", lambda: self.pipeline.normalizer.misses, "counter")
+        metrics.register("bot_expired_total", lambda: self.expiry.expired, "counter")
+        if self.waves is not None:
+            metrics.register("bot_waves_total", lambda: self.waves.waves, "counter")
+        if self.images is not None:
+            metrics.register("bot_image_blocklist_size", lambda: len(self.images))
+        if self.connections is not None:
+            metrics.register("bot_connections_ready", lambda: self.connections.ready)
+            metrics.register("bot_action_failovers_total", lambda: self.connections.failovers, "counter")
+            metrics.register("bot_events_duplicate_total", lambda: self.connections.dedup.duplicates, "counter")
+            metrics.register("bot_reconnects_total", lambda: self.connections.reconnects, "counter")
+            metrics.register("bot_outbox_depth", lambda: len(self.connections.outbox))
+            metrics.register("bot_outbox_replayed_total", lambda: self.connections.replayed, "counter")
+            metrics.register("bot_outbox_dropped_total", lambda: self.connections.outbox_dropped, "counter")
+        if self.capture is not None:
+            metrics.register("bot_events_captured_total", lambda: self.capture.captured, "counter")
+        if self.shards is not None:
+            metrics.register("bot_shard_events_forwarded_total", lambda: self.shards.forwarded, "counter")
+            metrics.register("bot_shard_events_dropped_total", lambda: self.shards.dropped, "counter")
+            metrics.register("bot_shard_events_processed_total", lambda: self.shards.stats().get("processed", 0), "counter")
+            metrics.register("bot_shard_event_queue_depth", lambda: self.shards.stats().get("depth", 0))
 
-    async def handle_message(self, event: Dict):
+    def _expire_mute(self, user_id: int):
+        """禁言记录到期"""
+        self.mute_list.pop(user_id, None)
+        self.store.delete(ModerationStore.MUTE, user_id)
+
+    def _expire_temp_ban(self, user_id: int):
+        """黑名单到期"""
+        self.temp_bans.pop(user_id, None)
+        self.store.delete(ModerationStore.TEMP_BAN, user_id)
+        logger.info(f"用户{user_id}的黑名单已到期")
+
+    def _expire_like_cooldown(self, user_id: int):
+        """点赞冷却到期"""
+        self.like_cooldowns.pop(user_id, None)
+        self.store.delete(ModerationStore.LIKE, user_id)
+
+    async def handle_event(self, event):
+        """分发器入口：消息事件为MessageEvent，通知事件为原始字典"""
+        if isinstance(event, MessageEvent):
+            await self.handle_message(event)
+        else:
+            await self.handle_notice(event)
+
+    async def handle_notice(self, event: Dict):
+        """处理通知事件：根据成员变动更新成员缓存"""
+        notice_type = event.get("notice_type")
+        group_id = event.get("group_id")
+        user_id = event.get("user_id")
+        if group_id not in ENABLED_GROUPS:
+            return
+
+        if notice_type == "group_admin":
+            # 设置/取消管理员
+            role = "admin" if event.get("sub_type") == "set" else "member"
+            self.member_cache.update_role(group_id, user_id, role)
+            logger.info(f"群{group_id} 成员{user_id} 角色变为 {role}")
+        elif notice_type == "group_decrease":
+            if user_id == event.get("self_id"):
+                # 机器人自己离开了群
+                self.member_cache.invalidate(group_id)
+            else:
+                self.member_cache.invalidate(group_id, user_id)
+        elif notice_type == "group_increase":
+            self.member_cache.invalidate(group_id, user_id)
+
+    async def handle_message(self, event: MessageEvent):
         try:
-            message_type = event.get("message_type")
-            group_id = event.get("group_id")
+            message_type = event.message_type
+            group_id = event.group_id
             
             # 检查是否在启用的群组中
             if group_id not in ENABLED_GROUPS:
                 return
 
-            user_id = event.get("user_id")
-            raw_message = event.get("raw_message", "").strip()
-            message_id = event.get("message_id")
+            user_id = event.user_id
+            raw_message = event.raw_message.strip()
+            message_id = event.message_id
+
+            sender_role = event.sender_role
+            if message_type == "group" and event.has_role:
+                self.member_cache.update_role(group_id, user_id, sender_role)
 
             # 新增：处理点赞请求（放在其他命令处理前面）
             if raw_message == "赞我":
@@ -229,43 +3083,52 @@ class GroupRuleEnforcer:
             if raw_message.startswith("!"):
                 await self.handle_command(event)
                 return
+
+            # 回复某条消息发送的管理命令（如回复图片消息发送 !blockimg），消息以回复和@的CQ码开头
+            if (raw_message.startswith("[CQ:reply,") and sender_role in ["owner", "admin"]
+                    and self.pipeline.parse(event).text.startswith("!")):
+                await self.handle_command(event)
+                return
                 
             if message_type != "group":
                 return
 
-            sender = event.get("sender", {})
-            sender_role = sender.get("role", "member")
-
             # 跳过管理人员的消息处理
             if sender_role in ["owner", "admin"]:
                 return
 
+            # 记录最近的消息ID，供批量撤回
+            self.recent_messages.record(group_id, user_id, message_id)
+
+            # 影子模式：只记录判断结果，不执行任何处罚
+            if SHADOW_MODE:
+                self._shadow_decide(event)
+                return
+
             # 检查用户是否在封禁/禁言列表中
             if await self.check_user_status(user_id, group_id):
                 return
 
-            # 预处理消息：移除CQ码（表情、图片等）
-            processed_message = self._process_message(raw_message)
-            
-            # 违禁词检测
-            await self.check_violation_words(group_id, user_id, processed_message, raw_message, message_id)
+            # 预处理消息：切分CQ码（表情、图片等），得到纯文字
+            started = metrics.clock()
+            processed_message = self.pipeline.parse(event).text
+            metrics.observe_since("bot_check_seconds", started, check="process_message")
             
-            # 广告检测
-            await self.check_advertisement(group_id, user_id, processed_message, raw_message, message_id)
+            # 违禁词与广告检测（单次扫描）
+            hit = await self.check_violation_words(group_id, user_id, processed_message, raw_message, message_id)
+
+            # 图片黑名单检测与重复图片记录（只查内存）
+            handled = await self.check_images(event, handled=hit is not None)
             
             # 刷屏检测
             await self.check_flood(user_id, group_id, raw_message, message_id)
 
+            # 跨用户重复内容检测（已按违禁词或图片处理的这条消息不再重复处理）
+            await self.check_wave(event, processed_message, handled=handled)
+
         except Exception as e:
             logger.error(f"处理消息时出错: {str(e)}")
 
-    def _process_message(self, message: str) -> str:
-        """预处理消息：移除CQ码，清理内容用于检测"""
-        # 移除所有CQ码
-        cleaned = CQ_PATTERN.sub('', message)
-        # 移除多余空白
-        return re.sub(r'\s+', ' ', cleaned).strip()
-
     # 新增：处理点赞请求
     async def handle_like_request(self, group_id: int, user_id: int):
         """处理用户的点赞请求"""
@@ -285,6 +3148,8 @@ class GroupRuleEnforcer:
             if success:
                 # 更新冷却时间
                 self.like_cooldowns[user_id] = now
+                self.store.save(ModerationStore.LIKE, user_id, now.timestamp())
+                self.expiry.schedule(ModerationStore.LIKE, user_id, now.timestamp() + LIKE_COOLDOWN_HOURS * 3600)
                 await self.send_notice(group_id, f"👍 已为用户{user_id}送上{LIKE_COUNT}个赞！")
                 logger.info(f"已为用户{user_id}点赞{LIKE_COUNT}次")
             else:
@@ -295,7 +3160,6 @@ class GroupRuleEnforcer:
             await self.send_notice(group_id, "❌ 点赞过程中出现错误")
 
     # 新增：发送点赞
-    @websocket_lock
     async def send_likes(self, user_id: int, count: int) -> bool:
         """通过WebSocket发送点赞"""
         try:
@@ -333,9 +3197,12 @@ class GroupRuleEnforcer:
         except Exception as e:
             logger.error(f"启动睡觉模式失败: {str(e)}")
 
-    @websocket_lock
     async def get_group_member_info(self, group_id: int, user_id: int) -> Dict:
-        """获取群成员信息"""
+        """获取群成员信息（优先读缓存）"""
+        cached = self.member_cache.get(group_id, user_id)
+        if cached is not None:
+            return cached
+
         payload = {
             "action": "get_group_member_info",
             "params": {
@@ -345,21 +3212,27 @@ class GroupRuleEnforcer:
             }
         }
         response = await self._send_ws(payload)
-        return response.get("data", {})
+        info = response.get("data") or {}
+        if info:
+            self.member_cache.put(group_id, user_id, info)
+        return info
 
-    async def handle_command(self, event: Dict):
-        """处理管理命令"""
+    async def handle_command(self, event: MessageEvent):
+        """处理管理命令（回复消息发送的命令，被回复的消息ID作为第一个参数）"""
         try:
-            message = event.get("raw_message", "").strip()
-            user_id = event.get("user_id")
-            group_id = event.get("group_id")
+            message = event.raw_message.strip()
+            reply = None
+            if message.startswith("[CQ:"):
+                parsed = self.pipeline.parse(event)
+                message, reply = parsed.text, parsed.reply
+            user_id = event.user_id
+            group_id = event.group_id
             
             # 检查是否在启用的群组中
             if group_id not in ENABLED_GROUPS:
                 return
 
-            sender = event.get("sender", {})
-            sender_role = sender.get("role", "member")
+            sender_role = event.sender_role
 
             # 只有管理员可以使用命令
             if sender_role not in ["owner", "admin"]:
@@ -367,9 +3240,12 @@ class GroupRuleEnforcer:
 
             parts = message.split()
             cmd = parts[0].lower()
+            args = parts[1:]
+            if reply is not None and cmd in self.REPLY_COMMANDS:
+                args = [reply] + args
             
             if cmd in self.commands:
-                await self.commands[cmd](group_id, user_id, parts[1:])
+                await self.commands[cmd](group_id, user_id, args)
                 
         except Exception as e:
             logger.error(f"处理命令时出错: {str(e)}")
@@ -381,13 +3257,15 @@ class GroupRuleEnforcer:
             if not args:
                 # 如果没有指定服务器，显示所有服务器状态
                 status_messages = []
-                for server_name, server_config in MC_SERVERS.items():
-                    # 使用更可靠的查询方法
-                    status_data = await self._reliable_server_query(server_config["host"], server_config["port"])
+                # 所有服务器并发读取（缓存未过期时不会发起查询）
+                results = await asyncio.gather(*(self.status_cache.get(name) for name in MC_SERVERS))
+                for (server_name, server_config), status_data in zip(MC_SERVERS.items(), results):
                     status_emoji = "🟢" if status_data["online"] else "🔴"
                     status_text = f"{status_emoji} {server_name}: {server_config['host']}"
                     if status_data["online"]:
                         status_text += f"\n  玩家: {status_data['players']['online']}/{status_data['players']['max']} | 版本: {status_data['version']}"
+                        if status_data.get('latency') is not None:
+                            status_text += f" | 延迟: {status_data['latency']}ms"
                     else:
                         status_text += " | 离线"
                     status_messages.append(status_text)
@@ -402,14 +3280,15 @@ class GroupRuleEnforcer:
                 return
                 
             server_config = MC_SERVERS[server_name]
-            # 使用更可靠的查询方法
-            status_data = await self._reliable_server_query(server_config["host"], server_config["port"])
+            status_data = await self.status_cache.get(server_name)
             
             if status_data["online"]:
                 status_msg = (f"🟢 {server_name} 服务器在线\n"
                              f"• 地址: {server_config['host']}:{server_config['port']}\n"
                              f"• 玩家: {status_data['players']['online']}/{status_data['players']['max']}\n"
                              f"• 版本: {status_data['version']}")
+                if status_data.get('latency') is not None:
+                    status_msg += f"\n• 延迟: {status_data['latency']}ms"
                 if status_data.get('motd'):
                     status_msg += f"\n• MOTD: {status_data['motd']}"
             else:
@@ -428,7 +3307,7 @@ class GroupRuleEnforcer:
         max_retries = 3
         for attempt in range(max_retries):
             try:
-                result = await MinecraftServerStatus.query_server(host, port)
+                result = await self.mc_status.query_server(host, port)
                 logger.info(f"服务器 {host}:{port} 查询结果: {'在线' if result['online'] else '离线'} (尝试 {attempt + 1})")
                 return result
             except Exception as e:
@@ -441,62 +3320,66 @@ class GroupRuleEnforcer:
 
     # 新增：监控服务器状态
     async def monitor_servers(self):
-        """监控所有Minecraft服务器状态"""
+        """监控所有Minecraft服务器状态：每台服务器独立调度、并发检查"""
         # 初始状态设为在线，避免启动时误报
         for server_name in MC_SERVERS.keys():
             self.server_status[server_name] = True
             self.server_retry_count[server_name] = 0
         
         logger.info("🔄 开始监控Minecraft服务器状态")
+        await asyncio.gather(*(self._monitor_server(server_name) for server_name in MC_SERVERS))
+
+    async def _monitor_server(self, server_name: str):
+        """按该服务器自己的间隔循环检查，检查时间加随机抖动错开"""
+        interval = MC_SERVERS[server_name].get("interval", SERVER_CHECK_INTERVAL)
+        await asyncio.sleep(random.uniform(0, SERVER_CHECK_JITTER))
         
         while self.running:
             try:
-                for server_name, server_config in MC_SERVERS.items():
-                    # 使用更可靠的查询方法
-                    status_data = await self._reliable_server_query(server_config["host"], server_config["port"])
-                    is_online = status_data["online"]
-                    previous_status = self.server_status.get(server_name, True)
-                    
-                    logger.info(f"服务器 {server_name} 状态: {'在线' if is_online else '离线'} (之前: {'在线' if previous_status else '离线'})")
-                    
-                    # 如果状态变化
-                    if is_online != previous_status:
-                        if not is_online:
-                            # 服务器离线，增加重试计数
-                            retry_count = self.server_retry_count.get(server_name, 0) + 1
-                            self.server_retry_count[server_name] = retry_count
-                            
-                            logger.info(f"服务器 {server_name} 离线检测 #{retry_count}")
-                            
-                            # 只有多次检测到离线才认为是真的离线
-                            if retry_count >= SERVER_CHECK_RETRY:
-                                self.server_status[server_name] = False
-                                await self.notify_server_status(server_name, False)
-                        else:
-                            # 服务器恢复在线
-                            self.server_status[server_name] = True
-                            self.server_retry_count[server_name] = 0
-                            await self.notify_server_status(server_name, True)
+                status_data = await self.status_cache.refresh(server_name)
+                is_online = status_data["online"]
+                previous_status = self.server_status.get(server_name, True)
+                
+                logger.info(f"服务器 {server_name} 状态: {'在线' if is_online else '离线'} (之前: {'在线' if previous_status else '离线'})")
+                
+                # 如果状态变化
+                if is_online != previous_status:
+                    if not is_online:
+                        # 服务器离线，增加重试计数
+                        retry_count = self.server_retry_count.get(server_name, 0) + 1
+                        self.server_retry_count[server_name] = retry_count
+                        
+                        logger.info(f"服务器 {server_name} 离线检测 #{retry_count}")
+                        
+                        # 只有多次检测到离线才认为是真的离线
+                        if retry_count >= SERVER_CHECK_RETRY:
+                            self.server_status[server_name] = False
+                            await self.notify_server_status(server_name, False)
                     else:
-                        # 状态未变化，重置重试计数
+                        # 服务器恢复在线
+                        self.server_status[server_name] = True
                         self.server_retry_count[server_name] = 0
-                
-                # 等待下一次检查
-                logger.debug(f"等待 {SERVER_CHECK_INTERVAL} 秒后进行下一次服务器检查")
-                await asyncio.sleep(SERVER_CHECK_INTERVAL)
+                        await self.notify_server_status(server_name, True, status_data)
+                else:
+                    # 状态未变化，重置重试计数
+                    self.server_retry_count[server_name] = 0
                 
             except Exception as e:
-                logger.error(f"服务器监控出错: {str(e)}")
-                await asyncio.sleep(SERVER_CHECK_INTERVAL)
+                logger.error(f"服务器 {server_name} 监控出错: {str(e)}")
+            
+            # 等待下一次检查
+            delay = max(1.0, interval + random.uniform(-SERVER_CHECK_JITTER, SERVER_CHECK_JITTER))
+            logger.debug("服务器 %s 等待 %.0f 秒后进行下一次检查", server_name, delay)
+            await asyncio.sleep(delay)
 
     # 新增：通知服务器状态变化
-    async def notify_server_status(self, server_name: str, is_online: bool):
-        """通知服务器状态变化"""
+    async def notify_server_status(self, server_name: str, is_online: bool, status_data: Optional[dict] = None):
+        """通知服务器状态变化（恢复在线时优先使用刚检查到的结果）"""
         try:
             server_config = MC_SERVERS[server_name]
             if is_online:
-                # 获取详细的服务器信息
-                status_data = await self._reliable_server_query(server_config["host"], server_config["port"])
+                if status_data is None:
+                    status_data = await self.status_cache.get(server_name)
                 message = (f"[🟢Online]服务器 {server_name} 已恢复在线\n"
                           f"• 地址: {server_config['host']}:{server_config['port']}\n"
                           f"• 玩家: {status_data['players']['online']}/{status_data['players']['max']}")
@@ -505,76 +3388,146 @@ class GroupRuleEnforcer:
                           f"• 地址: {server_config['host']}:{server_config['port']}\n"
                           f"• 已尝试检测 {SERVER_CHECK_RETRY} 次确认")
             
-            # 在所有启用的群组中发送通知
-            for group_id in ENABLED_GROUPS:
-                await self.send_notice(group_id, message)
+            # 在所有启用的群组中并发发送通知
+            await asyncio.gather(*(self.send_notice(group_id, message) for group_id in ENABLED_GROUPS),
+                                 return_exceptions=True)
                 
             logger.info(f"服务器状态通知: {server_name} {'在线' if is_online else '离线'}")
         except Exception as e:
             logger.error(f"发送服务器状态通知失败: {str(e)}")
 
-    async def check_violation_words(self, group_id: int, user_id: int, processed_msg: str, raw_msg: str, message_id: int):
-        """违禁词检测"""
-        if not processed_msg:  # 空消息不检测
-            return
-            
-        # 三级处罚检测（0容忍词汇）
-        if any(re.search(word, processed_msg) for word in LEVEL_3_WORDS):
-            logger.warning(f"检测到三级违禁词: 用户{user_id} 消息: {raw_msg[:50]}...")
+    async def check_violation_words(self, group_id: int, user_id: int, processed_msg: str, raw_msg: str,
+                                    message_id: int) -> Optional[Tuple[str, str]]:
+        """违禁词与广告检测：一次扫描得到最严重的命中，只执行对应的一种处罚，返回命中的 (级别, 规则)"""
+        if not processed_msg:  # 空消息不检测（纯动画表情过滤后也为空）
+            return None
+
+        started = metrics.clock()
+        hit = self.pipeline.match(processed_msg)
+        metrics.observe_since("bot_check_seconds", started, check="violation_words")
+        if self.shadow_rules is not None:
+            self._compare_shadow_rules(group_id, user_id, message_id, processed_msg, raw_msg, hit)
+        if hit is None:
+            return None
+
+        tier, pattern = hit
+        metrics.inc("bot_rule_hits_total", tier=tier)
+        # 归一化后才命中的（如 "k u k e"），记录原文中对应的片段
+        span = self.pipeline.locate(processed_msg, pattern)
+        matched = processed_msg[span[0]:span[1]] if span is not None else None
+        audit("rule_hit", group_id=group_id, user_id=user_id, message_id=message_id, tier=tier, rule=pattern,
+              matched=matched, span=list(span) if span is not None else None, message=raw_msg[:200])
+        if tier == "level_3":
+            logger.warning("检测到三级违禁词: 用户%s 命中: %s 消息: %s...", user_id, matched, raw_msg[:50])
             await self.enforce_level_3(group_id, user_id, raw_msg, message_id)
-            return
-        
-        # 二级处罚检测
-        if any(re.search(word, processed_msg) for word in LEVEL_2_WORDS):
-            logger.warning(f"检测到二级违禁词: 用户{user_id} 消息: {raw_msg[:50]}...")
+        elif tier == "level_2":
+            logger.warning("检测到二级违禁词: 用户%s 命中: %s 消息: %s...", user_id, matched, raw_msg[:50])
             await self.enforce_level_2(group_id, user_id, message_id)
-            return
-
-        # 一级处罚检测
-        if any(re.search(word, processed_msg) for word in LEVEL_1_WORDS):
-            logger.warning(f"检测到一级违禁词: 用户{user_id} 消息: {raw_msg[:50]}...")
+        elif tier == "ad":
+            logger.warning("检测到广告: 用户%s 命中: %s 消息: %s...", user_id, matched, raw_msg[:50])
+            await self.enforce_advertisement(group_id, user_id, message_id)
+        else:
+            logger.warning("检测到一级违禁词: 用户%s 命中: %s 消息: %s...", user_id, matched, raw_msg[:50])
             await self.enforce_level_1(group_id, user_id, message_id)
+        return hit
 
-    async def check_advertisement(self, group_id: int, user_id: int, processed_msg: str, raw_msg: str, message_id: int):
-        """广告检测"""
-        # 检查是否是纯动画表情消息
-        if ANIMATION_EMOJI_PATTERN.fullmatch(raw_msg.strip()):
-            return  # 纯动画表情不检测广告
-            
-        # 空消息（过滤后为空）不检测广告
-        if not processed_msg:
+    def _compare_shadow_rules(self, group_id: int, user_id: int, message_id: int, processed_msg: str, raw_msg: str,
+                              hit: Optional[Tuple[str, str]]):
+        """按候选规则再判断一次，结果与现行规则不同时记录下来"""
+        candidate = self.shadow_rules.match(self.pipeline.normalize(processed_msg))
+        if candidate == hit:
             return
-            
-        if any(re.search(pattern, processed_msg) for pattern in AD_PATTERNS):
-            logger.warning(f"检测到广告: 用户{user_id} 消息: {raw_msg[:50]}...")
-            await self.enforce_advertisement(group_id, user_id, message_id)
+        logger.info(f"[影子规则] 用户{user_id} 现行: {hit[0] if hit else '无'} 候选: "
+                    f"{candidate[0] if candidate else '无'} 消息: {raw_msg[:50]}")
+        audit("shadow_diff", group_id=group_id, user_id=user_id, message_id=message_id,
+              live=list(hit) if hit else None, candidate=list(candidate) if candidate else None, message=raw_msg[:200])
+
+    def _shadow_decide(self, event: MessageEvent):
+        """影子模式：判断消息本应触发的处罚，只写日志和审计"""
+        text = self.pipeline.parse(event).text
+        decisions = self.pipeline.decide(event, text=text)
+        if self.shadow_rules is not None:
+            hit = next((decision for decision in decisions if decision[0] not in self.pipeline.NON_TEXT_TIERS), None)
+            self._compare_shadow_rules(event.group_id, event.user_id, event.message_id, text, event.raw_message, hit)
+        for tier, rule in decisions:
+            logger.info(f"[影子模式] 用户{event.user_id} 将触发 {tier}（{rule}）: {event.raw_message[:50]}")
+            audit("shadow", group_id=event.group_id, user_id=event.user_id, message_id=event.message_id,
+                  tier=tier, rule=rule, message=event.raw_message[:200])
 
     async def check_flood(self, user_id: int, group_id: int, message: str, message_id: int):
         """刷屏检测"""
-        now = datetime.now()
-        record = self.violation_records.setdefault(user_id, {"count": 0, "last_time": now, "messages": []})
-        
-        # 记录最近5条消息
-        record["messages"] = record.get("messages", [])[-4:] + [now]
-        
-        # 5秒内发送超过3条消息视为刷屏
-        if len(record["messages"]) >= 3 and (now - record["messages"][0]).total_seconds() < 5:
-            logger.warning(f"检测到刷屏: 用户{user_id}")
+        started = metrics.clock()
+        flooded = self.flood.hit(group_id, user_id)
+        metrics.observe_since("bot_check_seconds", started, check="flood")
+        if flooded:
+            metrics.inc("bot_rule_hits_total", tier="flood")
+            logger.warning("检测到刷屏: 用户%s", user_id)
             await self.enforce_flood(group_id, user_id, message_id)
 
+    async def check_images(self, event: MessageEvent, handled: bool = False) -> bool:
+        """图片检测：含黑名单图片的消息按广告处理；同一张图片被多人重复发送时只写日志和审计
+
+        返回这条消息是否已被处理（包括调用前已按违禁词处理的）。
+        """
+        started = metrics.clock()
+        blocked, targets = self.pipeline.check_images(event)
+        metrics.observe_since("bot_check_seconds", started, check="images")
+        group_id, user_id, message_id = event.group_id, event.user_id, event.message_id
+        if blocked and not handled:
+            metrics.inc("bot_rule_hits_total", tier="image")
+            logger.warning("检测到黑名单图片: 用户%s 消息: %s...", user_id, event.raw_message[:50])
+            audit("rule_hit", group_id=group_id, user_id=user_id, message_id=message_id, tier="image",
+                  rule="blocked", message=event.raw_message[:200])
+            await self.enforce_advertisement(group_id, user_id, message_id)
+            handled = True
+        if targets and not blocked:
+            users = sorted({target[0] for target in targets})
+            logger.info("[仅记录] 检测到重复图片（多个用户发送同一张图片）: 用户%s 消息ID%s，是广告时回复发送 !blockimg",
+                        users, [target[1] for target in targets])
+            audit("image_repeat", group_id=group_id, users=users, message_ids=[target[1] for target in targets])
+        return handled
+
+    async def check_wave(self, event: MessageEvent, processed_msg: str, handled: bool = False):
+        """跨用户重复内容检测：同一波的所有发送者一并按广告处理（WAVE_ENFORCE 关闭时只记录）"""
+        started = metrics.clock()
+        targets = self.pipeline.wave(event, processed_msg)
+        metrics.observe_since("bot_check_seconds", started, check="wave")
+        if handled:
+            targets = [target for target in targets if target[1] != event.message_id]
+        if not targets:
+            return
+        group_id = event.group_id
+        users = sorted({user_id for user_id, _ in targets})
+        metrics.inc("bot_rule_hits_total", len(targets), tier="wave")
+        if not self.pipeline.wave_enforce:
+            logger.info("[仅记录] 检测到刷屏潮（多个用户发送相同或相近的内容）: 用户%s 消息: %s...",
+                        users, event.raw_message[:50])
+            audit("wave_log", group_id=group_id, users=users, message_ids=[message_id for _, message_id in targets],
+                  message=event.raw_message[:200])
+            return
+        logger.warning("检测到刷屏潮（多个用户发送相同或相近的内容）: 处理用户%s 消息: %s...",
+                       users, event.raw_message[:50])
+        audit("wave", group_id=group_id, users=users, message_ids=[message_id for _, message_id in targets],
+              message=event.raw_message[:200])
+        await asyncio.gather(*(self.enforce_advertisement(group_id, user_id, message_id)
+                               for user_id, message_id in targets))
+
     async def enforce_level_3(self, group_id: int, user_id: int, message: str, message_id: int):
-        """三级处罚：撤回+踢出+拉黑"""
+        """三级处罚：撤回+踢出+拉黑（开启 PURGE_ON_PUNISH 时同时撤回之前的消息）"""
         try:
             tasks = [
-                self.delete_message(message_id),
+                self.delete_message(group_id, message_id),
                 self.kick_user(group_id, user_id),
-                self.ban_user(group_id, user_id, 30*24*60*60)  # 30天黑名单
+                self.ban_user(group_id, user_id, LEVEL_3_BLACKLIST_DAYS*24*60*60),
+                self._purge_on_punish(group_id, user_id, message_id),
             ]
             await asyncio.gather(*tasks, return_exceptions=True)
+            self._add_temp_ban(user_id, timedelta(days=LEVEL_3_BLACKLIST_DAYS))
             
             notice = f"🚨 三级处罚执行\n• 用户: {user_id}\n• 违禁词: {message[:50]}...\n• 处理方式: 永久移出"
             await self.send_notice(group_id, notice)
             logger.info(f"已执行三级处罚: 用户{user_id}")
+            audit("enforce", action="level_3", group_id=group_id, user_id=user_id, message_id=message_id, duration=LEVEL_3_BLACKLIST_DAYS*24*60*60)
         except Exception as e:
             logger.error(f"执行三级处罚失败: {str(e)}")
 
@@ -582,12 +3535,13 @@ class GroupRuleEnforcer:
         """二级处罚：撤回+禁言1天"""
         try:
             await asyncio.gather(
-                self.delete_message(message_id),
+                self.delete_message(group_id, message_id),
                 self.ban_user(group_id, user_id, 24*60*60),  # 1天禁言
                 return_exceptions=True
             )
             self._record_violation(user_id)
             logger.info(f"已执行二级处罚: 用户{user_id}")
+            audit("enforce", action="level_2", group_id=group_id, user_id=user_id, message_id=message_id, duration=24*60*60)
         except Exception as e:
             logger.error(f"执行二级处罚失败: {str(e)}")
 
@@ -595,25 +3549,28 @@ class GroupRuleEnforcer:
         """一级处罚：撤回+禁言10分钟"""
         try:
             await asyncio.gather(
-                self.delete_message(message_id),
+                self.delete_message(group_id, message_id),
                 self.ban_user(group_id, user_id, 10*60),  # 10分钟禁言
                 return_exceptions=True
             )
             self._record_violation(user_id)
             logger.info(f"已执行一级处罚: 用户{user_id}")
+            audit("enforce", action="level_1", group_id=group_id, user_id=user_id, message_id=message_id, duration=10*60)
         except Exception as e:
             logger.error(f"执行一级处罚失败: {str(e)}")
 
     async def enforce_advertisement(self, group_id: int, user_id: int, message_id: int):
-        """广告处罚：撤回+禁言1小时"""
+        """广告处罚：撤回+禁言1小时（开启 PURGE_ON_PUNISH 时同时撤回之前的消息）"""
         try:
             await asyncio.gather(
-                self.delete_message(message_id),
+                self.delete_message(group_id, message_id),
                 self.ban_user(group_id, user_id, 60*60),  # 1小时禁言
+                self._purge_on_punish(group_id, user_id, message_id),
                 return_exceptions=True
             )
             self._record_violation(user_id)
             logger.info(f"已处理广告: 用户{user_id}")
+            audit("enforce", action="ad", group_id=group_id, user_id=user_id, message_id=message_id, duration=60*60)
         except Exception as e:
             logger.error(f"处理广告失败: {str(e)}")
 
@@ -621,36 +3578,47 @@ class GroupRuleEnforcer:
         """刷屏处罚：撤回+禁言30分钟"""
         try:
             await asyncio.gather(
-                self.delete_message(message_id),
+                self.delete_message(group_id, message_id),
                 self.ban_user(group_id, user_id, 30*60),  # 30分钟禁言
                 return_exceptions=True
             )
             self._record_violation(user_id)
             logger.info(f"已处理刷屏: 用户{user_id}")
+            audit("enforce", action="flood", group_id=group_id, user_id=user_id, message_id=message_id, duration=30*60)
         except Exception as e:
             logger.error(f"处理刷屏失败: {str(e)}")
 
+    def _add_temp_ban(self, user_id: int, duration: timedelta):
+        """加入限时黑名单，到期由调度器移除"""
+        until = datetime.now() + duration
+        self.temp_bans[user_id] = until
+        self.store.save(ModerationStore.TEMP_BAN, user_id, until.timestamp())
+        self.expiry.schedule(ModerationStore.TEMP_BAN, user_id, until.timestamp())
+
     def _record_violation(self, user_id: int):
         """记录违规次数"""
         now = datetime.now()
         record = self.violation_records.setdefault(user_id, {"count": 0, "last_time": now})
         record["count"] += 1
         record["last_time"] = now
+        self.store.save(ModerationStore.VIOLATION, user_id, now.timestamp(), record["count"])
         
         if record["count"] >= 3:  # 累计3次自动升级处罚
             self.ban_list.add(user_id)
+            self.store.save(ModerationStore.BAN, user_id)
+            audit("auto_ban", user_id=user_id, violations=record["count"])
             logger.warning(f"用户{user_id}违规次数已达3次，加入封禁列表")
 
     async def check_user_status(self, user_id: int, group_id: int) -> bool:
-        """检查用户状态（是否被封禁/禁言）"""
-        if user_id in self.ban_list:
-            await self.kick_user(group_id, user_id)
+        """检查用户状态（是否被封禁/禁言），重复的踢人/禁言由台账合并"""
+        if user_id in self.ban_list or user_id in self.temp_bans:
+            await self.ledger.run(group_id, user_id, "kick", lambda: self.kick_user(group_id, user_id))
             return True
             
         if user_id in self.mute_list and datetime.now() < self.mute_list[user_id]:
             remaining = (self.mute_list[user_id] - datetime.now()).total_seconds()
             if remaining > 0:
-                await self.ban_user(group_id, user_id, remaining)
+                await self.ledger.run(group_id, user_id, "mute", lambda: self.ban_user(group_id, user_id, int(remaining)))
                 return True
                 
         return False
@@ -666,6 +3634,9 @@ class GroupRuleEnforcer:
 !ban <用户ID> - 封禁用户
 !unban <用户ID> - 解封用户
 !mcstatus [服务器名] - 查看MC服务器状态
+!blockimg [消息ID] - 回复图片消息发送，图片加入黑名单并撤回
+!unblockimg [消息ID] - 回复图片消息发送，图片移出黑名单
+!purge <用户ID> [条数|分钟m] - 撤回用户最近的消息
 "启动战云睡觉模式" - 禁言目标用户8小时(仅管理)
 "赞我" - 获取10个赞（每天一次）"""
         await self.send_notice(group_id, help_msg)
@@ -683,12 +3654,13 @@ class GroupRuleEnforcer:
         
         if target_id in self.ban_list:
             status.append("🔴 永久封禁")
+        elif target_id in self.temp_bans:
+            remaining = self.temp_bans[target_id] - datetime.now()
+            status.append(f"🟠 黑名单中（剩余{remaining.days}天）")
         elif target_id in self.mute_list:
             remaining = self.mute_list[target_id] - datetime.now()
             if remaining.total_seconds() > 0:
-                status.append(f"🟡 禁言中（剩余{remaining.seconds//60}分钟）")
-            else:
-                del self.mute_list[target_id]
+                status.append(f"🟡 禁言中（剩余{int(remaining.total_seconds())//60}分钟）")
                 
         # 新增：显示点赞冷却状态
         if target_id in self.like_cooldowns:
@@ -717,7 +3689,10 @@ class GroupRuleEnforcer:
         minutes = int(args[1])
         
         await self.ban_user(group_id, target_id, minutes * 60)
+        audit("admin", command="mute", group_id=group_id, operator=user_id, target=target_id, minutes=minutes)
         self.mute_list[target_id] = datetime.now() + timedelta(minutes=minutes)
+        self.store.save(ModerationStore.MUTE, target_id, self.mute_list[target_id].timestamp())
+        self.expiry.schedule(ModerationStore.MUTE, target_id, self.mute_list[target_id].timestamp())
         await self.send_notice(group_id, f"✅ 已禁言用户 {target_id} {minutes}分钟")
 
     # 新增：管理员解除禁言
@@ -731,7 +3706,11 @@ class GroupRuleEnforcer:
         
         if target_id in self.mute_list:
             del self.mute_list[target_id]
+            self.store.delete(ModerationStore.MUTE, target_id)
+            self.expiry.cancel(ModerationStore.MUTE, target_id)
+            self.ledger.forget(target_id)
             await self.ban_user(group_id, target_id, 0)  # 解除禁言
+            audit("admin", command="unmute", group_id=group_id, operator=user_id, target=target_id)
             await self.send_notice(group_id, f"✅ 已解除用户 {target_id} 的禁言")
         else:
             await self.send_notice(group_id, f"⚠️ 用户 {target_id} 未被禁言")
@@ -745,7 +3724,9 @@ class GroupRuleEnforcer:
             
         target_id = int(args[0])
         self.ban_list.add(target_id)
+        self.store.save(ModerationStore.BAN, target_id)
         await self.kick_user(group_id, target_id)
+        audit("admin", command="ban", group_id=group_id, operator=user_id, target=target_id)
         await self.send_notice(group_id, f"✅ 已封禁用户 {target_id}")
 
     # 新增：管理员解封
@@ -757,24 +3738,133 @@ class GroupRuleEnforcer:
             
         target_id = int(args[0])
         
-        if target_id in self.ban_list:
-            self.ban_list.remove(target_id)
+        if target_id in self.ban_list or target_id in self.temp_bans:
+            self.ban_list.discard(target_id)
+            self.temp_bans.pop(target_id, None)
+            self.store.delete(ModerationStore.BAN, target_id)
+            self.store.delete(ModerationStore.TEMP_BAN, target_id)
+            self.expiry.cancel(ModerationStore.TEMP_BAN, target_id)
+            self.ledger.forget(target_id)
+            audit("admin", command="unban", group_id=group_id, operator=user_id, target=target_id)
             await self.send_notice(group_id, f"✅ 已解封用户 {target_id}")
         else:
             await self.send_notice(group_id, f"⚠️ 用户 {target_id} 未被封禁")
 
-    @websocket_lock
-    async def delete_message(self, message_id: int):
-        """撤回消息"""
+    # 新增：批量撤回
+    async def admin_purge(self, group_id: int, user_id: int, args: List[str]):
+        """管理员批量撤回用户最近的消息：!purge <用户ID> [条数|分钟m]，不带范围时撤回记录中的全部"""
+        if not args:
+            await self.send_notice(group_id, "❌ 用法: !purge <用户ID> [条数|分钟m]，如 !purge 123456 20 或 !purge 123456 10m")
+            return
+
+        target_id = int(args[0])
+        count = since = None
+        if len(args) > 1:
+            spec = args[1].lower()
+            for suffix in ("分钟", "min", "m"):
+                if spec.endswith(suffix):
+                    since = time.time() - float(spec[:-len(suffix)]) * 60
+                    break
+            else:
+                count = int(spec)
+        purged = await self.purge_messages(group_id, target_id, count=count, since=since)
+        audit("admin", command="purge", group_id=group_id, operator=user_id, target=target_id, purged=purged)
+        if purged:
+            await self.send_notice(group_id, f"✅ 已撤回用户 {target_id} 的 {purged} 条消息")
+        else:
+            await self.send_notice(group_id, f"⚠️ 没有找到用户 {target_id} 最近的消息")
+
+    async def purge_messages(self, group_id: int, user_id: int, count: Optional[int] = None,
+                             since: Optional[float] = None, exclude: Optional[int] = None) -> int:
+        """撤回用户最近的消息，返回发出的撤回数
+
+        所有撤回同时交给发送调度器，由它按限速陆续发出。
+        """
+        message_ids = [message_id for message_id in self.recent_messages.take(group_id, user_id, count, since)
+                       if message_id != exclude]
+        if not message_ids:
+            return 0
+        results = await asyncio.gather(*(self.delete_message(group_id, message_id) for message_id in message_ids),
+                                       return_exceptions=True)
+        purged = sum(1 for result in results if not isinstance(result, Exception))
+        metrics.inc("bot_messages_purged_total", purged)
+        logger.info(f"已撤回用户{user_id}的{purged}条消息")
+        audit("purge", group_id=group_id, user_id=user_id, message_ids=message_ids, purged=purged)
+        return purged
+
+    async def _purge_on_punish(self, group_id: int, user_id: int, message_id: int) -> int:
+        """处罚时撤回该用户最近 PURGE_AUTO_MINUTES 分钟内的其它消息"""
+        if not PURGE_ON_PUNISH:
+            return 0
+        return await self.purge_messages(group_id, user_id, since=time.time() - PURGE_AUTO_MINUTES * 60,
+                                         exclude=message_id)
+
+    # 新增：图片黑名单
+    async def admin_block_image(self, group_id: int, user_id: int, args: List[str]):
+        """管理员把消息里的图片加入黑名单并撤回该消息"""
+        if self.images is None:
+            await self.send_notice(group_id, "⚠️ 图片黑名单未启用")
+            return
+        if not args:
+            await self.send_notice(group_id, "❌ 用法: 回复图片消息发送 !blockimg，或 !blockimg <消息ID>")
+            return
+
+        message_id = int(args[0])
+        fingerprints = await self._message_images(group_id, message_id)
+        if not fingerprints:
+            await self.send_notice(group_id, f"⚠️ 消息 {message_id} 里没有找到图片")
+            return
+        added_at = time.time()
+        for digest in self.images.block(fingerprints):
+            self.store.save(ModerationStore.IMAGE, digest, added_at)
+        await self.delete_message(group_id, message_id)
+        audit("admin", command="blockimg", group_id=group_id, operator=user_id, message_id=message_id,
+              images=len(fingerprints))
+        await self.send_notice(group_id, f"✅ 已将 {len(fingerprints)} 张图片加入黑名单并撤回消息")
+
+    async def admin_unblock_image(self, group_id: int, user_id: int, args: List[str]):
+        """管理员把消息里的图片移出黑名单"""
+        if self.images is None:
+            await self.send_notice(group_id, "⚠️ 图片黑名单未启用")
+            return
+        if not args:
+            await self.send_notice(group_id, "❌ 用法: 回复图片消息发送 !unblockimg，或 !unblockimg <消息ID>")
+            return
+
+        message_id = int(args[0])
+        fingerprints = await self._message_images(group_id, message_id)
+        removed = self.images.unblock(fingerprints) if fingerprints else []
+        if not removed:
+            await self.send_notice(group_id, f"⚠️ 消息 {message_id} 里没有黑名单中的图片")
+            return
+        for digest in removed:
+            self.store.delete(ModerationStore.IMAGE, digest)
+        audit("admin", command="unblockimg", group_id=group_id, operator=user_id, message_id=message_id)
+        await self.send_notice(group_id, f"✅ 已将消息 {message_id} 的图片移出黑名单")
+
+    async def _message_images(self, group_id: int, message_id: int) -> List[Tuple[int, ...]]:
+        """消息里各图片的摘要：最近的消息直接从记录里取，找不到时才向Napcat查询（只在管理命令里发生）"""
+        fingerprints = self.images.images_of(group_id, message_id)
+        if fingerprints is not None:
+            return fingerprints
+        try:
+            response = await self._send_ws({"action": "get_msg", "params": {"message_id": message_id}})
+        except Exception:
+            return []
+        data = (response or {}).get("data") or {}
+        parsed = ParsedMessage.parse(data.get("raw_message") or "", data.get("message"))
+        return [digests for digests in map(self.images.fingerprint, parsed.images) if digests]
+
+    async def delete_message(self, group_id: int, message_id: int):
+        """撤回消息（参数里只有消息ID，群号用于按群限速）"""
         payload = {
             "action": "delete_msg",
             "params": {
                 "message_id": message_id
             }
         }
-        return await self._send_ws(payload)
+        return await self._send_ws(payload, group_id)
 
-    @websocket_lock
     async def ban_user(self, group_id: int, user_id: int, duration: int):
         """禁言用户"""
         payload = {
@@ -787,7 +3877,6 @@ class GroupRuleEnforcer:
         }
         return await self._send_ws(payload)
 
-    @websocket_lock
     async def kick_user(self, group_id: int, user_id: int):
         """踢出用户"""
         payload = {
@@ -800,95 +3889,472 @@ class GroupRuleEnforcer:
         }
         return await self._send_ws(payload)
 
-    @websocket_lock
     async def send_notice(self, group_id: int, text: str):
-        """发送通知消息"""
-        payload = {
-            "action": "send_group_msg",
-            "params": {
-                "group_id": group_id,
-                "message": text
-            }
-        }
-        return await self._send_ws(payload)
-
-    async def _send_ws(self, payload: Dict):
-        """发送WebSocket请求"""
+        """发送通知消息（短时间内同一群的多条通知会合并成一条）"""
         try:
-            if not self.websocket:
-                raise ConnectionError("WebSocket连接未建立")
-            
-            await self.websocket.send(json.dumps(payload))
-            response = await self.websocket.recv()
-            logger.debug(f"API响应: {response}")
-            return json.loads(response)
-        except websockets.exceptions.ConnectionClosed:
-            logger.warning("连接已关闭，尝试重连...")
-            await self.reconnect()
+            return await self.outbound.notice(group_id, text)
+        except Exception as e:
+            logger.error(f"发送通知失败: {str(e)}")
             raise
+
+    async def _send_ws(self, payload: Dict, group_id: Optional[int] = None):
+        """经发送调度器发出WebSocket请求，响应由读取任务按echo交付；group_id 为按哪个群限速"""
+        try:
+            response = await self.outbound.send(payload, group_id)
+            logger.debug("API响应: %s", response)
+            return response
         except Exception as e:
             logger.error(f"发送WS请求失败: {str(e)}")
             raise
 
-    async def reconnect(self):
-        """重新连接"""
-        if self.websocket:
-            await self.websocket.close()
-        return await self.connect()
+    def _dispatch_frame(self, message, connection: Optional[NapcatConnection] = None):
+        """处理一帧：响应交给动作客户端，事件去重后交给分发器（多进程模式下转给负责该群的工作进程）"""
+        # 多账号时要先在主进程里解析去重，不能直接按文本转发
+        if self.shards is not None and not self.connections.deduplicating and self.shards.route(message):
+            return
+        started = metrics.clock()
+        event = self.codec.decode(message)
+        metrics.observe_since("bot_frame_decode_seconds", started)
+        if event is None or self.actions.feed(event):
+            return
+        if connection is not None and not self.connections.accept(connection, event):
+            return
+        if self.shards is not None:
+            self.shards.route_event(event)
+            return
+        logger.debug("收到原始事件: %s", event)
+        post_type = event.get("post_type")
+        key = event.get("group_id") or event.get("user_id") or 0
+        if post_type == "message":
+            if self.capture is not None and event.get("group_id") in ENABLED_GROUPS:
+                self.capture.record(message)
+            self.dispatcher.submit(key, MessageEvent.from_dict(event))
+        elif post_type == "notice":
+            self.dispatcher.submit(key, event)
+        metrics.inc("bot_events_total", post_type=post_type)
 
     async def run(self):
-        """主运行循环"""
-        while self.running:
-            try:
-                if not await self.connect():
-                    await asyncio.sleep(5)
-                    continue
-
-                logger.info("🚀 机器人已启动，等待消息...")
-                async for message in self.websocket:
-                    try:
-                        event = json.loads(message)
-                        logger.debug(f"收到原始事件: {event}")
-                        if event.get("post_type") == "message":
-                            await self.handle_message(event)
-                    except json.JSONDecodeError:
-                        logger.error(f"无法解析的消息: {message}")
-                    except Exception as e:
-                        logger.error(f"处理消息时出错: {str(e)}")
-
-            except websockets.exceptions.ConnectionClosed:
-                logger.warning("⚠️ 连接断开，5秒后尝试重连...")
-                await asyncio.sleep(5)
-            except KeyboardInterrupt:
-                logger.info("收到终止信号，准备退出...")
-                break
-            except Exception as e:
-                logger.error(f"运行时错误: {str(e)}")
-                await asyncio.sleep(10)
-            finally:
-                if self.websocket:
-                    await self.websocket.close()
+        """主运行循环：各连接自行重连，这里只等待退出"""
+        self.dispatcher.start()
+        self.outbound.start()
+        self.store.start()
+        self.expiry.start()
+        if self.capture is not None:
+            self.capture.start()
+        if self.shards is not None:
+            await self.shards.start(self)
+        try:
+            await self.metrics_server.start()
+        except OSError as e:
+            logger.error(f"指标接口启动失败: {str(e)}")
+        self.connections.start(self._dispatch_frame, self.outbound.submit)
+        # 服务器状态监控只启动一次，与连接断开重连无关
+        if self.monitor_task is None:
+            self.monitor_task = asyncio.create_task(self.monitor_servers())
+        logger.info("🚀 机器人已启动，等待消息...")
+        await self._stopped.wait()
 
     async def shutdown(self):
         """关闭机器人"""
         self.running = False
-        if self.websocket:
-            await self.websocket.close()
+        self._stopped.set()
         if self.monitor_task:
             self.monitor_task.cancel()
+        if self.connections is not None:
+            await self.connections.stop()
+        await self.dispatcher.stop()
+        await self.outbound.stop()
+        await self.expiry.stop()
+        await self.mc_status.close()
+        await self.metrics_server.stop()
+        if self.shards is not None:
+            await self.shards.stop()
+        if self.capture is not None:
+            await self.capture.close()
+        await self.store.close()
+
+class ShardChannel:
+    """主进程与工作进程之间的消息通道：socketpair 上的帧，格式为 4字节长度 + 1字节类型 + 内容"""
+
+    EVENT = b"E"  # 主→工作：原始事件帧
+    SNAPSHOT = b"L"  # 主→工作：启动时的完整状态
+    RESULT = b"R"  # 主→工作：动作的响应
+    ACTION = b"A"  # 工作→主：要发出的动作
+    STATE = b"S"  # 双向：一条状态修改 [类型, 用户ID, 值, 计数]，值为null表示删除
+    STATS = b"T"  # 工作→主：定期上报的处理计数
+    STATUS = b"Q"  # 工作→主：查询MC服务器状态（读主进程的共享缓存），响应同样以 RESULT 发回
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, sock: socket.socket) -> "ShardChannel":
+        reader, writer = await asyncio.open_connection(sock=sock)
+        return cls(reader, writer)
+
+    @property
+    def buffered(self) -> int:
+        """已写入但还没送出的字节数"""
+        return self.writer.transport.get_write_buffer_size()
+
+    def send(self, kind: bytes, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.writer.write(struct.pack(">I", len(payload) + 1) + kind + payload)
+
+    async def recv(self) -> Tuple[bytes, bytes]:
+        """读取一帧，对端关闭时抛出 asyncio.IncompleteReadError"""
+        length, = struct.unpack(">I", await self.reader.readexactly(4))
+        body = await self.reader.readexactly(length)
+        return body[:1], body[1:]
+
+    def close(self):
+        self.writer.close()
+
+
+class ConsistentHashRing:
+    """一致性哈希环：每个节点放若干虚拟节点，节点数变化时只有少量键换到别的节点"""
+
+    def __init__(self, nodes, replicas: int = SHARD_VIRTUAL_NODES):
+        points = sorted((self._hash(f"{node}#{index}"), node) for node in nodes for index in range(replicas))
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key) -> int:
+        return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+    def node_for(self, key):
+        index = bisect.bisect(self._points, self._hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+class ShardActionClient:
+    """工作进程里的动作客户端：请求经通道交给主进程，由主进程的连接（含限速）发出"""
+
+    def __init__(self, channel: ShardChannel):
+        self.channel = channel
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._seq = itertools.count(1)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    async def call(self, payload: Dict) -> Dict:
+        try:
+            # 主进程那边还要排队限速，多等一些
+            return await self._request(ShardChannel.ACTION, {"payload": payload}, ACTION_TIMEOUT * 3)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"API请求超时: {payload.get('action')}")
+
+    async def server_status(self, host: str, port: int) -> dict:
+        """经主进程的服务器状态缓存查询，工作进程自己不发起查询"""
+        deadline = SERVER_CHECK_TIMEOUT * SERVER_CHECK_RETRY + MC_QUERY_DEADLINE
+        try:
+            return await self._request(ShardChannel.STATUS, {"host": host, "port": port}, deadline)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"服务器状态查询超时: {host}:{port}")
+
+    async def _request(self, kind: bytes, body: Dict, timeout: float):
+        request_id = next(self._seq)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self.channel.send(kind, json_dumps({"id": request_id, **body}))
+            return await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def feed(self, data: Dict) -> bool:
+        return False  # 工作进程收到的都是事件，响应走 resolve()
+
+    def resolve(self, payload: bytes):
+        """处理主进程发回的响应"""
+        reply = json_loads(payload)
+        future = self._pending.get(reply["id"])
+        if future is None or future.done():
+            return
+        if "error" in reply:
+            future.set_exception(ConnectionError(reply["error"]))
+        else:
+            future.set_result(reply["response"])
+
+    def fail_all(self, exc: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self._pending.clear()
+
+
+class SharedStateClient:
+    """工作进程里的状态存储：修改经通道交给主进程写盘，并由主进程同步给其它工作进程
+
+    接口与 ModerationStore 相同；启动状态由主进程在连接建立后发来。
+    """
+
+    def __init__(self, channel: ShardChannel, snapshot: Dict):
+        self.channel = channel
+        self.snapshot = snapshot
+
+    def load(self) -> Dict[str, Dict[int, Tuple[float, int]]]:
+        # JSON对象的键是字符串
+        return {kind: {int(user_id): tuple(row) for user_id, row in rows.items()}
+                for kind, rows in self.snapshot.items()}
+
+    def save(self, kind: str, user_id: int, value: float = 0, count: int = 0):
+        self.channel.send(ShardChannel.STATE, json_dumps([kind, user_id, value, count]))
+
+    def delete(self, kind: str, user_id: int):
+        self.channel.send(ShardChannel.STATE, json_dumps([kind, user_id, None, 0]))
+
+    def start(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class ShardPool:
+    """多进程模式（主进程侧）：启动工作进程，按群号一致性哈希转发事件，代发它们的动作、查询服务器状态并同步状态
+
+    主进程只做帧的文本预过滤和转发，JSON解析与规则检测都在工作进程里；同一个群总落在同一个
+    工作进程上，群内按序处理。状态修改由主进程写入数据库并广播给其它工作进程，后写的覆盖先写的。
+    """
+
+    def __init__(self, workers: int = WORKER_PROCESSES):
+        self.workers = workers
+        self.ring = ConsistentHashRing(range(workers))
+        self.owner: Optional["GroupRuleEnforcer"] = None
+        self.channels: List[Optional[ShardChannel]] = [None] * workers
+        self.processes: List = [None] * workers
+        self.tasks: List[Optional[asyncio.Task]] = [None] * workers
+        self.running = False
+        self.forwarded = 0  # 转给工作进程的事件数
+        self.dropped = 0  # 工作进程积压过多而丢弃的事件数
+        self.worker_stats: List[Dict[str, int]] = [{} for _ in range(workers)]  # 各工作进程最近上报的计数
+        self.ready: List[asyncio.Event] = []  # 工作进程第一次上报计数即表示已就绪
+        self._context = multiprocessing.get_context("spawn")
+        self._log_queue = None
+        self._log_listener = None
+
+    async def start(self, owner: "GroupRuleEnforcer"):
+        """启动所有工作进程（owner 为主进程中持有连接的实例）"""
+        if self.running:
+            return
+        self.owner = owner
+        self.running = True
+        # 工作进程的日志交给主进程的日志线程写盘，避免多个进程同时轮转同一个文件
+        # （没有调用 setup_logging 时，如压测脚本，交给根日志器现有的处理器）
+        handlers = log_listener.handlers if log_listener is not None else logging.getLogger().handlers
+        self._log_queue = self._context.Queue()
+        self._log_listener = logging.handlers.QueueListener(
+            self._log_queue, *(handlers or [logging.lastResort]), respect_handler_level=True
+        )
+        self._log_listener.start()
+        self.ready = [asyncio.Event() for _ in range(self.workers)]
+        for index in range(self.workers):
+            await self._spawn(index)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(event.wait() for event in self.ready)), timeout=60)
+            logger.info(f"已启动 {self.workers} 个工作进程")
+        except asyncio.TimeoutError:
+            logger.error("部分工作进程未能在60秒内就绪")
+
+    async def _spawn(self, index: int):
+        parent, child = socket.socketpair()
+        process = self._context.Process(target=run_shard_worker, args=(index, child, self._log_queue),
+                                        name=f"shard-{index}", daemon=True)
+        process.start()
+        child.close()
+        channel = await ShardChannel.open(parent)
+        channel.send(ShardChannel.SNAPSHOT, json_dumps(self.owner._state_snapshot()))
+        self.channels[index] = channel
+        self.processes[index] = process
+        self.tasks[index] = asyncio.create_task(self._serve(index, channel))
+
+    async def _serve(self, index: int, channel: ShardChannel):
+        """接收工作进程发来的动作与状态修改，进程退出时重启"""
+        try:
+            while True:
+                kind, payload = await channel.recv()
+                if kind == ShardChannel.ACTION:
+                    asyncio.create_task(self._forward_action(channel, payload))
+                elif kind == ShardChannel.STATUS:
+                    asyncio.create_task(self._forward_status(channel, payload))
+                elif kind == ShardChannel.STATE:
+                    self._apply_state(index, payload)
+                elif kind == ShardChannel.STATS:
+                    self.worker_stats[index] = json_loads(payload)
+                    self.ready[index].set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        channel.close()
+        self.channels[index] = None
+        if self.running:
+            logger.error(f"工作进程{index}已退出，1秒后重启")
+            await asyncio.sleep(1)
+            if self.running:
+                await self._spawn(index)
+
+    async def _forward_action(self, channel: ShardChannel, payload: bytes):
+        request = json_loads(payload)
+        try:
+            reply = {"id": request["id"], "response": await self.owner.outbound.send(request["payload"])}
+        except Exception as e:
+            reply = {"id": request["id"], "error": str(e)}
+        if not channel.writer.is_closing():
+            channel.send(ShardChannel.RESULT, json_dumps(reply))
+
+    async def _forward_status(self, channel: ShardChannel, payload: bytes):
+        """工作进程里的 !mcstatus：从主进程与监控共用的缓存读取，过期时才查询"""
+        request = json_loads(payload)
+        target = (request["host"], request["port"])
+        name = next((name for name, config in MC_SERVERS.items() if (config["host"], config["port"]) == target), None)
+        try:
+            if name is not None:
+                response = await self.owner.status_cache.get(name)
+            else:
+                response = await self.owner._reliable_server_query(*target)
+            reply = {"id": request["id"], "response": response}
+        except Exception as e:
+            reply = {"id": request["id"], "error": str(e)}
+        if not channel.writer.is_closing():
+            channel.send(ShardChannel.RESULT, json_dumps(reply))
+
+    def _apply_state(self, origin: int, payload: bytes):
+        kind, user_id, value, count = json_loads(payload)
+        row = None if value is None else (value, count)
+        if row is None:
+            self.owner.store.delete(kind, user_id)
+        else:
+            self.owner.store.save(kind, user_id, value, count)
+        self.owner._apply_state(kind, user_id, row)
+        for index, channel in enumerate(self.channels):
+            if index != origin and channel is not None:
+                channel.send(ShardChannel.STATE, payload)
+
+    def stats(self) -> Dict[str, int]:
+        """所有工作进程上报的处理计数之和（最多滞后 SHARD_STATS_INTERVAL 秒）"""
+        total = {"forwarded": self.forwarded, "dropped_forwarding": self.dropped}
+        for stats in self.worker_stats:
+            for name, value in stats.items():
+                total[name] = total.get(name, 0) + value
+        return total
+
+    def route(self, frame) -> bool:
+        """在主进程里处理一帧原始事件：不需要的丢弃，其余按群号转发；需要本进程解析（API响应）时返回False"""
+        text = frame.decode("utf-8") if isinstance(frame, (bytes, bytearray)) else frame
+        if '"echo"' in text:
+            return False
+        if not self.owner.codec.skip(text):
+            self._send(self.owner.codec.shard_key(text), text)
+        return True
+
+    def route_event(self, event: Dict):
+        """转发一个已解析的事件"""
+        self._send(event.get("group_id") or event.get("user_id") or 0, json_dumps(event))
+
+    def _send(self, key: int, text: str):
+        channel = self.channels[self.ring.node_for(key)]
+        if channel is None or channel.buffered > SHARD_MAX_BUFFER:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"工作进程积压过多，已累计丢弃 {self.dropped} 个事件")
+            return
+        channel.send(ShardChannel.EVENT, text)
+        self.forwarded += 1
+
+    async def stop(self):
+        """关闭通道（工作进程随之退出），等待进程结束"""
+        self.running = False
+        for index, channel in enumerate(self.channels):
+            if channel is not None:
+                channel.close()
+                self.channels[index] = None
+        await asyncio.gather(*(task for task in self.tasks if task is not None), return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        if self._log_listener is not None:
+            self._log_listener.stop()
+            self._log_listener = None
+
+
+def run_shard_worker(index: int, sock: socket.socket, log_queue):
+    """工作进程入口"""
+    setup_logging(log_queue)
+    try:
+        asyncio.run(_shard_worker_main(index, sock))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _shard_worker_main(index: int, sock: socket.socket):
+    channel = await ShardChannel.open(sock)
+    _, snapshot = await channel.recv()
+    actions = ShardActionClient(channel)
+    bot = GroupRuleEnforcer(actions=actions, store=SharedStateClient(channel, json_loads(snapshot)))
+    # !mcstatus 读主进程与服务器监控共用的缓存；这里不再缓存，只合并同一服务器的并发请求
+    bot.status_cache = ServerStatusCache(actions.server_status, MC_SERVERS, ttl=0)
+    bot.dispatcher.start()
+    bot.outbound.start()
+    bot.expiry.start()
+    if bot.capture is not None:
+        bot.capture.start()
+    logger.info(f"工作进程{index}已启动")
+
+    async def report_stats():
+        while True:
+            channel.send(ShardChannel.STATS, json_dumps({**bot.dispatcher.stats(), "in_flight": actions.in_flight}))
+            await asyncio.sleep(SHARD_STATS_INTERVAL)
+
+    reporter = asyncio.create_task(report_stats())
+    try:
+        while True:
+            kind, payload = await channel.recv()
+            if kind == ShardChannel.EVENT:
+                try:
+                    bot._dispatch_frame(payload)
+                except Exception as e:
+                    logger.error(f"工作进程{index}处理事件时出错: {str(e)}")
+            elif kind == ShardChannel.RESULT:
+                actions.resolve(payload)
+            elif kind == ShardChannel.STATE:
+                kind, user_id, value, count = json_loads(payload)
+                bot._apply_state(kind, user_id, None if value is None else (value, count))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass  # 主进程关闭了通道
+    finally:
+        reporter.cancel()
+        actions.fail_all(ConnectionError("主进程已断开"))
+        await bot.shutdown()
+        channel.close()
+
 
 async def main():
-    bot = GroupRuleEnforcer()
+    bot = GroupRuleEnforcer(shards=ShardPool() if WORKER_PROCESSES > 1 else None)
     try:
         await bot.run()
     except KeyboardInterrupt:
-        await bot.shutdown()
+        pass
     except Exception as e:
         logger.critical(f"致命错误: {str(e)}")
     finally:
+        # 无论如何退出都要写完未落盘的状态
+        await bot.shutdown()
         logger.info("机器人已停止")
 
 if __name__ == "__main__":
+    setup_logging()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
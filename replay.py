@@ -0,0 +1,202 @@
+"""离线回放：用录制的消息事件评估违禁词/广告规则，不执行任何动作
+
+用法:
+    python replay.py --dump-rules baseline.json          # 修改词库前先导出现行规则作为基线
+    python replay.py captures/ --baseline baseline.json  # 修改后回放，输出各规则命中数和与基线的差异
+    python replay.py captures/ --rules candidate.json    # 不改 main.py，直接评估一份候选规则
+
+输入为 main.py 在设置 CAPTURE_DIR 后录制的 .jsonl.gz 分段（也接受未压缩的 .jsonl，
+每行一条原始事件帧），可以是文件或目录。每个分段交给一个进程，完整走一遍 ModerationPipeline
+（预处理、规则匹配、刷屏与刷屏潮检测，两者都按事件自带的时间计算）。
+规则文件为JSON对象，键为级别名（按处罚轻重从高到低），值为正则列表，与 RULE_TIERS 对应。
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import main
+from main import EventCodec, MessageEvent, ModerationPipeline, RuleMatcher
+
+EXAMPLES_PER_RULE = 3  # 每条规则保留的差异示例数
+
+_pipeline: Optional[ModerationPipeline] = None
+_baseline: Optional[RuleMatcher] = None
+
+
+def load_rules(path: str) -> Tuple:
+    """读取规则文件，返回 RULE_TIERS 格式"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return tuple((name, set(patterns)) for name, patterns in data.items())
+
+
+def dump_rules(tiers, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({name: sorted(patterns) for name, patterns in tiers}, f, ensure_ascii=False, indent=2)
+
+
+def find_segments(paths: List[str]) -> List[str]:
+    segments = []
+    for path in paths:
+        if os.path.isdir(path):
+            segments.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith(".jsonl.gz") or name.endswith(".jsonl")
+            ))
+        else:
+            segments.append(path)
+    return segments
+
+
+def _init_worker(tiers, baseline_tiers):
+    global _pipeline, _baseline
+    main.logger.setLevel("ERROR")
+    _pipeline = ModerationPipeline(tiers)
+    _baseline = RuleMatcher(baseline_tiers) if baseline_tiers is not None else None
+
+
+def replay_segment(path: str) -> Dict:
+    """回放一个分段，返回计数（在工作进程里运行）"""
+    codec = EventCodec(_pipeline.enabled_groups)
+    hits, baseline_hits, added, removed = Counter(), Counter(), Counter(), Counter()
+    examples: Dict[str, List[str]] = {}
+    messages = moderated = changed = 0
+    truncated = False
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                event = codec.decode(line)
+                if event is None or event.get("post_type") != "message":
+                    continue
+                messages += 1
+                message = MessageEvent.from_dict(event)
+                if not _pipeline.applies(message):
+                    continue
+                moderated += 1
+
+                text = _pipeline.parse(message).text
+                decisions = _pipeline.decide(message, now=message.time or None, text=text)
+                hit = None
+                for tier, rule in decisions:
+                    hits[f"{tier}\t{rule}"] += 1
+                    if tier not in _pipeline.NON_TEXT_TIERS:
+                        hit = (tier, rule)
+                if _baseline is None:
+                    continue
+
+                base = _baseline.match(_pipeline.normalize(text)) if text else None
+                if base is not None:
+                    baseline_hits[f"{base[0]}\t{base[1]}"] += 1
+                if hit == base:
+                    continue
+                if base is None:
+                    key = f"{hit[0]}\t{hit[1]}"
+                    added[key] += 1
+                elif hit is None:
+                    key = f"{base[0]}\t{base[1]}"
+                    removed[key] += 1
+                else:
+                    key = f"{base[0]}\t{base[1]}\t->\t{hit[0]}\t{hit[1]}"
+                    changed += 1
+                samples = examples.setdefault(key, [])
+                if len(samples) < EXAMPLES_PER_RULE:
+                    samples.append(message.raw_message[:80])
+        except EOFError:
+            truncated = True  # 未正常关闭的分段，读到哪算哪
+
+    return {"messages": messages, "moderated": moderated, "hits": hits, "baseline_hits": baseline_hits,
+            "added": added, "removed": removed, "changed": changed, "examples": examples, "truncated": truncated}
+
+
+def merge(results: List[Dict]) -> Dict:
+    total = {"messages": 0, "moderated": 0, "hits": Counter(), "baseline_hits": Counter(), "added": Counter(),
+             "removed": Counter(), "changed": 0, "examples": {}, "truncated": 0}
+    for result in results:
+        for name in ("messages", "moderated", "changed", "truncated"):
+            total[name] += result[name]
+        for name in ("hits", "baseline_hits", "added", "removed"):
+            total[name].update(result[name])
+        for key, samples in result["examples"].items():
+            merged = total["examples"].setdefault(key, [])
+            merged.extend(samples[:EXAMPLES_PER_RULE - len(merged)])
+    return total
+
+
+def report(total: Dict, has_baseline: bool, elapsed: float, segments: int):
+    rate = total["messages"] / elapsed if elapsed > 0 else 0
+    print(f"回放 {segments} 个分段，共 {total['messages']:,} 条消息（需审核 {total['moderated']:,} 条），"
+          f"耗时 {elapsed:.1f} 秒（{rate:,.0f} 条/秒）")
+    if total["truncated"]:
+        print(f"其中 {total['truncated']} 个分段不完整，只回放了可读部分")
+
+    keys = sorted(set(total["hits"]) | set(total["baseline_hits"]),
+                  key=lambda key: (-total["hits"][key], key))
+    print("\n规则命中" + ("（候选 / 基线 / 变化）" if has_baseline else "") + ":")
+    for key in keys:
+        tier, rule = key.split("\t")
+        line = f"  {tier:<8} {rule:<30} {total['hits'][key]:>10,}"
+        if has_baseline and tier not in ModerationPipeline.NON_TEXT_TIERS:
+            baseline = total["baseline_hits"][key]
+            line += f" {baseline:>10,} {total['hits'][key] - baseline:>+10,}"
+        print(line)
+
+    if not has_baseline:
+        return
+    print(f"\n与基线逐条比较: 新增命中 {sum(total['added'].values()):,} 条，"
+          f"不再命中 {sum(total['removed'].values()):,} 条，改判 {total['changed']:,} 条")
+    for title, counter in (("新增命中", total["added"]), ("不再命中", total["removed"])):
+        for key, count in counter.most_common():
+            print(f"  {title} {key.replace(chr(9), ' ')}: {count:,}")
+            for sample in total["examples"].get(key, []):
+                print(f"      {sample}")
+    for key, samples in total["examples"].items():
+        if "\t->\t" in key:
+            print(f"  改判 {key.replace(chr(9), ' ')}")
+            for sample in samples:
+                print(f"      {sample}")
+
+
+def main_cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="离线回放录制的消息，评估规则命中")
+    parser.add_argument("paths", nargs="*", help="录制分段文件或目录")
+    parser.add_argument("--rules", help="候选规则文件（默认使用 main.py 中的 RULE_TIERS）")
+    parser.add_argument("--baseline", help="基线规则文件，输出与之的差异")
+    parser.add_argument("--dump-rules", metavar="PATH", help="把 main.py 中的现行规则导出为规则文件后退出")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="并行进程数")
+    parser.add_argument("--json", metavar="PATH", help="另外把结果写成JSON")
+    args = parser.parse_args(argv)
+
+    if args.dump_rules:
+        dump_rules(main.RULE_TIERS, args.dump_rules)
+        print(f"已导出现行规则: {args.dump_rules}")
+        return 0
+
+    segments = find_segments(args.paths)
+    if not segments:
+        parser.error("没有找到录制分段")
+    tiers = load_rules(args.rules) if args.rules else main.RULE_TIERS
+    baseline_tiers = load_rules(args.baseline) if args.baseline else None
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(segments))), initializer=_init_worker,
+                             initargs=(tiers, baseline_tiers)) as pool:
+        total = merge(list(pool.map(replay_segment, segments)))
+    elapsed = time.perf_counter() - started
+
+    report(total, baseline_tiers is not None, elapsed, len(segments))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({**total, "segments": len(segments), "seconds": elapsed}, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())